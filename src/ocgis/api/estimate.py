@@ -0,0 +1,319 @@
+from copy import deepcopy
+import numpy as np
+from shapely.geometry.point import Point
+from ocgis import env
+from ocgis.exc import EmptyData
+from ocgis.interface.shp import ShpDataset
+from ocgis.interface.nc.dimension import NcGridDimension
+from ocgis.interface.nc.temporal import get_date_parts_num
+from ocgis.calc.engine import OcgCalculationEngine
+from ocgis.calc.reduction import REDUCTIONS
+from ocgis.calc.library import SampleSize
+from ocgis.api.subset import get_igeom
+
+
+class RequestEstimate(object):
+    '''Sizes of an operation predicted before execution. The sizes are computed
+    from the metadata of the request datasets (dimension lengths and data
+    types), the grid windows of the selection geometries' bounds, and the
+    number of temporal groups. No data is read. Sizes are in bytes and exclude
+    geometries and output conversion. The peak memory includes the data read
+    shared by the selection geometries and the zonal aggregates held for the
+    whole operation.
+
+    >>> estimate = RequestEstimate(ops)
+    >>> estimate.read,estimate.output,estimate.get_memory()
+
+    :param ops: The operations to estimate.
+    :type ops: :class:`ocgis.OcgOperations`
+    '''
+
+    def __init__(self,ops):
+        self.ops = ops
+        if ops.calc is None:
+            self._engine = None
+        else:
+            self._engine = OcgCalculationEngine(ops.calc_grouping,ops.calc,
+                                                raw=ops.calc_raw,agg=ops.aggregate)
+        ## bytes read from the datasets
+        self.read = 0
+        ## bytes of the output values
+        self.output = 0
+        ## peak bytes for each selection geometry
+        self._memory = []
+        ## peak bytes for each selection geometry with streamed calculations
+        self._memory_stream = []
+        ## bytes of the data reads shared by the selection geometries when
+        ## running serially. see SubsetOperation._plan_hyperslabs_.
+        self._shared = 0
+        ## bytes of the aggregates computed for all selection geometries. see
+        ## env.ZONAL_AGGREGATE.
+        self._zonal = 0
+        ## sorted cell edges of each dataset's grid
+        self._edges = {}
+
+        geoms = list(self._iter_geoms_())
+        shared = ops.slice is None and not ops.file_only and len(geoms) > 1
+        temporal,windows = {},{}
+        for rd in ops.dataset:
+            temporal[rd.alias] = self._get_time_groups_(rd)
+            windows[rd.alias] = [self._get_window_(rd,geom) for geom in geoms]
+        zonal = dict([(rd.alias,shared and self._is_zonal_(rd,windows[rd.alias])) for rd in ops.dataset])
+        for idx in range(len(geoms)):
+            memory,memory_stream = 0,0
+            for rd in ops.dataset:
+                ntime,ngroups = temporal[rd.alias]
+                window = windows[rd.alias][idx]
+                ## zonal aggregates are read for all geometries at once
+                if zonal[rd.alias]:
+                    window = ((0,1),(0,1)) if self._get_cells_(window) > 0 else ((0,0),(0,0))
+                sizes = self._get_sizes_(rd,window,ntime,ngroups,read=not zonal[rd.alias])
+                self.read += sizes['read']
+                self.output += sizes['output']
+                memory += sizes['memory']
+                if memory_stream is not None and sizes['memory_stream'] is not None:
+                    memory_stream += sizes['memory_stream']
+                else:
+                    memory_stream = None
+            self._memory.append(memory)
+            self._memory_stream.append(memory_stream)
+
+        if shared:
+            for rd in ops.dataset:
+                ntime = temporal[rd.alias][0]
+                itemsize,nlevel = self._get_itemsize_level_(rd)
+                union = self._get_union_(windows[rd.alias])
+                ## values of the window covering all geometries
+                nvalue = ntime*nlevel*self._get_cells_(union)
+                if zonal[rd.alias]:
+                    self.read += nvalue*itemsize
+                    block = int(env.STREAM_BLOCK_LIMIT*1024**2*(itemsize+1)//itemsize)
+                    self._zonal += min(nvalue*(itemsize+1),block)
+                    self._zonal += ntime*nlevel*len(geoms)*(8+1)
+                else:
+                    self._shared += self._get_shared_read_(windows[rd.alias],union,nvalue,itemsize)
+
+    def can_stream(self):
+        '''
+        :returns: `True` if the calculations are streamed over blocks of time
+         steps when :attr:`env.STREAM_CALC` is `True`.
+        :rtype: bool
+        '''
+        return(self._engine is not None and self._engine.can_stream())
+
+    def get_memory(self,serial=True,stream=False):
+        '''
+        :param bool serial: If `False`, estimate the memory with the selection
+         geometries processed concurrently by :attr:`env.CORES` processes.
+        :param bool stream: If `True`, estimate the memory with calculations
+         streamed over blocks of time steps.
+        :returns: The peak memory in bytes or `None` if the calculations may not
+         be streamed.
+        :rtype: int
+        '''
+        memory = self._memory_stream if stream else self._memory
+        if len(memory) == 0:
+            ret = 0
+        elif any([m is None for m in memory]):
+            ret = None
+        else:
+            ## the largest geometries may be processed at the same time
+            workers = 1 if serial else env.CORES
+            ret = sum(sorted(memory)[-workers:])+self._zonal
+            ## reads are only shared when running serially
+            if serial:
+                ret += self._shared
+        return(ret)
+
+    def _get_itemsize_level_(self,rd):
+        ods = rd.ds
+        itemsize = np.dtype(ods.metadata['variables'][rd.variable]['dtype']).itemsize
+        if ods.level is None or self.ops.snippet:
+            nlevel = 1
+        elif rd.level_range is not None:
+            nlevel = rd.level_range[1]-rd.level_range[0]+1
+        else:
+            nlevel = ods.level.shape[0]
+        return(itemsize,nlevel)
+
+    def _get_sizes_(self,rd,window,ntime,ngroups,read=True):
+        itemsize,nlevel = self._get_itemsize_level_(rd)
+        ncell = self._get_cells_(window)
+        ## cells of the output values
+        ocell = 1 if self.ops.aggregate else ncell
+
+        nvalue = ntime*nlevel*ncell
+        ## values are masked arrays
+        value = nvalue*(itemsize+1)
+        if self.ops.aggregate:
+            value += ntime*nlevel*(itemsize+1)
+        ret = {'read':nvalue*itemsize if read else 0}
+
+        if self._engine is None:
+            ret['output'] = ntime*nlevel*ocell*itemsize
+            ret['memory'] = value
+            ret['memory_stream'] = None
+        else:
+            ## the sample size is counted with the reductions
+            funcs = self._engine.funcs
+            reducing = [f['ref'] for f in funcs if f['ref'] != SampleSize]
+            ## cells of the calculation's input values
+            ccell = 1 if self._engine.use_agg else ncell
+            output = ngroups*nlevel*ocell*len(funcs)*(8+1)
+            reduced = 0
+            if any([ref.reductions is not None for ref in reducing]):
+                reduced = ngroups*nlevel*ccell*(8+1)*len(REDUCTIONS)
+            ## transformed, nan-filled, or sorted copies of the values
+            copy = 0
+            if not all([ref._shares_reductions_() for ref in reducing]):
+                copy = ntime*nlevel*ccell*(8+1)
+            ret['output'] = ngroups*nlevel*ocell*len(funcs)*8
+            ret['memory'] = value+copy+reduced+output
+            if self._engine.can_stream():
+                ## a block of time steps is held in place of the values
+                block = int(env.STREAM_BLOCK_LIMIT*1024**2*(itemsize+1)//itemsize)
+                ret['memory_stream'] = min(value,block)+reduced+output
+            else:
+                ret['memory_stream'] = None
+        return(ret)
+
+    def _get_time_groups_(self,rd):
+        ## snippets contain the first time step or temporal group
+        if self.ops.snippet:
+            ret = (1,1)
+        else:
+            ods = rd.ds
+            try:
+                if rd.time_range is None:
+                    temporal = ods.temporal[:]
+                else:
+                    temporal = ods.temporal.subset(*rd.time_range)
+            except EmptyData:
+                ret = (0,0)
+            else:
+                ntime = temporal.shape[0]
+                if self._engine is None or self._engine.grouping is None or ntime == 0:
+                    ngroups = ntime
+                else:
+                    ngroups = self._get_ngroups_(temporal,self._engine.grouping)
+                ret = (ntime,ngroups)
+        return(ret)
+
+    @staticmethod
+    def _get_ngroups_(temporal,grouping):
+        ## the date parts are decoded from the numeric times if possible as
+        ## opposed to datetime objects
+        try:
+            parts = get_date_parts_num(temporal.value_num,temporal.units,temporal.calendar)
+        except (NotImplementedError,ValueError,TypeError,AttributeError):
+            parts = temporal.get_date_parts()
+        date_parts = ('year','month','day','hour','minute','second','microsecond')
+        idx = [ii for ii,part in enumerate(date_parts) if part in grouping]
+        return(np.unique(parts[:,idx],axis=0).shape[0])
+
+    def _get_window_(self,rd,geom):
+        '''
+        :returns: Start and stop indices of the row and column windows of the
+         selection geometry's bounds or `None` for a point selection geometry.
+         Indices of vector grids are positions in the sorted cell edges.
+        '''
+        ods = rd.ds
+        igeom = get_igeom(ods,deepcopy(geom))
+        grid = ods.spatial.grid
+        if igeom is None:
+            ret = ((0,grid.shape[0]),(0,grid.shape[1]))
+        elif isinstance(igeom,Point):
+            ret = None
+        elif isinstance(grid,NcGridDimension):
+            if rd.alias not in self._edges:
+                self._edges[rd.alias] = [self._get_edges_(dim) for dim in [grid.row,grid.column]]
+            minx,miny,maxx,maxy = igeom.bounds
+            row,column = self._edges[rd.alias]
+            ret = (self._get_range_(row,miny,maxy),self._get_range_(column,minx,maxx))
+        else:
+            try:
+                shape = grid.subset(polygon=igeom).shape
+            ## the geometry does not overlap the grid
+            except (EmptyData,IndexError,ValueError):
+                shape = (0,0)
+            ret = ((0,shape[0]),(0,shape[1]))
+        return(ret)
+
+    @staticmethod
+    def _get_edges_(dim):
+        ## sorted lower and upper cell edges and sorted cell centers
+        value = np.sort(dim.value)
+        if dim.bounds is None:
+            ret = (None,None,value)
+        else:
+            ret = (np.sort(dim.bounds.min(axis=1)),np.sort(dim.bounds.max(axis=1)),value)
+        return(ret)
+
+    @staticmethod
+    def _get_range_(edges,lower,upper):
+        '''The cells selected by :meth:`AbstractVectorDimension.subset`. Cells
+        overlap the limits if their upper edge is above the lower limit and
+        their lower edge is below the upper limit. Otherwise, cells with
+        centers inside the limits are selected.'''
+        lower_edge,upper_edge,value = edges
+        start,stop = 0,0
+        if lower_edge is not None:
+            start = np.searchsorted(upper_edge,lower,side='right')
+            stop = np.searchsorted(lower_edge,upper,side='left')
+        if start >= stop:
+            start = np.searchsorted(value,lower,side='left')
+            stop = np.searchsorted(value,upper,side='right')
+        return((int(start),int(max(start,stop))))
+
+    @staticmethod
+    def _get_cells_(window):
+        ## point selection geometries select a single cell
+        if window is None:
+            ret = 1
+        else:
+            ret = (window[0][1]-window[0][0])*(window[1][1]-window[1][0])
+        return(ret)
+
+    @classmethod
+    def _get_union_(cls,windows):
+        windows = [w for w in windows if w is not None and cls._get_cells_(w) > 0]
+        if len(windows) == 0:
+            ret = ((0,0),(0,0))
+        else:
+            ret = ((min([w[0][0] for w in windows]),max([w[0][1] for w in windows])),
+                   (min([w[1][0] for w in windows]),max([w[1][1] for w in windows])))
+        return(ret)
+
+    def _get_shared_read_(self,windows,union,nvalue,itemsize):
+        '''Bytes of the shared read planned by
+        :meth:`ocgis.interface.nc.dataset.NcDataset.plan_hyperslab`.'''
+        windows = [w for w in windows if w is not None and self._get_cells_(w) > 0]
+        ret = 0
+        if len(windows) > 1:
+            ## the union window is read only if it is not larger than the
+            ## individual windows and fits the limit
+            ncells = sum([self._get_cells_(w) for w in windows])
+            if self._get_cells_(union) <= ncells and \
+               nvalue*itemsize <= env.SHARED_READ_LIMIT*1024**2:
+                ret = nvalue*(itemsize+1)
+        return(ret)
+
+    def _is_zonal_(self,rd,windows):
+        '''`True` if the dataset is aggregated for all selection geometries at
+        once. See :meth:`ocgis.api.subset.SubsetOperation._get_zonal_aggregates_`.'''
+        ops = self.ops
+        ret = False
+        if env.ZONAL_AGGREGATE and ops.aggregate and not ops.calc_raw:
+            spatial = rd.ds.spatial
+            if spatial.abstraction == 'polygon' and isinstance(spatial.grid,NcGridDimension) and \
+               spatial.grid.is_bounded and all([w is not None for w in windows]):
+                ret = True
+        return(ret)
+
+    def _iter_geoms_(self):
+        geom = self.ops.geom
+        if isinstance(geom,ShpDataset):
+            for element in geom:
+                yield(element)
+        else:
+            yield(geom)
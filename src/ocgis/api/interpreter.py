@@ -3,10 +3,10 @@ from ocgis.api.parms import definition
 from ocgis.conv.meta import MetaConverter
 from ocgis.conv.base import OcgConverter
 from subset import SubsetOperation
+from estimate import RequestEstimate
 import os
 import shutil
 
-## TODO: add method to estimate request size
 
 class Interpreter(object):
     '''Superclass for custom interpreter frameworks.
@@ -94,16 +94,27 @@ class OcgInterpreter(Interpreter):
 #                conv = NcEmpty(None,outdir,prefix,ops=self.ops)
 #                ret = conv.write()
 #            else:
+            ## select an execution strategy fitting the memory budget
+            serial,stream = self._get_strategy_()
             ## the operations object performs subsetting and calculations
             if env.VERBOSE: print('initializing subset...')
-            so = SubsetOperation(self.ops,serial=env.SERIAL,nprocs=env.CORES,validate=True)
+            so = SubsetOperation(self.ops,serial=serial,nprocs=env.CORES,validate=True,
+                                 ordered=env.ORDERED)
             ## if there is no grouping on the output files, a singe converter is
             ## is needed
             if self.ops.output_grouping is None:
                 Conv = OcgConverter.get_converter(self.ops.output_format)
                 if env.VERBOSE: print('initializing converter...')
                 conv = Conv(so,outdir,prefix,mode=self.ops.mode,ops=self.ops)
-                ret = conv.write()
+                ## calculations are streamed if required by the memory budget
+                switch = stream and not env.STREAM_CALC
+                if switch:
+                    env.STREAM_CALC = True
+                try:
+                    ret = conv.write()
+                finally:
+                    if switch:
+                        env.STREAM_CALC = False
             else:
                 raise(NotImplementedError)
         
@@ -111,3 +122,33 @@ class OcgInterpreter(Interpreter):
             print('execution complete.')
             
         return(ret)
+    
+    def _get_strategy_(self):
+        '''Select the execution strategy for the memory budget
+        :attr:`env.MAX_MEMORY`. The request is executed as configured,
+        serially, with streamed calculations, or serially with streamed
+        calculations, whichever fits first.
+        
+        :returns: Tuple of the serial and streamed calculation switches.
+        :rtype: (bool, bool)
+        :raises: :class:`ocgis.exc.MemoryLimitExceeded`
+        '''
+        strategies = [(env.SERIAL,env.STREAM_CALC),(True,env.STREAM_CALC),
+                      (env.SERIAL,True),(True,True)]
+        if env.MAX_MEMORY is None:
+            ret = strategies[0]
+        else:
+            if env.VERBOSE: print('estimating request size...')
+            estimate = RequestEstimate(self.ops)
+            limit = env.MAX_MEMORY*1024**2
+            memory = []
+            for serial,stream in strategies:
+                ## calculations that may not be streamed load all the values
+                stream_estimate = stream and estimate.can_stream()
+                memory.append(estimate.get_memory(serial=serial,stream=stream_estimate))
+                if memory[-1] <= limit:
+                    ret = (serial,stream)
+                    break
+            else:
+                raise(exc.MemoryLimitExceeded(min(memory)/1024.0**2,env.MAX_MEMORY))
+        return(ret)
@@ -1,21 +1,44 @@
 import itertools
+import traceback
 from multiprocessing import Pool
 from ocgis.calc.engine import OcgCalculationEngine
 from ocgis import env
 from ocgis.interface.shp import ShpDataset
 from ocgis.api.collection import RawCollection
-from ocgis.exc import EmptyData, ExtentError, MaskedDataError
+from ocgis.exc import EmptyData, ExtentError, MaskedDataError,\
+    SubsetGeometryError
 from ocgis.interface.projection import WGS84
 from ocgis.util.spatial.wrap import Wrapper
 from copy import deepcopy
+from shapely.geometry.point import Point
+
+
+## the subset operation referenced by worker processes in parallel execution.
+## this is set by the pool initializer and inherited by the forked workers.
+_so = None
 
 
 class SubsetOperation(object):
+    '''
+    :param ops: The operations to execute.
+    :type ops: :class:`ocgis.OcgOperations`
+    :param serial: If `False`, distribute the selection geometries over a
+     process pool.
+    :type serial: bool
+    :param nprocs: The number of worker processes used when not serial.
+    :type nprocs: int
+    :param validate: If `True`, validate the request datasets.
+    :type validate: bool
+    :param ordered: If `False`, parallel collections are returned as they
+     complete as opposed to selection geometry order.
+    :type ordered: bool
+    '''
     
-    def __init__(self,ops,serial=True,nprocs=1,validate=True):
+    def __init__(self,ops,serial=True,nprocs=1,validate=True,ordered=True):
         self.ops = ops
         self.serial = serial
         self.nprocs = nprocs
+        self.ordered = ordered
         
         if validate:
             if env.VERBOSE: print('validating request datasets...')
@@ -38,43 +61,118 @@ class SubsetOperation(object):
             if env.VERBOSE: print('getting snippet bounds...')
             for rd in self.ops.dataset:
                 rd.level_range = [1,1]
-                ods = rd.ds
-                ## load the first time slice if there is calculation or the 
-                ## calculation does not use a temporal group.
-                if self.cengine is None or (self.cengine is not None and self.cengine.grouping is None):
-                    ##TODO: improve slicing to not load all time values
-                    ods._load_slice.update({'T':slice(0,1)})
-                ## snippet for the computation. this currently requires loading
-                ## all the data for the time dimension into memory.
-                ##TODO: more efficiently pull dates for monthly grouping (for
-                ##example).
+                ## only a prefix of the time coordinate is read to find the
+                ## first time step or temporal group
+                if self.cengine is None:
+                    grouping = None
                 else:
-                    ods.temporal.set_grouping(self.cengine.grouping)
-                    tgdim = ods.temporal.group
-                    times = ods.temporal.value[tgdim.dgroups[0]]
-                    rd.time_range = [times.min(),times.max()]
+                    grouping = self.cengine.grouping
+                rd.ds.set_snippet(grouping=grouping,time_range=rd.time_range)
+                    
+        ## aggregated values of all selection geometries computed in a single
+        ## pass. these are computed when iteration starts.
+        self._zonal = {}
         
     def __iter__(self):
         ''':rtype: AbstractCollection'''
         
-        ## simple iterator for serial operations
-        if self.serial:
-            it = itertools.imap(get_collection,self._iter_proc_args_())
-        ## use a multiprocessing pool returning unordered geometries
-        ## for the parallel case
-        else:
-            raise(NotImplementedError)
-            pool = Pool(processes=self.nprocs)
-            it = pool.imap_unordered(get_collection,
-                                     self._iter_proc_args_())
-        ## the iterator return from the Pool requires calling its 'next'
-        ## method and catching the StopIteration exception
-        while True:
+        try:
+            ## neighboring selection geometries share a single read of the
+            ## data. aggregated values may be computed for all geometries in
+            ## that read.
+            if self.ops.slice is None and not self.ops.file_only and \
+               isinstance(self.ops.geom,ShpDataset) and len(self.ops.geom) > 1:
+                if env.ZONAL_AGGREGATE and self.ops.aggregate and not self.ops.calc_raw:
+                    self._get_zonal_aggregates_()
+                ## each worker process would read the whole shared window for
+                ## its geometries. reads are only shared when running serially.
+                if self.serial:
+                    self._plan_hyperslabs_()
+            
+            ## there is nothing to distribute with a single selection geometry
+            if self.serial or not isinstance(self.ops.geom,ShpDataset) or len(self.ops.geom) == 1:
+                it = itertools.imap(get_collection,self._iter_proc_args_())
+            ## use a multiprocessing pool for the parallel case. collections are
+            ## streamed back as they complete.
+            else:
+                it = self._iter_parallel_()
+            ## the iterator return from the Pool requires calling its 'next'
+            ## method and catching the StopIteration exception
+            while True:
+                try:
+                    yld = it.next()
+                    yield(yld)
+                except StopIteration:
+                    break
+        ## the shared reads and aggregates are held by the operation otherwise
+        finally:
+            self._release_hyperslabs_()
+            self._zonal = {}
+            
+    def _iter_parallel_(self):
+        ''':rtype: AbstractCollection'''
+        if env.VERBOSE: print('distributing geometries over {0} process(es)...'.format(self.nprocs))
+        pool = Pool(processes=self.nprocs,initializer=_init_worker_,
+                    initargs=(self,))
+        try:
+            ## unordered returns yield collections in order of completion
+            if self.ordered:
+                imap = pool.imap
+            else:
+                imap = pool.imap_unordered
+            geoms = (geom for _,geom in self._iter_proc_args_())
+            for ugid,coll,tb in imap(_get_collection_worker_,geoms):
+                ## the worker traceback is only present if the geometry failed
+                if tb is not None:
+                    raise(SubsetGeometryError(ugid,tb))
+                yield(coll)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        
+    def _get_zonal_aggregates_(self):
+        for rd in self.ops.dataset:
+            ods = rd.ds
+            geoms = list(self.ops.geom)
+            igeoms = [get_igeom(ods,deepcopy(geom)) for geom in geoms]
+            ## point selections are aggregated separately
+            if any([isinstance(igeom,Point) for igeom in igeoms]):
+                continue
+            uids = [geom.spatial.uid[0] for geom in geoms]
             try:
-                yld = it.next()
-                yield(yld)
-            except StopIteration:
-                break
+                aggregates = ods.get_zonal_aggregates(igeoms,uids,
+                 spatial_operation=self.ops.spatial_operation,
+                 temporal=rd.time_range,level=rd.level_range)
+            ## the dataset is not supported
+            except NotImplementedError:
+                continue
+            if env.VERBOSE: print('aggregated {0} geometries in a single pass: alias={1}'.format(len(geoms),rd.alias))
+            self._zonal[rd.alias] = dict(zip(uids,aggregates))
+        
+    def _plan_hyperslabs_(self):
+        for rd in self.ops.dataset:
+            ## aggregated datasets have been read already
+            if rd.alias in self._zonal:
+                continue
+            ods = rd.ds
+            grids = []
+            for geom in self.ops.geom:
+                igeom = get_igeom(ods,deepcopy(geom))
+                ## point selections do not have a footprint
+                if isinstance(igeom,Point):
+                    continue
+                try:
+                    grids.append(ods.spatial.grid.subset(polygon=igeom))
+                ## the geometry may be outside the spatial domain
+                except EmptyData:
+                    continue
+            if ods.plan_hyperslab(grids,temporal=rd.time_range,level=rd.level_range):
+                if env.VERBOSE: print('sharing data read for {0} geometries: alias={1}'.format(len(grids),rd.alias))
+        
+    def _release_hyperslabs_(self):
+        for rd in self.ops.dataset:
+            rd.ds._hyperslab = None
         
     def _iter_proc_args_(self):
         ''':rtype: tuple'''
@@ -91,6 +189,52 @@ class SubsetOperation(object):
         else:
             if env.VERBOSE: print('1 geometry to process.')
             yield(self,self.ops.geom)
+
+
+def _init_worker_(so):
+    global _so
+    _so = so
+    
+def _get_collection_worker_(geom):
+    '''
+    :type geom: ShpDataset
+    :returns: A tuple composed of the selection geometry's unique identifier,
+     the collection, and the formatted traceback if an exception occurred.
+    :rtype: (int, AbstractCollection, str)
+    '''
+    ugid = geom.spatial.uid[0]
+    try:
+        ret = (ugid,get_collection((_so,geom)),None)
+    ## exceptions are not guaranteed to pickle. return the traceback for the
+    ## parent process to raise.
+    except Exception:
+        ret = (ugid,None,traceback.format_exc())
+    return(ret)
+            
+def get_igeom(ods,copy_geom):
+    '''Prepare a copied selection geometry for the spatial subset of a dataset.
+    The copied geometry is modified in place.
+    
+    :type ods: AbstractDataset
+    :type copy_geom: None, GeometryDataset, ShpDataset
+    :rtype: None, :class:`shapely.geometry.base.BaseGeometry`
+    '''
+    ## if a geometry is passed and the target dataset is 360 longitude,
+    ## unwrap the passed geometry to match the spatial domain of the target
+    ## dataset.
+    if copy_geom is None:
+        igeom = None
+    else:
+        ## check projections adjusting projection the selection geometry
+        ## if necessary
+        if type(ods.spatial.projection) != type(copy_geom.spatial.projection):
+            copy_geom.project(ods.spatial.projection)
+        ## unwrap the data if it is geographic and 360
+        if type(ods.spatial.projection) == WGS84 and ods.spatial.is_360:
+            w = Wrapper(axis=ods.spatial.pm)
+            copy_geom.spatial.geom[0] = w.unwrap(deepcopy(copy_geom.spatial.geom[0]))
+        igeom = copy_geom.spatial.geom[0]
+    return(igeom)
             
 def get_collection((so,geom)):
     '''
@@ -119,29 +263,22 @@ def get_collection((so,geom)):
             ods = ods.__getitem__(so.ops.slice)
         ## other subsetting operations
         else:
-            ## if a geometry is passed and the target dataset is 360 longitude,
-            ## unwrap the passed geometry to match the spatial domain of the target
-            ## dataset.
-            if copy_geom is None:
-                igeom = None
-            else:
-                ## check projections adjusting projection the selection geometry
-                ## if necessary
-                if type(ods.spatial.projection) != type(copy_geom.spatial.projection):
-                    copy_geom.project(ods.spatial.projection)
-                ## unwrap the data if it is geographic and 360
-                if type(ods.spatial.projection) == WGS84 and ods.spatial.is_360:
-                    w = Wrapper(axis=ods.spatial.pm)
-                    copy_geom.spatial.geom[0] = w.unwrap(deepcopy(copy_geom.spatial.geom[0]))
-                igeom = copy_geom.spatial.geom[0]
+            igeom = get_igeom(ods,copy_geom)
             ## perform the data subset
             try:
-                ods = ods.get_subset(spatial_operation=so.ops.spatial_operation,
-                                     igeom=igeom,
-                                     temporal=request_dataset.time_range,
-                                     level=request_dataset.level_range)
+                ## aggregates computed for all the selection geometries
+                zonal = so._zonal.get(request_dataset.alias)
+                if zonal is not None:
+                    ods = zonal[copy_geom.spatial.uid[0]]
+                    if ods is None:
+                        raise(EmptyData)
+                else:
+                    ods = ods.get_subset(spatial_operation=so.ops.spatial_operation,
+                                         igeom=igeom,
+                                         temporal=request_dataset.time_range,
+                                         level=request_dataset.level_range)
                 ## aggregate the geometries and data if requested
-                if so.ops.aggregate:
+                if so.ops.aggregate and zonal is None:
                     ## the new geometry will have the same id as the passed
                     ## geometry. if it does not have one, simple give it a value
                     ## of 1 as it is the only geometry requested for subsetting.
@@ -161,8 +298,16 @@ def get_collection((so,geom)):
                        so.ops.output_format != 'nc' and \
                        so.ops.vector_wrap:
                         ods.spatial.vector.wrap()
-                ## check for all masked values
-                if not so.ops.file_only and ods.value.mask.all():
+                ## check for all masked values. streamed calculations do not
+                ## load the value and only the geometry mask is checked.
+                if so.ops.file_only:
+                    is_masked = False
+                elif so.cengine is not None and so.cengine._use_stream_(ods):
+                    vector_mask = ods.spatial.vector.mask
+                    is_masked = vector_mask is not None and vector_mask.all()
+                else:
+                    is_masked = ods.value.mask.all()
+                if is_masked:
                     if so.ops.snippet or so.ops.allow_empty:
                         if env.VERBOSE:
                             if so.ops.snippet:
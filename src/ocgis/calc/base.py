@@ -5,7 +5,10 @@ import groups
 import numpy as np
 import itertools
 import abc
+import warnings
 from ocgis.calc.groups import OcgFunctionGroup
+from ocgis.calc.reduction import get_reductions, get_sorted_groups
+from ocgis.interface.base import TemporalGroupIndex
 
 
 class OcgFunctionTree(object):
@@ -81,6 +84,9 @@ class OcgFunction(object):
     nargs = 0
     checked = False
     name = None
+    ## reductions passed to _reduce_ to calculate all temporal groups at once.
+    ## if None, each group is calculated separately by _calculate_.
+    reductions = None
     
     def __init__(self,values=None,groups=None,agg=False,weights=None,kwds={}):
         self.values = values
@@ -94,14 +100,45 @@ class OcgFunction(object):
         if self.name is None:
             self.name = self.text.lower()
     
-    def calculate(self):
+    def calculate(self,reduced=None,sorted_groups=None):
+        '''
+        :param reduced: Reductions of the values shared with other functions.
+         Must contain at least :attr:`reductions`. Only used if the function
+         calculates all temporal groups at once.
+        :type reduced: dict
+        :param sorted_groups: Sorted values of each temporal group shared with
+         other functions as returned by :func:`~ocgis.calc.reduction.get_sorted_groups`.
+         Only used if the function defines :meth:`_calculate_sorted_`.
+        :type sorted_groups: list
+        '''
         ## holds output from calculation
         fill = self._get_fill_(self.values)
-        ## iterate over temporal groups and levels
-        for idx,group in enumerate(self.groups):
-            value_slice = self.values[group,:,:,:]
-            calc = self._calculate_(value_slice,**self.kwds)
-            fill[idx] = calc
+        ## reduce all the groups at once if the function supports it
+        if self._use_reductions_():
+            if reduced is None:
+                values = self._prepare_(self.values,**self.kwds)
+                reduced = get_reductions(values,self.groups,self.reductions)
+            fill[:] = self._reduce_(reduced,**self.kwds)
+        ## order statistics are calculated from the sorted group values
+        elif self._uses_sorted_():
+            if sorted_groups is None:
+                sorted_groups = get_sorted_groups(self.values,self.groups)
+            for idx,(value,count) in enumerate(sorted_groups):
+                fill[idx] = self._calculate_sorted_(value,count,**self.kwds)
+        ## masked values are nan for functions with a kernel for float arrays
+        elif self._use_nan_():
+            with warnings.catch_warnings():
+                ## groups with all values missing return nan
+                warnings.simplefilter('ignore',RuntimeWarning)
+                for idx,group in enumerate(self.groups):
+                    fill[idx] = self._calculate_nan_(self.values[group,:,:,:],**self.kwds)
+            fill.mask = np.logical_or(fill.mask,np.isnan(fill.data))
+        else:
+            ## iterate over temporal groups and levels
+            for idx,group in enumerate(self.groups):
+                value_slice = self.values[group,:,:,:]
+                calc = self._calculate_(value_slice,**self.kwds)
+                fill[idx] = calc
         ## if data is calculated on raw values, but area-weighting is required
         ## aggregate the data using provided weights.
         ret = self.aggregate_spatial(fill)
@@ -124,6 +161,65 @@ class OcgFunction(object):
     def _calculate_(values,**kwds):
         raise(NotImplementedError)
     
+    @staticmethod
+    def _calculate_nan_(values,**kwds):
+        '''Calculate the function for a group of float values with `nan` for
+        masked values. Elements without a result are `nan`.'''
+        raise(NotImplementedError)
+    
+    @staticmethod
+    def _calculate_sorted_(sorted_value,count,**kwds):
+        '''Calculate the function for a group from its values sorted along the
+        time axis with missing values last.
+        
+        :param count: The number of values that are not missing.
+        :type count: :class:`numpy.ndarray`
+        '''
+        raise(NotImplementedError)
+    
+    @staticmethod
+    def _prepare_(values,**kwds):
+        '''Transform the values before the reductions are computed.'''
+        return(values)
+    
+    @staticmethod
+    def _reduce_(reduced,**kwds):
+        '''Calculate the function for all groups from the reductions.
+        
+        :param reduced: Masked arrays keyed by reduction name with shape
+         (groups,level,row,column).
+        :type reduced: dict
+        '''
+        raise(NotImplementedError)
+    
+    @classmethod
+    def _shares_reductions_(cls):
+        '''Functions reducing the untransformed values may share the reductions
+        with other functions.'''
+        return(cls.reductions is not None and cls._prepare_ is OcgFunction._prepare_)
+
+    @classmethod
+    def _has_nan_kernel_(cls):
+        '''`True` if the function is calculated by :meth:`_calculate_nan_` for
+        float values with `nan` for masked values.'''
+        return(cls._calculate_nan_ is not OcgFunction._calculate_nan_)
+    
+    @classmethod
+    def _uses_sorted_(cls):
+        '''`True` if the function is calculated by :meth:`_calculate_sorted_`.'''
+        return(cls._calculate_sorted_ is not OcgFunction._calculate_sorted_)
+    
+    def _use_nan_(self):
+        return(self._has_nan_kernel_() and not np.ma.isMaskedArray(self.values))
+    
+    def _use_reductions_(self):
+        ret = False
+        if self.reductions is not None and isinstance(self.groups,TemporalGroupIndex):
+            ## empty groups are not supported by the segmented reductions
+            if len(self.groups) > 0 and np.all(np.diff(self.groups.offsets) > 0):
+                ret = True
+        return(ret)
+    
     @staticmethod
     def _aggregate_spatial_(values,weights):
         try:
@@ -134,7 +230,10 @@ class OcgFunction(object):
     def _get_fill_(self,values):
         fill = np.empty((len(self.groups),values.shape[1],values.shape[2],values.shape[3]),dtype=self.dtype)
         mask = np.empty(fill.shape,dtype=bool)
-        mask[:] = values.mask[0,0,:]
+        if np.ma.isMaskedArray(values):
+            mask[:] = values.mask[0,0,:]
+        else:
+            mask[:] = np.isnan(values[0,0,:])
         fill = np.ma.array(fill,mask=mask)
         return(fill)
         
@@ -165,17 +264,16 @@ class OcgCvArgFunction(OcgArgFunction):
         super(OcgCvArgFunction,self).__init__(values=kwds,groups=groups,agg=agg,weights=weights,kwds=kwds)
     
     def calculate(self):
-        if self.groups is None:
-            fill = self._calculate_(**self.kwds)
+        ## masked values are nan for functions with a kernel for float arrays
+        if self._use_nan_():
+            with warnings.catch_warnings():
+                ## groups with all values missing return nan
+                warnings.simplefilter('ignore',RuntimeWarning)
+                fill = self._get_groups_(self._calculate_nan_,self._aggregate_temporal_nan_)
+            mask = np.logical_or(np.ma.getmaskarray(fill),np.isnan(np.ma.getdata(fill)))
+            fill = np.ma.array(fill,mask=mask)
         else:
-            arch = self.kwds[self.keys[0]]
-            fill = self._get_fill_(arch)
-            ## iterate over temporal groups and levels
-            for idx,group in enumerate(self.groups):
-                kwds = self._subset_kwds_(group,self.kwds)
-                calc = self._calculate_(**kwds)
-                calc = self.aggregate_temporal(calc)
-                fill[idx] = calc
+            fill = self._get_groups_(self._calculate_,self.aggregate_temporal)
         ret = self.aggregate_spatial(fill)
         return(ret)
     
@@ -186,6 +284,27 @@ class OcgCvArgFunction(OcgArgFunction):
     def _aggregate_temporal_(values):
         return(np.ma.mean(values,axis=0))
     
+    @staticmethod
+    def _aggregate_temporal_nan_(values):
+        return(np.nanmean(values,axis=0))
+    
+    def _get_groups_(self,calculate,aggregate_temporal):
+        if self.groups is None:
+            ret = calculate(**self.kwds)
+        else:
+            arch = self.kwds[self.keys[0]]
+            ret = self._get_fill_(arch)
+            ## iterate over temporal groups and levels
+            for idx,group in enumerate(self.groups):
+                kwds = self._subset_kwds_(group,self.kwds)
+                calc = calculate(**kwds)
+                calc = aggregate_temporal(calc)
+                ret[idx] = calc
+        return(ret)
+    
+    def _use_nan_(self):
+        return(self._has_nan_kernel_() and not np.ma.isMaskedArray(self.kwds[self.keys[0]]))
+    
     def _subset_kwds_(self,group,kwds):
         ret = {}
         for key,value in kwds.iteritems():
@@ -5,6 +5,11 @@ from collections import OrderedDict
 import numpy as np
 from ocgis import constants, env
 from warnings import warn
+import threading
+from multiprocessing.pool import ThreadPool
+from ocgis.calc.reduction import get_reductions, ReductionAccumulator,\
+    get_sorted_groups
+from ocgis.util.helpers import get_nan_filled
 
 
 class OcgCalculationEngine(object):
@@ -46,6 +51,123 @@ class OcgCalculationEngine(object):
             weights = ds.spatial.vector.weights
         return(value,weights)
     
+    def _get_streamed_(self,ds,fused):
+        '''Calculate the univariate functions from blocks of time steps read by
+        :meth:`NcDataset.iter_value_blocks`.
+        
+        :param fused: Names of the reductions shared by the functions.
+        :returns: Calculated values keyed by function name or `None` if the
+         temporal groups are not supported.
+        :rtype: dict
+        '''
+        groups = ds.temporal.group.dgroups
+        ## the shared reductions are accumulated from the values. functions
+        ## transforming the values accumulate their own reductions.
+        accumulators = {}
+        for f in self.funcs:
+            if f['ref'] == SampleSize:
+                continue
+            ref = f['ref'](groups=groups,kwds=f['kwds'])
+            if not ref._use_reductions_():
+                return(None)
+            if ref._shares_reductions_():
+                if None not in accumulators:
+                    accumulators[None] = ReductionAccumulator(groups,fused)
+            else:
+                accumulators[f['name']] = ReductionAccumulator(groups,f['ref'].reductions)
+        funcs = dict([(f['name'],f) for f in self.funcs])
+        ## the first time step provides the mask of the calculated values
+        first = None
+        for block in ds.iter_value_blocks():
+            if first is None:
+                first = block[0:1].copy()
+            for key,accumulator in accumulators.iteritems():
+                if key is None:
+                    accumulator.update(block)
+                else:
+                    f = funcs[key]
+                    accumulator.update(f['ref']._prepare_(block,**f['kwds']))
+        
+        ret = {}
+        for f in self.funcs:
+            ref = f['ref'](values=first,groups=groups,kwds=f['kwds'])
+            if f['ref'] == SampleSize:
+                calc = ref._get_fill_(first)
+                calc.data[:] = np.diff(groups.offsets).reshape(-1,1,1,1)
+            else:
+                key = None if ref._shares_reductions_() else f['name']
+                calc = ref.calculate(reduced=accumulators[key].get_reductions())
+            ret[f['name']] = calc
+        return(ret)
+    
+    def _get_univariate_(self,f,alias,var,fused,shared):
+        '''Calculate a univariate function for a variable.
+        
+        :param fused: Names of the reductions shared by the functions.
+        :param shared: Values shared by the calculations.
+        :type shared: :class:`_SharedValues`
+        :returns: The calculated values or `None` if the calculation is
+         skipped.
+        '''
+        value,weights = self._get_value_weights_(var)
+        ## make the function instance
+        try:
+            ref = f['ref'](values=value,agg=self.agg,
+                           groups=var.temporal.group.dgroups,
+                           kwds=f['kwds'],weights=weights)
+        except AttributeError:
+            ## if there is no grouping, there is no need to calculate
+            ## sample size.
+            if self.grouping is None and f['ref'] == SampleSize:
+                return(None)
+            elif self.grouping is None:
+                raise(NotImplementedError('Univariate calculations must have a temporal grouping.'))
+            else:
+                raise
+        ## calculate the values
+        if ref._shares_reductions_() and ref._use_reductions_():
+            reduced = shared.get(('reduced',alias),lambda: get_reductions(value,ref.groups,fused))
+            calc = ref.calculate(reduced=reduced)
+        ## the groups are sorted once for order statistics
+        elif ref._uses_sorted_():
+            sorted_groups = shared.get(('sorted',alias),lambda: get_sorted_groups(value,ref.groups))
+            calc = ref.calculate(sorted_groups=sorted_groups)
+        ## functions calculating each group separately use float values with
+        ## nan for masked values. see env.NAN_CALC.
+        elif env.NAN_CALC and ref._has_nan_kernel_() and not ref._use_reductions_():
+            ref.values = shared.get(('nan',alias),lambda: get_nan_filled(value))
+            calc = ref.calculate()
+        else:
+            calc = ref.calculate()
+        return(calc)
+    
+    def _is_multivariate_(self,f):
+        return(issubclass(f['ref'],OcgCvArgFunction) or (self.has_multi and f['ref'] == SampleSize))
+    
+    def _use_stream_(self,ds):
+        '''
+        :returns: `True` if the calculations for the dataset are computed from
+         blocks of time steps. See :attr:`env.STREAM_CALC`.
+        :rtype: bool
+        '''
+        ret = False
+        if env.STREAM_CALC and self.can_stream():
+            ## the value must not be loaded already
+            if hasattr(ds,'iter_value_blocks') and ds._value is None:
+                ret = True
+        return(ret)
+    
+    def can_stream(self):
+        '''
+        :returns: `True` if the functions may be computed from blocks of time
+         steps when :attr:`env.STREAM_CALC` is `True`.
+        :rtype: bool
+        '''
+        ret = False
+        if not self.agg and not self.has_multi and self.grouping is not None:
+            ret = all([f['ref'] == SampleSize or f['ref'].reductions is not None for f in self.funcs])
+        return(ret)
+    
     def execute(self,coll,file_only=False):
         ## switch collection type based on the presence of a multivariate
         ## calculation
@@ -60,10 +182,53 @@ class OcgCalculationEngine(object):
             for ds in coll.variables.itervalues():
                 ds.temporal.set_grouping(self.grouping)
 
-        ## iterate over functions
+        ## reductions of each variable shared by the univariate functions are
+        ## computed once. all values are traversed in a single pass.
+        fused = set()
         for f in self.funcs:
+            if f['ref']._shares_reductions_():
+                fused.update(f['ref'].reductions)
+        fused = tuple(sorted(fused))
+        
+        ## calculate from blocks of time steps if the data is not loaded
+        streamed = {}
+        if not file_only:
+            for alias,var in coll.variables.iteritems():
+                if self._use_stream_(var):
+                    calcs = self._get_streamed_(var,fused)
+                    if calcs is not None:
+                        streamed[alias] = calcs
+        
+        ## univariate calculations are independent for each function and
+        ## variable. they may be computed concurrently.
+        tasks = []
+        if not file_only:
+            for fidx,f in enumerate(self.funcs):
+                if not self._is_multivariate_(f):
+                    for alias,var in coll.variables.iteritems():
+                        if alias not in streamed:
+                            tasks.append((fidx,alias,var))
+        shared = _SharedValues()
+        def _calculate_((fidx,alias,var)):
+            return(self._get_univariate_(self.funcs[fidx],alias,var,fused,shared))
+        if env.THREAD_CALC and env.CORES > 1 and len(tasks) > 1:
+            ## load the values before they are shared by the threads
+            for _,_,var in tasks:
+                self._get_value_weights_(var)
+            pool = ThreadPool(processes=env.CORES)
+            try:
+                results = pool.map(_calculate_,tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(_calculate_,tasks)
+        results = dict(zip([task[0:2] for task in tasks],results))
+
+        ## iterate over functions
+        for fidx,f in enumerate(self.funcs):
             ## change behavior for multivariate functions
-            if issubclass(f['ref'],OcgCvArgFunction) or (self.has_multi and f['ref'] == SampleSize):
+            if self._is_multivariate_(f):
                 ## do not calculated sample size for multivariate calculations
                 ## yet
                 if f['ref'] == SampleSize:
@@ -80,6 +245,8 @@ class OcgCalculationEngine(object):
                     ## pull associated data
                     dref = coll.variables[backref]
                     value,weights = self._get_value_weights_(dref)
+                    if env.NAN_CALC and f['ref']._has_nan_kernel_():
+                        value = shared.get(('nan',backref),lambda: get_nan_filled(value))
                     ## get the calculation groups and weights.
                     if ii == 0:
                         if self.grouping is None:
@@ -94,30 +261,44 @@ class OcgCalculationEngine(object):
                 ## store calculation value
                 ret.calc[f['name']] = calc
             else:
-                ## perform calculation on each variable
+                ## store the calculation for each variable in order
                 for alias,var in coll.variables.iteritems():
                     if alias not in ret.calc:
                         ret.calc[alias] = OrderedDict()
                     if file_only:
                         calc = np.ma.array(np.empty(0,dtype=f['ref'].dtype),fill_value=constants.fill_value)
+                    elif alias in streamed:
+                        calc = streamed[alias][f['name']]
                     else:
-                        value,weights = self._get_value_weights_(var)
-                        ## make the function instance
-                        try:
-                            ref = f['ref'](values=value,agg=self.agg,
-                                           groups=var.temporal.group.dgroups,
-                                           kwds=f['kwds'],weights=weights)
-                        except AttributeError:
-                            ## if there is no grouping, there is no need to calculate
-                            ## sample size.
-                            if self.grouping is None and f['ref'] == SampleSize:
-                                break
-                            elif self.grouping is None:
-                                raise(NotImplementedError('Univariate calculations must have a temporal grouping.'))
-                            else:
-                                raise
-                        ## calculate the values
-                        calc = ref.calculate()
+                        calc = results[fidx,alias]
+                        ## sample size is not calculated without a grouping
+                        if calc is None:
+                            break
                     ## store the values
                     ret.calc[alias][f['name']] = calc
         return(ret)
+
+
+class _SharedValues(object):
+    '''Values shared by the calculations. Each value is created once even if
+    requested by concurrent calculations.'''
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        
+    def get(self,key,create):
+        '''
+        :param key: The value key.
+        :param create: Called without arguments to create the value if it does
+         not exist.
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = [threading.Lock(),None]
+                self._entries[key] = entry
+        with entry[0]:
+            if entry[1] is None:
+                entry[1] = create()
+        return(entry[1])
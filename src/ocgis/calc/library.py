@@ -1,7 +1,7 @@
 import groups
 from base import OcgFunction, OcgCvArgFunction, OcgArgFunction
 import numpy as np
-from ocgis.util.helpers import iter_array
+from ocgis.calc.reduction import get_sorted_groups, get_percentile
 
 
 class FrequencyPercentile(OcgArgFunction):
@@ -13,9 +13,13 @@ class FrequencyPercentile(OcgArgFunction):
     
     @staticmethod
     def _calculate_(values,perc=None):
+        (sorted_value,count), = get_sorted_groups(values,[slice(None)])
+        return(FrequencyPercentile._calculate_sorted_(sorted_value,count,perc=perc))
+    
+    @staticmethod
+    def _calculate_sorted_(sorted_value,count,perc=None):
         perc = int(perc)
-        ret = np.percentile(values,perc,axis=0)
-        return(ret)
+        return(get_percentile(sorted_value,count,perc))
 
 
 class SampleSize(OcgFunction):
@@ -50,46 +54,86 @@ class Median(OcgFunction):
     def _calculate_(values):
         return(np.ma.median(values,axis=0))
     
+    @staticmethod
+    def _calculate_sorted_(sorted_value,count):
+        return(get_percentile(sorted_value,count,50))
+    
     
 class Mean(OcgFunction):
     description = 'Mean value for the series.'
     Group = groups.BasicStatistics
     dtype = float
+    reductions = ('sum','count')
     
     @staticmethod
     def _calculate_(values):
         return(np.ma.mean(values,axis=0))
     
+    @staticmethod
+    def _calculate_nan_(values):
+        return(np.nanmean(values,axis=0))
+    
+    @staticmethod
+    def _reduce_(reduced):
+        return(reduced['sum']/reduced['count'].astype(float))
+    
     
 class Max(OcgFunction):
     description = 'Max value for the series.'
     Group = groups.BasicStatistics
     dtype = float
+    reductions = ('max',)
     
     @staticmethod
     def _calculate_(values):
         return(np.ma.max(values,axis=0))
     
+    @staticmethod
+    def _calculate_nan_(values):
+        return(np.nanmax(values,axis=0))
+    
+    @staticmethod
+    def _reduce_(reduced):
+        return(reduced['max'])
+    
     
 class Min(OcgFunction):
     description = 'Min value for the series.'
     Group = groups.BasicStatistics
     dtype = float
+    reductions = ('min',)
     
     @staticmethod
     def _calculate_(values):
         return(np.ma.min(values,axis=0))
     
+    @staticmethod
+    def _calculate_nan_(values):
+        return(np.nanmin(values,axis=0))
+    
+    @staticmethod
+    def _reduce_(reduced):
+        return(reduced['min'])
+    
     
 class StandardDeviation(OcgFunction):
     description = 'Standard deviation for the series.'
     Group = groups.BasicStatistics
     dtype = float
     name = 'std'
+    reductions = ('ssd','count')
     
     @staticmethod
     def _calculate_(values):
         return(np.ma.std(values,axis=0))
+    
+    @staticmethod
+    def _calculate_nan_(values):
+        return(np.nanstd(values,axis=0))
+    
+    @staticmethod
+    def _reduce_(reduced):
+        return(np.ma.sqrt(reduced['ssd']/reduced['count'].astype(float)))
 
 
 class MaxConsecutive(OcgArgFunction):
@@ -102,10 +146,19 @@ class MaxConsecutive(OcgArgFunction):
     
     @staticmethod
     def _calculate_(values,threshold=None,operation=None):
-        ## time index reference
-        ref = np.arange(0,values.shape[0])
-        ## storage array for counts
-        store = np.empty(list(values.shape)[1:])
+        arr = MaxConsecutive._compare_(values,threshold,operation)
+        ## masked time steps end a sequence
+        arr = np.ma.filled(arr,False)
+        return(MaxConsecutive._get_max_consecutive_(arr))
+    
+    @staticmethod
+    def _calculate_nan_(values,threshold=None,operation=None):
+        ## comparisons with nan are false and end a sequence
+        arr = MaxConsecutive._compare_(values,threshold,operation)
+        return(MaxConsecutive._get_max_consecutive_(arr))
+    
+    @staticmethod
+    def _compare_(values,threshold,operation):
         ## perform requested logical operation
         if operation == 'gt':
             arr = values > threshold
@@ -115,31 +168,16 @@ class MaxConsecutive(OcgArgFunction):
             arr = values >= threshold
         elif operation == 'lte':
             arr = values <= threshold
-
-        ## find longest sequence for each geometry across time dimension
-        for xidx,yidx in iter_array(values[0,:]):
-            vec = arr[:,xidx,yidx]
-#            ## collapse data if no axis provided
-#            if axis is None:
-#                vec = vec.reshape(-1)
-            ## check first if there is a longer series than 1
-            if np.any(np.diff(ref[vec]) == 1):
-                split_idx = ref[np.diff(vec)] + 1
-                splits = np.array_split(vec,split_idx)
-                sums = [a.sum() for a in splits if np.all(a)]
-                fill = np.max(sums)
-            ## case of only a singular occurrence
-            elif np.any(vec):
-                fill = 1
-            ## case for no occurrence
-            else:
-                fill = 0
-            store[xidx,yidx] = fill
-        
-#        ## summarize across geometries if axis is collapsed
-#        if axis is None:
-#            store = np.max(store)
-            
+        return(arr)
+    
+    @staticmethod
+    def _get_max_consecutive_(arr):
+        ## the running count of true values is reset to zero at each false
+        ## value. the reset level is the count at the last false value.
+        count = np.cumsum(arr,axis=0)
+        reset = np.maximum.accumulate(np.where(arr,0,count),axis=0)
+        ## find longest sequence for each element across the time dimension
+        store = (count-reset).max(axis=0)
         return(store)
         
 
@@ -148,21 +186,37 @@ class Between(OcgArgFunction):
     description = 'Count of values falling within the limits lower and upper (inclusive).'
     Group = groups.Thresholds
     dtype = int
+    reductions = ('sum',)
     
     @staticmethod
     def _calculate_(values,lower=None,upper=None):
-        idx = (values >= lower)*(values <= upper)
+        idx = Between._prepare_(values,lower=lower,upper=upper)
         return(np.ma.sum(idx,axis=0))
     
+    @staticmethod
+    def _prepare_(values,lower=None,upper=None):
+        return((values >= lower)*(values <= upper))
+    
+    @staticmethod
+    def _reduce_(reduced,lower=None,upper=None):
+        return(reduced['sum'])
+    
     
 class Threshold(OcgArgFunction):
     nargs = 2
     description = 'Count of values where the logical operation is True.'
     Group = groups.Thresholds
     dtype = int
+    reductions = ('sum',)
     
     @staticmethod
     def _calculate_(values,threshold=None,operation=None):
+        idx = Threshold._prepare_(values,threshold=threshold,operation=operation)
+        ret = np.ma.sum(idx,axis=0)
+        return(ret)
+    
+    @staticmethod
+    def _prepare_(values,threshold=None,operation=None):
         threshold = float(threshold)
         
         ## perform requested logical operation
@@ -176,9 +230,11 @@ class Threshold(OcgArgFunction):
             idx = values <= threshold
         else:
             raise(NotImplementedError('The operation "{0}" was not recognized.'.format(operation)))
-        
-        ret = np.ma.sum(idx,axis=0)
-        return(ret)
+        return(idx)
+    
+    @staticmethod
+    def _reduce_(reduced,threshold=None,operation=None):
+        return(reduced['sum'])
         
     @staticmethod
     def _aggregate_spatial_(values,weights):
@@ -214,6 +270,27 @@ class HeatIndex(OcgCvArgFunction):
         else:
             raise(NotImplementedError)
         
+        idx = tas < 80
+        tas.mask = np.logical_or(idx,tas.mask)
+        idx = rhs < 40
+        rhs.mask = np.logical_or(idx,rhs.mask)
+        
+        return(HeatIndex._get_heat_index_(tas,rhs))
+    
+    @staticmethod
+    def _calculate_nan_(tas=None,rhs=None,units=None):
+        if units == 'k':
+            tas = 1.8*(tas - 273.15) + 32
+        else:
+            raise(NotImplementedError)
+        
+        tas = np.where(tas < 80,np.nan,tas)
+        rhs = np.where(rhs < 40,np.nan,rhs)
+        
+        return(HeatIndex._get_heat_index_(tas,rhs))
+    
+    @staticmethod
+    def _get_heat_index_(tas,rhs):
         c1 = -42.379
         c2 = 2.04901523
         c3 = 10.14333127
@@ -224,11 +301,6 @@ class HeatIndex(OcgCvArgFunction):
         c8 = 8.5282e-4
         c9 = -1.99e-6
         
-        idx = tas < 80
-        tas.mask = np.logical_or(idx,tas.mask)
-        idx = rhs < 40
-        rhs.mask = np.logical_or(idx,rhs.mask)
-        
         tas_sq = np.square(tas)
         rhs_sq = np.square(rhs)
         
@@ -0,0 +1,220 @@
+import numpy as np
+from ocgis.interface.base import TemporalGroupIndex
+from ocgis.util.helpers import get_nan_filled
+
+
+## reductions available to functions evaluating all temporal groups at once
+REDUCTIONS = ('count','sum','min','max','ssd')
+
+def get_reductions(values,groups,reductions):
+    '''Reduce each temporal group along the time axis with segmented array
+    operations as opposed to looping over the groups.
+
+    :param values: Array with the time steps on the first axis.
+    :type values: :class:`numpy.ma.MaskedArray`
+    :param groups: The temporal groups. All groups must have time steps.
+    :type groups: :class:`ocgis.interface.base.TemporalGroupIndex`
+    :param reductions: Names of the reductions to compute. Members of
+     :attr:`REDUCTIONS`: `count` is the number of unmasked values, `ssd` is the
+     sum of squared deviations from the group mean.
+    :type reductions: sequence of str
+    :returns: Reduced arrays keyed by reduction name with the groups on the
+     first axis. Elements without unmasked values are masked.
+    :rtype: dict
+    '''
+    for name in reductions:
+        if name not in REDUCTIONS:
+            raise(NotImplementedError('reduction not recognized: {0}'.format(name)))
+    ## sort the time steps by group unless they are sorted already
+    order = groups.order
+    if np.all(order == np.arange(order.shape[0])):
+        data = np.ma.getdata(values)
+        valid = np.logical_not(np.ma.getmaskarray(values))
+    else:
+        data = np.ma.getdata(values).take(order,axis=0)
+        valid = np.logical_not(np.ma.getmaskarray(values).take(order,axis=0))
+    if data.dtype == bool:
+        data = data.astype(int)
+    starts = groups.offsets[:-1]
+
+    count = np.add.reduceat(valid,starts,axis=0,dtype=int)
+    ret = {'count':count}
+    if 'sum' in reductions or 'ssd' in reductions:
+        ret['sum'] = np.add.reduceat(np.where(valid,data,0),starts,axis=0)
+    if 'ssd' in reductions:
+        mean = ret['sum']/np.maximum(count,1).astype(float)
+        dev = np.where(valid,data-np.repeat(mean,np.diff(groups.offsets),axis=0),0.0)
+        ret['ssd'] = np.add.reduceat(dev**2,starts,axis=0)
+    for name,ufunc in [('min',np.minimum),('max',np.maximum)]:
+        if name in reductions:
+            ## masked values are replaced with the identity of the reduction
+            identity = _get_identity_(name,data.dtype)
+            ret[name] = ufunc.reduceat(np.where(valid,data,identity),starts,axis=0)
+
+    mask = count == 0
+    for name in ret.keys():
+        ret[name] = np.ma.array(ret[name],mask=mask.copy())
+    return(ret)
+
+def get_sorted_groups(values,groups):
+    '''Sort the values of each temporal group along the time axis. Masked
+    values are replaced by `nan` and sorted last.
+
+    :param values: Array with the time steps on the first axis.
+    :type values: :class:`numpy.ma.MaskedArray`
+    :param groups: Time step selections for the temporal groups.
+    :type groups: sequence
+    :returns: The sorted values and the number of unmasked values for each
+     group.
+    :rtype: list of (:class:`numpy.ndarray`, :class:`numpy.ndarray`)
+    '''
+    ret = []
+    for group in groups:
+        value = values[group]
+        if np.ma.isMaskedArray(value):
+            value = get_nan_filled(value)
+        elif value.dtype.kind != 'f':
+            value = value.astype(float)
+        else:
+            value = value.copy()
+        value.sort(axis=0)
+        ret.append((value,np.logical_not(np.isnan(value)).sum(axis=0)))
+    return(ret)
+
+def get_percentile(sorted_value,count,perc):
+    '''Percentile of sorted values with linear interpolation between the
+    closest ranks as for :func:`numpy.percentile`.
+
+    :param sorted_value: Values sorted along the first axis with missing values
+     last as returned by :func:`get_sorted_groups`.
+    :type sorted_value: :class:`numpy.ndarray`
+    :param count: The number of values that are not missing.
+    :type count: :class:`numpy.ndarray`
+    :param float perc: The percentile between 0 and 100.
+    :returns: Elements without values are masked.
+    :rtype: :class:`numpy.ma.MaskedArray`
+    '''
+    rank = perc/100.0*(np.maximum(count,1)-1)
+    lower = np.floor(rank).astype(int)
+    upper = np.minimum(lower+1,np.maximum(count,1)-1)
+    weight = rank-lower
+    below = np.take_along_axis(sorted_value,lower[np.newaxis],axis=0)[0]
+    above = np.take_along_axis(sorted_value,upper[np.newaxis],axis=0)[0]
+    ret = below*(1-weight)+above*weight
+    mask = count == 0
+    ret[mask] = 0
+    return(np.ma.array(ret,mask=mask))
+
+def _get_identity_(name,dtype):
+    if name in ('min','max'):
+        if dtype.kind == 'f':
+            ret = np.inf if name == 'min' else -np.inf
+        else:
+            info = np.iinfo(dtype)
+            ret = info.max if name == 'min' else info.min
+    else:
+        ret = 0
+    return(ret)
+
+
+class ReductionAccumulator(object):
+    '''Accumulate the reductions of temporal groups over consecutive blocks of
+    time steps. Partial reductions of a block are merged with the pairwise
+    update for the mean and the sum of squared deviations. A group is finalized
+    once its last time step is added so only the reductions of groups spanning
+    the current block are held in memory.
+
+    :param groups: The temporal groups of all time steps.
+    :type groups: :class:`ocgis.interface.base.TemporalGroupIndex`
+    :param reductions: Names of the reductions to compute. See
+     :func:`get_reductions`.
+    :type reductions: sequence of str
+    '''
+
+    def __init__(self,groups,reductions):
+        for name in reductions:
+            if name not in REDUCTIONS:
+                raise(NotImplementedError('reduction not recognized: {0}'.format(name)))
+        self.groups = groups
+        self.reductions = tuple(reductions)
+        ## the sum is required to merge the squared deviations
+        self._names = set(self.reductions+('count',))
+        if 'ssd' in self._names:
+            self._names.add('sum')
+        ## the last time step of each group. empty groups are never active.
+        self._last = np.where(np.diff(groups.offsets) > 0,
+                              groups.order[np.maximum(groups.offsets[1:]-1,0)],-1)
+        self._active = {}
+        self._reduced = None
+        self._stop = 0
+
+    @property
+    def is_complete(self):
+        '''`True` if all time steps are added.'''
+        return(self._stop == self.groups.group_ids.shape[0])
+
+    def update(self,block):
+        '''Add the next block of time steps.
+
+        :param block: Array with the time steps on the first axis.
+        :type block: :class:`numpy.ma.MaskedArray`
+        :returns: Indices of the groups finalized by the block.
+        :rtype: :class:`numpy.ndarray`
+        '''
+        start,stop = self._stop,self._stop+block.shape[0]
+        if stop > self.groups.group_ids.shape[0]:
+            raise(ValueError('more time steps added than there are in the groups'))
+        gids,inverse = np.unique(self.groups.group_ids[start:stop],return_inverse=True)
+        partial = get_reductions(block,TemporalGroupIndex(inverse,ngroups=gids.shape[0]),self._names)
+        ## values of empty elements are the identities of the reductions
+        partial = dict([(name,np.ma.getdata(value)) for name,value in partial.iteritems()])
+        if self._reduced is None:
+            shape = (len(self.groups),)+block.shape[1:]
+            self._reduced = {}
+            for name,value in partial.iteritems():
+                self._reduced[name] = np.empty(shape,dtype=value.dtype)
+                self._reduced[name][:] = _get_identity_(name,value.dtype)
+
+        finalized = []
+        for idx,gid in enumerate(gids):
+            current = dict([(name,value[idx]) for name,value in partial.iteritems()])
+            previous = self._active.pop(gid,None)
+            if previous is not None:
+                current = self._merge_(previous,current)
+            if self._last[gid] < stop:
+                for name,value in current.iteritems():
+                    self._reduced[name][gid] = value
+                finalized.append(gid)
+            else:
+                self._active[gid] = current
+        self._stop = stop
+        return(np.array(finalized,dtype=int))
+
+    def get_reductions(self):
+        '''
+        :returns: Reduced arrays keyed by reduction name as returned by
+         :func:`get_reductions`.
+        :rtype: dict
+        '''
+        if not self.is_complete or self._reduced is None:
+            raise(ValueError('reductions are available once all time steps are added'))
+        mask = self._reduced['count'] == 0
+        ret = {}
+        for name in self._names:
+            ret[name] = np.ma.array(self._reduced[name],mask=mask.copy())
+        return(ret)
+
+    @staticmethod
+    def _merge_(a,b):
+        ret = {'count':a['count']+b['count']}
+        if 'sum' in a:
+            ret['sum'] = a['sum']+b['sum']
+        if 'ssd' in a:
+            na,nb = a['count'].astype(float),b['count'].astype(float)
+            delta = b['sum']/np.maximum(nb,1)-a['sum']/np.maximum(na,1)
+            ret['ssd'] = a['ssd']+b['ssd']+delta**2*na*nb/np.maximum(na+nb,1)
+        if 'min' in a:
+            ret['min'] = np.minimum(a['min'],b['min'])
+        if 'max' in a:
+            ret['max'] = np.maximum(a['max'],b['max'])
+        return(ret)
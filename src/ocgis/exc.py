@@ -81,4 +81,37 @@ class EmptyDataNotAllowed(SubsetException):
     
 class EmptyData(SubsetException):
     def __str__(self):
-        return('Empty data returned.')
\ No newline at end of file
+        return('Empty data returned.')
+    
+    
+class SubsetGeometryError(SubsetException):
+    """Raised when a subset fails for a selection geometry during a parallel
+    execution.
+    
+    :param ugid: The unique identifier of the failed selection geometry.
+    :type ugid: int
+    :param msg: The formatted traceback from the worker process.
+    :type msg: str
+    """
+    
+    def __init__(self,ugid,msg):
+        self.ugid = ugid
+        self.msg = msg
+        
+    def __str__(self):
+        return('Subset failed for selection geometry with UGID={0}:\n{1}'.format(self.ugid,self.msg))
+        
+        
+class MemoryLimitExceeded(OcgException):
+    """Raised when the estimated memory of a request exceeds :attr:`env.MAX_MEMORY`.
+    
+    :param float estimate: The estimated memory in megabytes.
+    :param float limit: The memory budget in megabytes.
+    """
+    
+    def __init__(self,estimate,limit):
+        self.estimate = estimate
+        self.limit = limit
+        
+    def __str__(self):
+        return('Estimated memory of {0:.1f} MB exceeds the limit of {1:.1f} MB.'.format(self.estimate,self.limit))
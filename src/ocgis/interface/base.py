@@ -1,9 +1,8 @@
 from ocgis import env
 from abc import ABCMeta, abstractmethod, abstractproperty
 import numpy as np
-import itertools
-from collections import deque
 from ocgis.exc import EmptyData
+from ocgis.util.helpers import get_date_parts
 
 
 class AbstractDataset(object):
@@ -238,70 +237,152 @@ class AbstractTemporalDimension(AbstractVectorDimension,AbstractInterfaceDimensi
     @abstractproperty
     def _dtemporal_group_dimension(self): AbstractTemporalGroupDimension
     
+    def get_date_parts(self):
+        '''
+        :returns: Array with shape (n,7) and columns `year, month, day, hour,
+         minute, second, microsecond`.
+        :rtype: :class:`numpy.ndarray`
+        '''
+        return(get_date_parts(self.value))
+    
+    def get_datetime64(self):
+        '''
+        :returns: The value and bounds as :class:`numpy.datetime64` arrays. The
+         bounds are `None` if there are no bounds.
+        :rtype: (:class:`numpy.ndarray`, :class:`numpy.ndarray`)
+        :raises: TypeError, ValueError
+        '''
+        value = self.value.astype('datetime64[us]')
+        bounds = None if self.bounds is None else self.bounds.astype('datetime64[us]')
+        return(value,bounds)
+    
     def set_grouping(self,grouping):
         date_parts = ('year','month','day','hour','minute','second','microsecond')
-        group_map = dict(zip(range(0,7),date_parts,))
-        group_map_rev = dict(zip(date_parts,range(0,7),))
         
-        value = np.empty((self.value.shape[0],3),dtype=object)
-        if self.bounds is None:
-            value[:,:] = self.value.reshape(-1,1)
-        else:
-            value[:,0] = self.bounds[:,0]
-            value[:,1] = self.value
-            value[:,2] = self.bounds[:,1]
+        ## group bounds are computed from numpy datetimes if possible
+        try:
+            value,bounds = self.get_datetime64()
+        ## datetime objects from non-standard calendars do not convert
+        except (TypeError,ValueError):
+            value,bounds = self.value,self.bounds
+        if bounds is None:
+            bounds = np.hstack((value.reshape(-1,1),value.reshape(-1,1)))
         
-        def _get_attrs_(dt):
-            return([dt.year,dt.month,dt.day,dt.hour,dt.minute,dt.second,dt.microsecond])
-        parts = np.empty((len(self.value),len(date_parts)),dtype=int)
-        for row in range(parts.shape[0]):
-            parts[row,:] = _get_attrs_(value[row,1])
+        ## integer parts of the grouped dates
+        idx_cmp = [idx for idx,part in enumerate(date_parts) if part in grouping]
+        parts = self.get_date_parts()[:,idx_cmp]
         
-        unique = deque()
+        ## combine the date parts into a single integer key. the keys sort in
+        ## the order of the date parts.
+        key = np.zeros(parts.shape[0],dtype=np.int64)
         for idx in range(parts.shape[1]):
-            if group_map[idx] in grouping:
-                fill = np.unique(parts[:,idx])
-            else:
-#                fill = np.array([0])
-                fill = [None]
-            unique.append(fill)
-
-        select = deque()
-        idx2_seq = range(len(date_parts))
-        for idx in itertools.product(*[range(len(u)) for u in unique]):
-            select.append([unique[idx2][idx[idx2]] for idx2 in idx2_seq])
-        select = np.array(select)
-        dgroups = deque()
-        idx_cmp = [group_map_rev[group] for group in grouping]
-        keep_select = []
-        for idx in range(select.shape[0]):
-            match = select[idx,idx_cmp] == parts[:,idx_cmp]
-            dgrp = match.all(axis=1)
-            if dgrp.any():
-                keep_select.append(idx)
-                dgroups.append(dgrp)
-        select = select[keep_select,:]
-        assert(len(dgroups) == select.shape[0])
+            col = parts[:,idx]-parts[:,idx].min()
+            key = key*(col.max()+1) + col
+        unique,first,group_ids = np.unique(key,return_index=True,return_inverse=True)
         
-        new_value = np.empty((len(dgroups),len(date_parts)),dtype=object)
-        new_bounds = np.empty((len(dgroups),2),dtype=object)
-
-        for idx,dgrp in enumerate(dgroups):
-            new_value[idx] = select[idx]
-            sel = value[dgrp][:,(0,2)]
-            new_bounds[idx,:] = [sel.min(),sel.max()]
+        dgroups = TemporalGroupIndex(group_ids,ngroups=unique.shape[0])
+        
+        new_value = np.empty((unique.shape[0],len(date_parts)),dtype=object)
+        new_value[:,idx_cmp] = parts[first]
+        new_bounds = dgroups.get_bounds(bounds)
         
-        self.group = self._dtemporal_group_dimension(self,new_value,new_bounds,dgroups)
+        self.group = self._dtemporal_group_dimension(self,new_value,new_bounds,
+                                                     dgroups,group_ids=group_ids)
 
     
+class TemporalGroupIndex(object):
+    '''Time step indices for temporal groups. Indexing or iterating returns a
+    slice for groups with contiguous time steps and an array of sorted time
+    step indices otherwise. Slices select views of the data as opposed to
+    copies.
+    
+    :param group_ids: The group index of each time step.
+    :type group_ids: :class:`numpy.ndarray`
+    :param int ngroups: The number of groups.
+    '''
+    
+    def __init__(self,group_ids,ngroups=None):
+        self.group_ids = np.asarray(group_ids,dtype=int)
+        if ngroups is None:
+            ngroups = 0 if self.group_ids.shape[0] == 0 else self.group_ids.max()+1
+        ## time steps sorted by group. the sort is stable so time steps remain
+        ## ordered within groups.
+        self.order = np.argsort(self.group_ids,kind='mergesort')
+        self.offsets = np.hstack(([0],np.cumsum(np.bincount(self.group_ids,minlength=ngroups))))
+        
+    def __getitem__(self,idx):
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise(IndexError('group index out of range'))
+        members = self.order[self.offsets[idx]:self.offsets[idx+1]]
+        if members.shape[0] > 0 and members[-1]-members[0]+1 == members.shape[0]:
+            ret = slice(members[0],members[-1]+1)
+        else:
+            ret = members
+        return(ret)
+    
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield(self[idx])
+    
+    def __len__(self):
+        return(self.offsets.shape[0]-1)
+    
+    @property
+    def is_contiguous(self):
+        '''`True` if the time steps of every group are contiguous.'''
+        start = self.order[self.offsets[:-1]]
+        stop = self.order[np.maximum(self.offsets[1:]-1,0)]
+        return(bool(np.all(stop-start+1 == np.diff(self.offsets))))
+    
+    def get_bounds(self,value):
+        '''
+        :param value: Array with the time steps on the first axis.
+        :type value: :class:`numpy.ndarray`
+        :returns: Array with shape (ngroups,2) holding the minimum and maximum
+         value of each group.
+        :rtype: :class:`numpy.ndarray`
+        '''
+        ## numpy datetimes are returned as datetime objects
+        ret = np.empty((len(self),2),dtype=object if value.dtype.kind == 'M' else value.dtype)
+        value = value.reshape(value.shape[0],-1)
+        starts = self.offsets[:-1]
+        try:
+            sorted_value = value.astype('datetime64[us]')[self.order]
+        ## datetime objects from non-standard calendars do not convert
+        except (TypeError,ValueError):
+            for idx in range(len(self)):
+                sel = value[self[idx]]
+                ret[idx,:] = [sel.min(),sel.max()]
+        else:
+            lower = np.minimum.reduceat(sorted_value.min(axis=1),starts)
+            upper = np.maximum.reduceat(sorted_value.max(axis=1),starts)
+            ret[:,0] = lower.astype(object)
+            ret[:,1] = upper.astype(object)
+        return(ret)
+    
+    def get_mask(self,idx):
+        '''
+        :param int idx: The group index.
+        :returns: A boolean array selecting the time steps of the group.
+        :rtype: :class:`numpy.ndarray`
+        '''
+        ret = np.zeros(self.group_ids.shape[0],dtype=bool)
+        ret[self[idx]] = True
+        return(ret)
+    
+    
 class AbstractTemporalGroupDimension(AbstractVectorDimension,AbstractInterfaceDimension):
     __metaclass__ = ABCMeta
     
-    def __init__(self,parent,value,bounds,dgroups,uid=None):
+    def __init__(self,parent,value,bounds,dgroups,uid=None,group_ids=None):
         self.parent = parent
         self.value = value
         self.bounds = bounds
         self.dgroups = dgroups
+        ## the group index of each parent time step
+        self.group_ids = group_ids
         if uid is None:
             uid = np.arange(1,self.value.shape[0]+1,dtype=int)
         self.uid = uid
@@ -9,6 +9,7 @@ from shapely.geometry.multipolygon import MultiPolygon
 from shapely.geometry.point import Point
 from ocgis.util.helpers import iter_array
 from ocgis.util.shp_cabinet import ShpCabinet
+from ocgis.util.spatial.geometry_array import GeometryArray
 
 
 class GeometrySpatialDimension(base.AbstractSpatialDimension):
@@ -16,7 +17,7 @@ class GeometrySpatialDimension(base.AbstractSpatialDimension):
     def __init__(self,uid=None,geom=None,projection=None,attrs=None):
         _projection = projection or WGS84()
         super(GeometrySpatialDimension,self).__init__(projection=_projection)
-        self.geom = self._as_numpy_(geom)
+        self.geom = self._as_geometry_array_(geom)
         self.uid = self._as_numpy_(uid)
         self.attrs = attrs or {}
     
@@ -38,6 +39,15 @@ class GeometrySpatialDimension(base.AbstractSpatialDimension):
         for idx in range(geom.shape[0]):
             geom[idx] = w.unwrap(geom[idx])
     
+    def _as_geometry_array_(self,geom):
+        if isinstance(geom,GeometryArray):
+            ret = geom
+        else:
+            ret = GeometryArray.from_shapely(geom)
+        if len(ret.shape) == 0:
+            ret = ret.reshape(1,)
+        return(ret)
+    
     def _as_numpy_(self,element):
         ## check for multipolygons to avoid array confusion
         if isinstance(element,MultiPolygon) or isinstance(element,MultiPoint) or isinstance(element,Point):
@@ -1,7 +1,8 @@
 from ocgis.interface import base
 from ocgis.interface.nc.dimension import NcTemporalDimension, NcLevelDimension,\
-    NcSpatialDimension
+    NcSpatialDimension, NcGridDimension, NcPolygonDimension
 from ocgis.interface.metadata import NcMetadata
+from ocgis.interface.nc.multifile import NcMultiFileDataset
 import numpy as np
 import netCDF4 as nc
 from shapely.geometry.multipolygon import MultiPolygon
@@ -15,6 +16,9 @@ import itertools
 from osgeo.ogr import CreateGeometryFromWkb
 from ocgis.constants import reference_projection
 from shapely.wkb import loads
+from ocgis.util.helpers import get_weighted_average, make_poly
+from ocgis.util.spatial.zonal import get_sparse_weights
+from ocgis.interface.projection import WGS84
 import ocgis
 
 
@@ -32,12 +36,23 @@ class NcDataset(base.AbstractDataset):
         self.__ds = None
         self.__dim_map = None
         self._load_slice = {}
+        ## a planned read shared with other subsets of this dataset
+        self._hyperslab = None
         
     def __del__(self):
         try:
             self._ds.close()
         finally:
             pass
+            
+    def __getstate__(self):
+        ## open file handles and netCDF variable references may not be pickled.
+        ## they are reloaded on demand along with the metadata.
+        state = self.__dict__.copy()
+        state['_NcDataset__ds'] = None
+        state['_NcDataset__dim_map'] = None
+        state['_metadata'] = None
+        return(state)
         
     def __getitem__(self,slc):
         if self.level is None:
@@ -74,16 +89,7 @@ class NcDataset(base.AbstractDataset):
         if self._value is None:
             ref = self._ds.variables[self.request_dataset.variable]
             
-            try:
-                row_start,row_stop = self._sub_range_(self.spatial.grid.row.real_idx)
-            ## NcGridMatrixDimension correction
-            except AttributeError:
-                row_start,row_stop = self._sub_range_(self.spatial.grid.real_idx_row.flatten())
-            try:
-                column_start,column_stop = self._sub_range_(self.spatial.grid.column.real_idx)
-            ## NcGridMatrixDimension correction
-            except AttributeError:
-                column_start,column_stop = self._sub_range_(self.spatial.grid.real_idx_column.flatten())
+            (row_start,row_stop),(column_start,column_stop) = self._get_window_(self.spatial.grid)
                 
             time_start,time_stop = self._sub_range_(self.temporal.real_idx)
             
@@ -93,15 +99,62 @@ class NcDataset(base.AbstractDataset):
                 level = self.level.real_idx
                 level_start,level_stop = level[0],level[-1]+1
             
-            self._value = self._get_numpy_data_(ref,time_start,time_stop,
-             row_start,row_stop,column_start,column_stop,level_start=level_start,
-             level_stop=level_stop)
+            if self._hyperslab is None:
+                self._value = self._get_numpy_data_(ref,time_start,time_stop,
+                 row_start,row_stop,column_start,column_stop,level_start=level_start,
+                 level_stop=level_stop)
+            else:
+                self._value = self._hyperslab.get_value(self,ref,time_start,time_stop,
+                 row_start,row_stop,column_start,column_stop,level_start=level_start,
+                 level_stop=level_stop)
             
-            if self.spatial.vector._geom is not None:
-                self._value.mask[:,:,:,:] = np.logical_or(self._value.mask[0,:,:,:],self.spatial.vector._geom.mask)
+            vector_mask = self.spatial.vector.mask
+            if vector_mask is not None:
+                self._value.mask[:,:,:,:] = np.logical_or(self._value.mask[0,:,:,:],vector_mask)
                 
         return(self._value)
-    
+
+    def iter_value_blocks(self,limit=None):
+        '''Iterate over the value in blocks of time steps. If the value is not
+        loaded, blocks are read from the file and not stored.
+
+        :param float limit: The maximum size of a block in megabytes. Defaults
+         to :attr:`env.STREAM_BLOCK_LIMIT`.
+        :rtype: :class:`numpy.ma.MaskedArray`
+        '''
+        if limit is None:
+            limit = ocgis.env.STREAM_BLOCK_LIMIT
+        if self._value is not None:
+            nbytes = self._value[0].nbytes
+            block_size = max(int(limit*1024**2//max(nbytes,1)),1)
+            for start in range(0,self._value.shape[0],block_size):
+                yield(self._value[start:start+block_size])
+        else:
+            ref = self._ds.variables[self.request_dataset.variable]
+            (row_start,row_stop),(column_start,column_stop) = self._get_window_(self.spatial.grid)
+            time_start,time_stop = self._sub_range_(self.temporal.real_idx)
+            if self.level is None:
+                level_start,level_stop = None,None
+                nlevel = 1
+            else:
+                level = self.level.real_idx
+                level_start,level_stop = level[0],level[-1]+1
+                nlevel = level_stop-level_start
+            nbytes = (row_stop-row_start)*(column_stop-column_start)*nlevel*ref.dtype.itemsize
+            block_size = max(int(limit*1024**2//max(nbytes,1)),1)
+            ## as for the loaded value, the mask of the first time step is
+            ## combined with the geometry mask
+            vector_mask = self.spatial.vector.mask
+            for start in range(time_start,time_stop,block_size):
+                block = self._get_numpy_data_(ref,start,min(start+block_size,time_stop),
+                 row_start,row_stop,column_start,column_stop,level_start=level_start,
+                 level_stop=level_stop)
+                if vector_mask is not None:
+                    if start == time_start:
+                        vector_mask = np.logical_or(block.mask[0,:,:,:],vector_mask)
+                    block.mask[:,:,:,:] = vector_mask
+                yield(block)
+
     def aggregate(self,new_geom_id=1,clip_geom=None):
         ## will hold the unioned geometry
         new_geometry = np.ones((1,1),dtype=object)
@@ -141,8 +194,9 @@ class NcDataset(base.AbstractDataset):
         ## overwrite the original geometry
         self.spatial.vector._geom = new_geometry
         self.spatial.vector.uid = np.ma.array([[new_geom_id]],mask=False)
-        ## aggregate the values
-        self.raw_value = self.value.copy()
+        ## aggregate the values. the aggregated value replaces the stored value
+        ## so the raw value does not need to be copied.
+        self.raw_value = self.value
         self._value = self._get_aggregate_sum_()
         self.spatial.vector._weights = None
     
@@ -155,11 +209,12 @@ class NcDataset(base.AbstractDataset):
     @property
     def _ds(self):
         if self.__ds is None:
-            try:
-                self.__ds = nc.Dataset(self.request_dataset.uri,'r')
-            ## likely multiple uris...
-            except TypeError:
-                self.__ds = nc.MFDataset(self.request_dataset.uri,'r')
+            uri = self.request_dataset.uri
+            if isinstance(uri,basestring):
+                self.__ds = nc.Dataset(uri,'r')
+            ## multiple uris are concatenated along the unlimited dimension
+            else:
+                self.__ds = NcMultiFileDataset(uri)
         return(self.__ds)
     
     def get_iter_value(self,add_bounds=True,add_masked=True,value=None,
@@ -286,7 +341,137 @@ class NcDataset(base.AbstractDataset):
             new_spatial = self.spatial
         ret = self.__class__(request_dataset=self.request_dataset,temporal=new_temporal,
          level=new_level,spatial=new_spatial,metadata=self.metadata,value=None)
+        ret._hyperslab = self._hyperslab
+        return(ret)
+    
+    def get_zonal_aggregates(self,igeoms,uids,spatial_operation='intersects',
+                             temporal=None,level=None):
+        '''Aggregate the dataset for many selection geometries in a single pass
+        over the data. Values are read in blocks of time steps and averaged for
+        all geometries at once using a sparse matrix of cell weights.
+
+        :param igeoms: Selection geometries prepared for the dataset.
+        :type igeoms: sequence of :class:`shapely.geometry.Polygon` or :class:`shapely.geometry.MultiPolygon`
+        :param uids: Unique identifiers of the selection geometries.
+        :param str spatial_operation: Either `'intersects'` or `'clip'`.
+        :param temporal: The temporal subset as passed to :meth:`get_subset`.
+        :param level: The level subset as passed to :meth:`get_subset`.
+        :returns: Aggregated datasets in the order of the selection geometries.
+         Selection geometries not overlapping the grid are `None`.
+        :rtype: list
+        '''
+        if self.spatial.abstraction != 'polygon' or not isinstance(self.spatial.grid,NcGridDimension) or \
+           not self.spatial.grid.is_bounded:
+            raise(NotImplementedError('zonal aggregation requires a bounded polygon grid'))
+        base = self.get_subset(temporal=temporal,level=level)
+        ## limit the read to the window covering all selection geometries
+        bounds = np.array([igeom.bounds for igeom in igeoms])
+        footprint = make_poly((bounds[:,1].min(),bounds[:,3].max()),(bounds[:,0].min(),bounds[:,2].max()))
+        try:
+            grid = base.spatial.grid.subset(polygon=footprint)
+        except EmptyData:
+            return([None]*len(igeoms))
+        row_bounds,col_bounds = grid.row.bounds,grid.column.bounds
+        weights = get_sparse_weights(igeoms,row_bounds,col_bounds,
+                                     spatial_operation=spatial_operation,
+                                     spherical=ocgis.env.SPHERICAL_WEIGHTS and \
+                                      isinstance(self.spatial.projection,WGS84))
+
+        ## read and reduce the data in blocks of time steps
+        ref = self._ds.variables[self.request_dataset.variable]
+        (row_start,row_stop),(column_start,column_stop) = self._get_window_(grid)
+        time_start,time_stop = self._sub_range_(base.temporal.real_idx)
+        if base.level is None:
+            level_start,level_stop = None,None
+            nlevel = 1
+        else:
+            level_start,level_stop = self._sub_range_(base.level.real_idx)
+            nlevel = level_stop-level_start
+        nbytes = grid.shape[0]*grid.shape[1]*nlevel*ref.dtype.itemsize
+        block_size = max(int(ocgis.env.STREAM_BLOCK_LIMIT*1024**2//nbytes),1)
+        value = np.ma.array(np.zeros((time_stop-time_start,nlevel,len(igeoms)),dtype=float),mask=False)
+        ## as for the loaded value, the mask of the first time step applies to
+        ## all time steps
+        mask = None
+        for start in range(time_start,time_stop,block_size):
+            stop = min(start+block_size,time_stop)
+            block = self._get_numpy_data_(ref,start,stop,row_start,row_stop,
+             column_start,column_stop,level_start=level_start,level_stop=level_stop)
+            if mask is None:
+                mask = np.ma.getmaskarray(block)[0,:,:,:].copy()
+            block.mask = np.ma.getmaskarray(block)
+            block.mask[:,:,:,:] = mask
+            value[start-time_start:stop-time_start] = weights.average(block)
+
+        ## construct the aggregated dataset for each selection geometry
+        ret = []
+        for idx,(igeom,uid) in enumerate(zip(igeoms,uids)):
+            indices,_ = weights.get_row(idx)
+            if indices.shape[0] == 0:
+                ret.append(None)
+                continue
+            ii,jj = indices//grid.shape[1],indices%grid.shape[1]
+            new_grid = grid[slice(ii.min(),ii.max()+1),slice(jj.min(),jj.max()+1)]
+            if spatial_operation == 'clip':
+                extent = make_poly((row_bounds[ii,:].min(),row_bounds[ii,:].max()),
+                                   (col_bounds[jj,:].min(),col_bounds[jj,:].max()))
+                new_geometry = igeom.intersection(extent)
+            else:
+                new_geometry = cascaded_union([make_poly(row_bounds[r,:],col_bounds[c,:]) for r,c in zip(ii,jj)])
+            geom = np.ma.array(np.empty((1,1),dtype=object),mask=False)
+            geom[0,0] = new_geometry
+            vector = NcPolygonDimension(grid=new_grid,geom=geom,
+                                        uid=np.ma.array([[uid]],mask=False),
+                                        projection=self.spatial.projection)
+            spatial = NcSpatialDimension(grid=new_grid,vector=vector,
+                                         projection=self.spatial.projection,
+                                         abstraction=self.spatial.abstraction)
+            ds = self.__class__(request_dataset=self.request_dataset,temporal=base.temporal,
+             level=base.level,spatial=spatial,metadata=self.metadata,
+             value=value[:,:,idx].reshape(value.shape[0],value.shape[1],1,1))
+            ret.append(ds)
         return(ret)
+
+    def plan_hyperslab(self,grids,temporal=None,level=None):
+        '''Plan a single read of the window covering all grid subsets. Values
+        for subsets of this dataset falling inside the window are views on the
+        shared read.
+        
+        :param grids: Grid subsets of this dataset.
+        :type grids: sequence of :class:`ocgis.interface.nc.dimension.NcGridDimension`
+        :param temporal: The temporal subset as passed to :meth:`get_subset`.
+        :param level: The level subset as passed to :meth:`get_subset`.
+        :returns: `True` if the read is shared.
+        :rtype: bool
+        '''
+        ## a previous plan is not reused
+        self._hyperslab = None
+        windows = np.array([np.array(self._get_window_(grid)).flatten() for grid in grids])
+        if windows.shape[0] <= 1:
+            return(False)
+        row = (windows[:,0].min(),windows[:,1].max())
+        column = (windows[:,2].min(),windows[:,3].max())
+        ## a shared read is only useful if the windows overlap. the union
+        ## window will otherwise read more data than the individual reads.
+        ncells = (windows[:,1]-windows[:,0])*(windows[:,3]-windows[:,2])
+        if (row[1]-row[0])*(column[1]-column[0]) > ncells.sum():
+            return(False)
+        row,column = self._get_chunk_aligned_(row,column)
+        ## limit the size of the shared read
+        ref = self._ds.variables[self.request_dataset.variable]
+        nbytes = (row[1]-row[0])*(column[1]-column[0])*ref.dtype.itemsize
+        try:
+            nbytes *= self.get_subset(temporal=temporal,level=level).temporal.shape[0]
+        except EmptyData:
+            return(False)
+        if level is not None:
+            nbytes *= level[1]-level[0]+1
+        elif self.level is not None:
+            nbytes *= self.level.shape[0]
+        if nbytes > ocgis.env.SHARED_READ_LIMIT*1024**2:
+            return(False)
+        self._hyperslab = NcHyperslab(row,column)
+        return(True)
     
     def project(self,projection):
         raise(NotImplementedError)
@@ -323,21 +508,77 @@ class NcDataset(base.AbstractDataset):
         self.spatial.grid.column.value = new_col
         ## update the projection
         self.spatial.projection = projection
+        self.spatial.vector.projection = projection
+    
+    def set_snippet(self,grouping=None,time_range=None,size=32):
+        '''Limit the loaded time steps and levels to a snippet. The snippet is
+        the first level and the first time step or, with a grouping, the
+        consecutive time steps in the group of the first time step. Only a
+        prefix of the time coordinate is read. Its size is doubled until the
+        end of the group is found.
+        
+        :param grouping: The temporal grouping of a calculation.
+        :type grouping: list of str
+        :param time_range: The snippet starts at the first time step in the
+         range.
+        :type time_range: [:class:`datetime.datetime`, :class:`datetime.datetime`]
+        :param int size: The initial number of time steps in the prefix.
+        '''
+        self._load_slice.update({'Z':slice(0,1)})
+        self._level = None
+        start = 0
+        if time_range is not None:
+            ## numeric times are searched without decoding the time axis
+            try:
+                start = self.temporal.subset(*time_range).real_idx[0]
+            ## the empty subset is reported by the operation
+            except (EmptyData,IndexError):
+                pass
+        if grouping is None:
+            stop = start+1
+        else:
+            while True:
+                self._load_slice.update({'T':slice(start,start+size)})
+                self._temporal = None
+                self.temporal.set_grouping(grouping)
+                group_ids = self.temporal.group.dgroups.group_ids
+                change = np.flatnonzero(group_ids != group_ids[0])
+                if change.shape[0] > 0:
+                    stop = start+change[0]
+                    break
+                ## the group extends to the end of the time axis
+                elif self.temporal.shape[0] < size:
+                    stop = start+self.temporal.shape[0]
+                    break
+                size *= 2
+        self._load_slice.update({'T':slice(start,stop)})
+        self._temporal = None
     
     def _get_aggregate_sum_(self):
-        value = self.raw_value
-        weights = self.spatial.vector.raw_weights
-
-        ## make the output array
-        wshape = (value.shape[0],value.shape[1],1,1)
-        weighted = np.ma.array(np.empty(wshape,dtype=float),
-                                mask=False)
-        ## next, weight and sum the data accordingly
-        for dim_time in range(value.shape[0]):
-            for dim_level in range(value.shape[1]):
-                weighted[dim_time,dim_level,0,0] = \
-                 np.ma.average(value[dim_time,dim_level,:,:],weights=weights)
-        return(weighted)
+        return(get_weighted_average(self.raw_value,self.spatial.vector.raw_weights))
+    
+    def _get_chunk_aligned_(self,row,column):
+        ## expand the window to the boundaries of the variable's chunks to
+        ## avoid partial chunk reads
+        ref = self._ds.variables[self.request_dataset.variable]
+        try:
+            chunking = ref.chunking()
+        ## multi-file datasets do not expose chunking
+        except AttributeError:
+            chunking = 'contiguous'
+        if chunking == 'contiguous' or chunking is None:
+            ret = (row,column)
+        else:
+            ret = []
+            for axis,(start,stop) in zip(['Y','X'],[row,column]):
+                idx = ref.dimensions.index(self._dim_map[axis]['dimension'])
+                size = chunking[idx]
+                length = len(self._ds.dimensions[ref.dimensions[idx]])
+                start = (start//size)*size
+                stop = min(-(-stop//size)*size,length)
+                ret.append((start,stop))
+            ret = tuple(ret)
+        return(ret)
     
     def _get_axis_(self,dimvar,dims,dim):
         try:
@@ -425,9 +666,25 @@ class NcDataset(base.AbstractDataset):
                 name_bounds = None
             else:
                 raise
-        ret = kls(value=value,name=name,bounds=bounds,name_bounds=name_bounds)
+        ## positions of the loaded values in the file
+        real_idx = np.arange(slc.start or 0,(slc.start or 0)+value.shape[0])
+        ret = kls(value=value,name=name,bounds=bounds,name_bounds=name_bounds,
+                  uid=real_idx+1,real_idx=real_idx)
         return(ret)
     
+    def _get_window_(self,grid):
+        try:
+            row = self._sub_range_(grid.row.real_idx)
+        ## NcGridMatrixDimension correction
+        except AttributeError:
+            row = self._sub_range_(grid.real_idx_row.flatten())
+        try:
+            column = self._sub_range_(grid.column.real_idx)
+        ## NcGridMatrixDimension correction
+        except AttributeError:
+            column = self._sub_range_(grid.real_idx_column.flatten())
+        return(row,column)
+    
     @staticmethod
     def _sub_range_(arr):
         try:
@@ -435,3 +692,50 @@ class NcDataset(base.AbstractDataset):
         except IndexError:
             ret = (arr,arr+1)
         return(ret)
+
+
+
+class NcHyperslab(object):
+    '''A window of variable data read once and shared by the subsets of a
+    dataset.
+    
+    :param row: Start and stop indices of the row window.
+    :type row: (int, int)
+    :param column: Start and stop indices of the column window.
+    :type column: (int, int)
+    '''
+    
+    def __init__(self,row,column):
+        self.row = row
+        self.column = column
+        self._key = None
+        self._value = None
+        self._mask = None
+        
+    def get_value(self,ds,variable,time_start,time_stop,row_start,row_stop,
+                  column_start,column_stop,level_start=None,level_stop=None):
+        '''Return the value for the requested window. If the window is inside
+        the shared window, the data is a view on the shared read. The mask is
+        always a copy as it is modified by the spatial subset.'''
+        inside = self.row[0] <= row_start and row_stop <= self.row[1] and \
+                 self.column[0] <= column_start and column_stop <= self.column[1]
+        if not inside:
+            ret = ds._get_numpy_data_(variable,time_start,time_stop,row_start,
+             row_stop,column_start,column_stop,level_start=level_start,
+             level_stop=level_stop)
+        else:
+            ## the temporal and level subsets are normally shared by all the
+            ## subsets. reread only if they change.
+            key = (time_start,time_stop,level_start,level_stop)
+            if key != self._key:
+                self._value = ds._get_numpy_data_(variable,time_start,time_stop,
+                 self.row[0],self.row[1],self.column[0],self.column[1],
+                 level_start=level_start,level_stop=level_stop)
+                self._mask = np.ma.getmaskarray(self._value)
+                self._key = key
+            rslc = slice(row_start-self.row[0],row_stop-self.row[0])
+            cslc = slice(column_start-self.column[0],column_stop-self.column[0])
+            ret = np.ma.array(self._value.data[:,:,rslc,cslc],
+                              mask=self._mask[:,:,rslc,cslc].copy(),
+                              fill_value=self._value.fill_value)
+        return(ret)
\ No newline at end of file
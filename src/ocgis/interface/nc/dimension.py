@@ -1,18 +1,24 @@
 from ocgis.interface import base
+import ocgis
 import numpy as np
 from ocgis.util.spatial import index as si
+from ocgis.util.spatial.mask import classify_cells
+from ocgis.util.spatial.geometry_array import GeometryArray
 from itertools import product
-from ocgis.util.helpers import make_poly, iter_array
+from ocgis.util.helpers import make_poly, iter_array, get_cell_area
 from shapely import prepared
 import netCDF4 as nc
 from abc import ABCMeta, abstractproperty
 from ocgis.exc import DummyDimensionEncountered, EmptyData
 import datetime
-from ocgis.interface.projection import get_projection, RotatedPole
+from ocgis.interface.projection import get_projection, RotatedPole, WGS84
 from shapely.geometry.point import Point
 from ocgis.util.spatial.wrap import Wrapper
 from shapely.geometry.multipoint import MultiPoint
 from copy import copy
+from ocgis.util.cache import get_cache
+from shapely import wkb
+from ocgis.interface.nc.temporal import get_date_parts_num, get_datetime64
 
 
 class NcDimension(object):
@@ -55,11 +61,47 @@ class NcTemporalGroupDimension(base.AbstractTemporalGroupDimension):
 
 
 class NcTemporalDimension(NcDimension,base.AbstractTemporalDimension):
+    '''Times are stored as the numeric values in the file's units. Datetime
+    objects are decoded when the value or bounds are first accessed. Assigning
+    datetime objects to the value or bounds stores them directly.
+    
+    :param str units: CF time units of the numeric values.
+    :param str calendar: CF calendar of the numeric values.
+    '''
     axis = 'T'
     _name_id = 'tid'
     _name_long = 'time'
     _dtemporal_group_dimension = NcTemporalGroupDimension
     
+    def __init__(self,*args,**kwds):
+        self.units = kwds.pop('units',None)
+        self.calendar = kwds.pop('calendar',None)
+        self.value_num = None
+        self.bounds_num = None
+        self._value = None
+        self._bounds = None
+        super(NcTemporalDimension,self).__init__(*args,**kwds)
+    
+    def __getitem__(self,slc):
+        if self.value_num is None:
+            ret = super(NcTemporalDimension,self).__getitem__(slc)
+            ret.units,ret.calendar = self.units,self.calendar
+        else:
+            ret = self._get_numeric_subset_(slc)
+        return(ret)
+    
+    @property
+    def bounds(self):
+        if self._bounds is None and self.bounds_num is not None:
+            self._bounds = self._decode_(self.bounds_num)
+        return(self._bounds)
+    @bounds.setter
+    def bounds(self,value):
+        if self._is_numeric_(value):
+            self.bounds_num,self._bounds = value,None
+        else:
+            self.bounds_num,self._bounds = None,value
+    
     @property
     def resolution(self):
         diffs = np.array([],dtype=float)
@@ -72,28 +114,130 @@ class NcTemporalDimension(NcDimension,base.AbstractTemporalDimension):
                 break
         return(diffs.mean())
     
+    @property
+    def shape(self):
+        if self.value_num is None:
+            ret = self.value.shape
+        else:
+            ret = self.value_num.shape
+        return(ret)
+    
+    @property
+    def value(self):
+        if self._value is None and self.value_num is not None:
+            self._value = self._decode_(self.value_num)
+        return(self._value)
+    @value.setter
+    def value(self,value):
+        if self._is_numeric_(value):
+            self.value_num,self._value = value,None
+        else:
+            self.value_num,self._value = None,value
+    
+    def get_date_parts(self):
+        try:
+            ret = get_date_parts_num(self.value_num,self.units,self.calendar)
+        ## the times are not numeric or cannot be decoded without datetime
+        ## objects
+        except (NotImplementedError,ValueError,TypeError,AttributeError):
+            ret = super(NcTemporalDimension,self).get_date_parts()
+        return(ret)
+    
+    def get_datetime64(self):
+        try:
+            value = get_datetime64(self.value_num,self.units,self.calendar)
+            if self.bounds_num is None:
+                bounds = None
+            else:
+                bounds = get_datetime64(self.bounds_num,self.units,self.calendar)
+            ret = (value,bounds)
+        except (NotImplementedError,ValueError,TypeError,AttributeError):
+            ret = super(NcTemporalDimension,self).get_datetime64()
+        return(ret)
+    
     def get_nc_time(self,values):
         ret = nc.date2num(values,self.units,calendar=self.calendar)
         return(ret)
     
-    def subset(self,*args,**kwds):
-        ret = super(self.__class__,self).subset(*args,**kwds)
-        ret.units = self.units
-        ret.calendar = self.calendar
-        ret.name_bounds = self.name_bounds
+    def subset(self,lower,upper):
+        '''Subset with the same rules as the datetime comparison of
+        :meth:`AbstractVectorDimension.subset`. For increasing numeric times,
+        the limits are converted to the file's units and the window is found
+        by binary search. Only times in the window are decoded.
+        '''
+        try:
+            idx = self._get_subset_window_(lower,upper)
+        ## decode the times and compare datetime objects
+        except NotImplementedError:
+            ret = super(self.__class__,self).subset(lower,upper)
+            ret.units = self.units
+            ret.calendar = self.calendar
+            ret.name_bounds = self.name_bounds
+        else:
+            ret = self._get_numeric_subset_(idx)
+        return(ret)
+    
+    def _get_subset_window_(self,lower,upper):
+        value = self.value_num
+        if value is None or value.ndim != 1 or value.shape[0] == 0 or np.any(np.diff(value) <= 0):
+            raise(NotImplementedError('the numeric times are not increasing'))
+        try:
+            lower,upper = nc.date2num([lower,upper],self.units,calendar=self.calendar)
+        except (ValueError,TypeError,AttributeError):
+            raise(NotImplementedError('the limits are not convertible to the time units'))
+        if self.bounds_num is not None:
+            bounds = self.bounds_num
+            if bounds[0,0] > bounds[0,1]:
+                lower_col,upper_col = 1,0
+            else:
+                lower_col,upper_col = 0,1
+            if np.any(np.diff(bounds,axis=0) <= 0):
+                raise(NotImplementedError('the numeric bounds are not increasing'))
+            ## bounds overlapping the limits
+            start = np.searchsorted(bounds[:,upper_col],lower,side='right')
+            stop = np.searchsorted(bounds[:,lower_col],upper,side='left')
+            if start < stop:
+                return(slice(start,stop))
+        ## bounds may align with centroids, check if the centroids return a
+        ## match
+        start = np.searchsorted(value,lower,side='left')
+        stop = np.searchsorted(value,upper,side='right')
+        if self.bounds_num is not None and start >= stop:
+            raise(EmptyData('temporal subset returned empty'))
+        return(slice(start,max(start,stop)))
+    
+    def _decode_(self,value):
+        try:
+            ret = get_datetime64(value,self.units,self.calendar).astype(object)
+        ## use the netCDF4 decoding for calendars without numpy datetimes
+        except (NotImplementedError,ValueError):
+            ret = nc.num2date(value,self.units,calendar=self.calendar)
+            self._to_datetime_(ret)
         return(ret)
     
+    def _get_numeric_subset_(self,idx):
+        bounds = None if self.bounds_num is None else self.bounds_num[idx,:]
+        ret = self.__class__(value=self.value_num[idx],bounds=bounds,
+                             uid=self.uid[idx],real_idx=self.real_idx[idx],
+                             name=self.name,name_bounds=self.name_bounds,
+                             units=self.units,calendar=self.calendar)
+        ## keep decoded times
+        if self._value is not None:
+            ret._value = self._value[idx]
+        if self._bounds is not None:
+            ret._bounds = self._bounds[idx,:]
+        return(ret)
+    
+    @staticmethod
+    def _is_numeric_(value):
+        return(isinstance(value,np.ndarray) and value.dtype.kind in 'iuf')
+    
     @classmethod
     def _load_(cls,gi,subset_by=None):
         ret = NcDimension._load_.im_func(cls,gi,subset_by=subset_by)
         attrs = gi.metadata['variables'][ret.name]['attrs']
         ret.units = gi._t_units or attrs['units']
         ret.calendar = gi._t_calendar or attrs['calendar']
-        ret.value = nc.num2date(ret.value,ret.units,calendar=ret.calendar)
-        cls._to_datetime_(ret.value)
-        if ret.bounds is not None:
-            ret.bounds = nc.num2date(ret.bounds,ret.units,calendar=ret.calendar)
-            cls._to_datetime_(ret.bounds)
         return(ret)
     
     @staticmethod
@@ -118,9 +262,11 @@ class NcSpatialDimension(base.AbstractSpatialDimension):
             self.grid = grid
         if vector is None:
             if self.abstraction == 'point' or self.grid.row.bounds is None:
-                self.vector = NcPointDimension(grid=self.grid,uid=self.grid.uid)
+                self.vector = NcPointDimension(grid=self.grid,uid=self.grid.uid,
+                                               projection=projection)
             else:
-                self.vector = NcPolygonDimension(grid=self.grid,uid=self.grid.uid)
+                self.vector = NcPolygonDimension(grid=self.grid,uid=self.grid.uid,
+                                                 projection=projection)
         else:
             self.vector = vector
             
@@ -163,14 +309,26 @@ class NcSpatialDimension(base.AbstractSpatialDimension):
         raise(NotImplementedError,'Use "grid" or "vector" weights.')
     
     def get_iter(self):
-        geoms = self.vector.geom
+        vector = self.vector
         name_id = self._name_id
-        uid = self.vector.uid
+        uid = vector.uid
+        
+        ## if geometries are not loaded, create them for each unmasked cell
+        ## without storing them on the vector dimension.
+        if vector._geom is None:
+            mask = vector.mask
+            if mask is None:
+                mask = False
+            geoms = np.ma.array(np.empty(vector.shape,dtype=object),mask=mask)
+            get_geom = vector._get_geom_
+        else:
+            geoms = vector.geom
+            get_geom = lambda ii,jj: geoms[ii,jj]
 
         ret = {}
         for ii,jj in iter_array(geoms):
             ret[name_id] = uid[ii,jj]
-            yield(((ii,jj),geoms[ii,jj],ret))
+            yield(((ii,jj),get_geom(ii,jj),ret))
     
     @classmethod
     def _load_(cls,gi,subset_by=None):
@@ -381,24 +539,65 @@ class NcGridMatrixDimension(base.AbstractSpatialGrid):
 
 class NcPolygonDimension(base.AbstractPolygonDimension):
     
-    def __init__(self,grid=None,geom=None,uid=None):
+    def __init__(self,grid=None,geom=None,uid=None,mask=None,projection=None):
         self._geom = geom
+        self._mask = mask
         self._weights = None
         self.grid = grid
         self.uid = uid
+        self.projection = projection
         
     @property
     def extent(self):
         raise(NotImplementedError)
     
+    @property
+    def mask(self):
+        '''Boolean mask of the vector dimension or `None` if there is no mask.
+        Geometries are not loaded to retrieve the mask.'''
+        if self._geom is None:
+            ret = self._mask
+        elif isinstance(self._geom,GeometryArray):
+            ret = self._geom.mask
+        else:
+            ret = np.ma.getmaskarray(self._geom)
+        return(ret)
+    
+    @property
+    def shape(self):
+        if self._geom is None:
+            ret = self.grid.shape
+        else:
+            ret = self._geom.shape
+        return(ret)
+    
     @property
     def weights(self):
         if self._weights is None:
-            geom = self.geom
-            weights = np.ones(geom.shape,dtype=float)
-            weights = np.ma.array(weights,mask=geom.mask)
-            for ii,jj in iter_array(geom):
-                weights[ii,jj] = geom[ii,jj].area
+            geom = self._geom
+            if geom is None or isinstance(geom,GeometryArray):
+                ## cell areas come from the bounds
+                row_bounds,col_bounds = self.grid.row.bounds,self.grid.column.bounds
+                ## areas on the sphere are only valid for geographic coordinates
+                spherical = ocgis.env.SPHERICAL_WEIGHTS and isinstance(self.projection,WGS84)
+                weights = get_cell_area(row_bounds,col_bounds,spherical=spherical)
+                mask = self.mask
+                weights = np.ma.array(weights,mask=(False if mask is None else mask.copy()))
+                ## clipped cells are scaled by the fraction of the cell area
+                ## remaining.
+                if geom is not None:
+                    replaced = np.logical_and(geom.replaced,np.logical_not(geom.mask))
+                    if replaced.any():
+                        area = get_cell_area(row_bounds,col_bounds)
+                        for ii,jj in zip(*np.nonzero(replaced)):
+                            if area[ii,jj] > 0:
+                                weights[ii,jj] *= geom[ii,jj].area/area[ii,jj]
+            else:
+                geom = self.geom
+                weights = np.ones(geom.shape,dtype=float)
+                weights = np.ma.array(weights,mask=geom.mask)
+                for ii,jj in iter_array(geom):
+                    weights[ii,jj] = geom[ii,jj].area
             weights = weights/weights.max()
             self._weights = weights
         return(self._weights)
@@ -406,18 +605,42 @@ class NcPolygonDimension(base.AbstractPolygonDimension):
     def clip(self,polygon):
         ## perform an intersects operation first
         vd = self.intersects(polygon)
+        geom = vd.geom
+        
+        ## clipped geometries may be stored from a previous clip. weights are
+        ## computed from the geometries when requested.
+        cache = get_cache()
+        if cache is not None:
+            key = cache.get_key('clip',vd.grid.row.bounds,vd.grid.column.bounds,
+                                polygon.wkb)
+            cached = cache.get(key)
+            if cached is not None:
+                offsets = cached['wkb_offsets']
+                buf = cached['wkb'].tostring()
+                for idx,(ii,jj) in enumerate(cached['replaced']):
+                    geom[ii,jj] = wkb.loads(buf[offsets[idx]:offsets[idx+1]])
+                return(self.__class__(grid=vd.grid,geom=geom,uid=vd.uid,
+                                      projection=self.projection))
+        
         ## prepare the geometry for intersection
         prep_igeom = prepared.prep(polygon)
         
         ## loop for the intersection
-        geom = vd._geom
+        replaced = []
         for ii,jj in iter_array(geom):
             ref = geom[ii,jj]
             if not prep_igeom.contains(ref):
                 new_geom = polygon.intersection(ref)
                 geom[ii,jj] = new_geom
+                replaced.append((ii,jj))
         
-        ret = self.__class__(grid=vd.grid,geom=geom,uid=vd.uid)
+        ret = self.__class__(grid=vd.grid,geom=geom,uid=vd.uid,projection=self.projection)
+        if cache is not None:
+            wkbs = [geom[ii,jj].wkb for ii,jj in replaced]
+            offsets = np.cumsum([0]+[len(w) for w in wkbs])
+            cache.put(key,replaced=np.array(replaced,dtype=int).reshape(-1,2),
+                      wkb=np.array(bytearray(''.join(wkbs)),dtype=np.uint8),
+                      wkb_offsets=offsets)
         return(ret)
     
     def get_iter(self):
@@ -431,30 +654,43 @@ class NcPolygonDimension(base.AbstractPolygonDimension):
         ## do the initial grid subset
         grid = self.grid.subset(polygon=polygon)
         
-        ## construct the spatial index
-        index_grid = si.build_index_grid(30.0,polygon)
-        index = si.build_index(polygon,index_grid)
+        ## the mask may be stored from a previous intersects
+        cache = get_cache()
+        if cache is not None:
+            key = cache.get_key('intersects',grid.row.bounds,grid.column.bounds,polygon.wkb)
+            cached = cache.get(key)
+            if cached is not None:
+                return(self.__class__(grid=grid,uid=grid.uid,mask=cached['mask'],
+                                      projection=self.projection))
         
-        ## the fill arrays
-        geom = np.ones(grid.shape,dtype=object)
-        geom = np.ma.array(geom,mask=True)
+        ## the fill array. geometries are created when first requested.
+        mask = np.ones(grid.shape,dtype=bool)
         
-        ## loop performing the spatial operation
+        ## classify cells using the bounds. only cells on the polygon boundary
+        ## require the exact test.
         row = grid.row.bounds
         col = grid.column.bounds
-        index_intersects = si.index_intersects
-        geom_mask = geom.mask
-        for ii,jj in product(range(row.shape[0]),range(col.shape[0])):
-            rref = row[ii,:]
-            cref = col[jj,:]
-            test_geom = make_poly(rref,cref)
-            geom[ii,jj] = test_geom
-            if index_intersects(test_geom,index):
-                geom_mask[ii,jj] = False
-            else:
-                geom_mask[ii,jj] = True
+        classified = classify_cells(polygon,row,col)
+        if classified is None:
+            to_test = product(range(row.shape[0]),range(col.shape[0]))
+        else:
+            inside,boundary = classified
+            mask[inside] = False
+            to_test = zip(*np.nonzero(boundary))
+        
+        ## loop performing the spatial operation
+        index = None
+        for ii,jj in to_test:
+            ## construct the spatial index on first use
+            if index is None:
+                index = si.get_spatial_index(polygon)
+            bounds = (col[jj,:].min(),row[ii,:].min(),col[jj,:].max(),row[ii,:].max())
+            if index.keep(make_poly(row[ii,:],col[jj,:]),bounds=bounds):
+                mask[ii,jj] = False
 
-        ret = self.__class__(grid=grid,geom=geom,uid=grid.uid)
+        if cache is not None:
+            cache.put(key,mask=mask)
+        ret = self.__class__(grid=grid,uid=grid.uid,mask=mask,projection=self.projection)
         return(ret)
     
     def unwrap(self):
@@ -467,18 +703,11 @@ class NcPolygonDimension(base.AbstractPolygonDimension):
             geom[ii,jj] = wrap(to_wrap)
     
     def _get_all_geoms_(self):
-        ## the fill arrays
-        geom = np.ones(self.grid.shape,dtype=object)
-        geom = np.ma.array(geom,mask=False)
-        ## loop performing the spatial operation
-        row = self.grid.row.bounds
-        col = self.grid.column.bounds
-        for ii,jj in product(range(row.shape[0]),range(col.shape[0])):
-            rref = row[ii,:]
-            cref = col[jj,:]
-            geom[ii,jj] = make_poly(rref,cref)
-        
-        return(geom)
+        mask = None if self._mask is None else self._mask.copy()
+        return(GeometryArray.from_bounds(self.grid.row.bounds,self.grid.column.bounds,mask=mask))
+    
+    def _get_geom_(self,ii,jj):
+        return(make_poly(self.grid.row.bounds[ii,:],self.grid.column.bounds[jj,:]))
     
     
 class NcPointDimension(NcPolygonDimension):
@@ -489,7 +718,10 @@ class NcPointDimension(NcPolygonDimension):
 
     @property
     def weights(self):
-        return(np.ma.array(self.grid.weights,mask=self.geom.mask))
+        mask = self.mask
+        if mask is None:
+            mask = False
+        return(np.ma.array(self.grid.weights,mask=mask))
 
     def clip(self,polygon):
         return(self.intersects(polygon))
@@ -497,53 +729,30 @@ class NcPointDimension(NcPolygonDimension):
     def intersects(self,polygon):
         ## do the initial grid subset
         grid = self.grid.subset(polygon=polygon)
-        ## a prepared polygon
-        prep_polygon = prepared.prep(polygon)
-        ## the fill arrays
-        geom = np.ones(grid.shape,dtype=object)
-        geom = np.ma.array(geom,mask=True)
-        geom_mask = geom.mask
-        
+        ## test all point coordinates at once. point geometries are created
+        ## when first requested.
+        x,y = self._get_coordinates_(grid)
+        mask = np.logical_not(si.intersects_points(polygon,x,y))
+        ret = self.__class__(grid=grid,uid=grid.uid,mask=mask,projection=self.projection)
+        return(ret)
+
+    def _get_all_geoms_(self):
+        x,y = self._get_coordinates_(self.grid)
+        mask = None if self._mask is None else self._mask.copy()
+        return(GeometryArray.from_points(x,y,mask=mask))
+    
+    def _get_geom_(self,ii,jj):
         try:
-            row = grid.row.value
-            col = grid.column.value
-            for ii,jj in product(range(row.shape[0]),range(col.shape[0])):
-                pt = Point(col[jj],row[ii])
-                geom[ii,jj] = pt
-                if prep_polygon.intersects(pt):
-                    geom_mask[ii,jj] = False
-                else:
-                    geom_mask[ii,jj] = True
+            ret = Point(self.grid.column.value[jj],self.grid.row.value[ii])
         ## NcGridMatrixDimension correction
         except AttributeError:
-            _row = grid.row
-            _col = grid.column
-            for ii,jj in iter_array(_row):
-                pt = Point(_col[ii,jj],_row[ii,jj])
-                geom[ii,jj] = pt
-                if prep_polygon.intersects(pt):
-                    geom_mask[ii,jj] = False
-                else:
-                    geom_mask[ii,jj] = True
-            
-        ret = self.__class__(grid=grid,geom=geom,uid=grid.uid)
-
+            ret = Point(self.grid.column[ii,jj],self.grid.row[ii,jj])
         return(ret)
-
-    def _get_all_geoms_(self):
-        ## the fill arrays
-        geom = np.ones(self.grid.shape,dtype=object)
-        geom = np.ma.array(geom,mask=False)
-        ## loop performing the spatial operation
+    
+    def _get_coordinates_(self,grid):
         try:
-            row = self.grid.row.value
-            col = self.grid.column.value
-            for ii,jj in product(range(row.shape[0]),range(col.shape[0])):
-                geom[ii,jj] = Point(col[jj],row[ii])
+            x,y = np.meshgrid(grid.column.value,grid.row.value)
         ## NcGridMatrixDimension correction
         except AttributeError:
-            _row = self.grid.row
-            _col = self.grid.column
-            for ii,jj in iter_array(_row):
-                geom[ii,jj] = Point(_col[ii,jj],_row[ii,jj])
-        return(geom)
\ No newline at end of file
+            x,y = grid.column,grid.row
+        return(x,y)
\ No newline at end of file
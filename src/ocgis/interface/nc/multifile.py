@@ -0,0 +1,255 @@
+import os
+from collections import OrderedDict
+import numpy as np
+import netCDF4 as nc
+from ocgis import constants
+from ocgis.util.cache import get_cache, SubsetCache
+
+
+## time indices of files keyed by the file and coordinate names. entries are
+## also stored in the subset cache if it is enabled.
+_index_cache = {}
+
+
+class NcFileIndex(object):
+    '''The positions of files along the aggregation dimension of a multi-file
+    dataset with the values of its coordinate variables. Values of each file
+    are converted to the time units of the first file.
+
+    :param uris: The files in the order of concatenation.
+    :type uris: sequence of str
+    :param str dimension: The name of the aggregation dimension.
+    :param names: Names of the coordinate variables to index. The first name
+     is the coordinate variable of the dimension. Names of variables missing
+     from the files are ignored.
+    :type names: sequence of str
+    :param str units: Time units of the coordinate variables in the first file.
+    :param str calendar: Calendar of the coordinate variables.
+    '''
+
+    def __init__(self,uris,dimension,names,units=None,calendar='standard'):
+        self.uris = list(uris)
+        self.dimension = dimension
+        self.names = list(names)
+        self.units = units
+        self.calendar = calendar
+
+        entries = [self._get_entry_(uri) for uri in self.uris]
+        sizes = [entry['size'] for entry in entries]
+        ## file idx holds positions offsets[idx] to offsets[idx+1]
+        self.offsets = np.hstack(([0],np.cumsum(sizes))).astype(int)
+        self.values = {}
+        for name in self.names:
+            if all([name in entry for entry in entries]):
+                self.values[name] = np.concatenate([entry[name] for entry in entries])
+
+    def __len__(self):
+        return(int(self.offsets[-1]))
+
+    def get_files(self,idx):
+        '''
+        :param idx: Positions along the aggregation dimension.
+        :type idx: :class:`numpy.ndarray`
+        :returns: Tuples of file index and local positions for consecutive
+         positions in the same file.
+        :rtype: list
+        '''
+        fidx = np.searchsorted(self.offsets,idx,side='right')-1
+        ret = []
+        if idx.shape[0] > 0:
+            breaks = np.flatnonzero(np.diff(fidx))+1
+            for start,stop in zip(np.hstack(([0],breaks)),np.hstack((breaks,[idx.shape[0]]))):
+                ret.append((fidx[start],idx[start:stop]-self.offsets[fidx[start]]))
+        return(ret)
+
+    def _get_entry_(self,uri):
+        try:
+            stat = os.stat(uri)
+        ## likely a remote dataset. the entry is kept for this process only.
+        except OSError:
+            stamp = None
+        else:
+            stamp = (stat.st_mtime,stat.st_size)
+        key = SubsetCache.get_key('file_index',uri,stamp,self.dimension,
+                                  ','.join(self.names),self.units,self.calendar)
+        ret = _index_cache.get(key)
+        if ret is None:
+            cache = get_cache() if stamp is not None else None
+            if cache is not None:
+                ret = cache.get(key)
+                if ret is not None:
+                    ret['size'] = int(ret['size'])
+            if ret is None:
+                ret = self._read_entry_(uri)
+                if cache is not None:
+                    cache.put(key,**ret)
+            _index_cache[key] = ret
+        return(ret)
+
+    def _read_entry_(self,uri):
+        ds = nc.Dataset(uri,'r')
+        try:
+            ret = {'size':len(ds.dimensions[self.dimension])}
+            ## bounds variables share the units of the coordinate variable
+            try:
+                units = getattr(ds.variables[self.names[0]],'units',self.units)
+            except (IndexError,KeyError):
+                units = self.units
+            for name in self.names:
+                try:
+                    var = ds.variables[name]
+                except KeyError:
+                    continue
+                value = np.asarray(var[:])
+                if self.units is not None and units != self.units:
+                    value = nc.date2num(nc.num2date(value,units,calendar=self.calendar),
+                                        self.units,calendar=self.calendar)
+                ret[name] = value
+        finally:
+            ds.close()
+        return(ret)
+
+
+class NcMultiFileDataset(object):
+    '''A read-only view of netCDF files concatenated along the unlimited
+    dimension of the first file. It replaces :class:`netCDF4.MFDataset`:
+    metadata is read from the first file and variables along the aggregation
+    dimension are read only from the files overlapping the requested positions.
+    The time coordinates are read from a cached :class:`NcFileIndex`.
+
+    :param uris: The files in the order of concatenation.
+    :type uris: sequence of str
+    '''
+
+    def __init__(self,uris):
+        self.uris = list(uris)
+        self._files = {}
+        first = self._get_file_(0)
+        unlimited = [key for key,value in first.dimensions.iteritems() if value.isunlimited()]
+        if len(unlimited) == 0:
+            raise(ValueError('multi-file datasets require an unlimited dimension: {0}'.format(self.uris[0])))
+        self.aggregation_dimension = unlimited[0]
+        self._index = None
+
+        self.dimensions = OrderedDict()
+        for key,value in first.dimensions.iteritems():
+            if key == self.aggregation_dimension:
+                value = NcMultiFileDimension(key,self)
+            self.dimensions[key] = value
+        self.variables = OrderedDict()
+        for key,value in first.variables.iteritems():
+            if len(value.dimensions) > 0 and value.dimensions[0] == self.aggregation_dimension:
+                value = NcMultiFileVariable(key,self)
+            self.variables[key] = value
+
+    def __getattr__(self,name):
+        ## global attributes are those of the first file
+        if name.startswith('_'):
+            raise(AttributeError(name))
+        return(getattr(self._get_file_(0),name))
+
+    @property
+    def index(self):
+        if self._index is None:
+            first = self._get_file_(0)
+            names = []
+            try:
+                coordinate = first.variables[self.aggregation_dimension]
+            except KeyError:
+                units,calendar = None,'standard'
+            else:
+                names.append(self.aggregation_dimension)
+                units = getattr(coordinate,'units',None)
+                calendar = getattr(coordinate,'calendar','standard')
+                for attr in constants.name_bounds:
+                    try:
+                        names.append(getattr(coordinate,attr))
+                        break
+                    except AttributeError:
+                        continue
+            ## time units are only converted for time coordinates
+            if units is not None and 'since' not in units:
+                units = None
+            self._index = NcFileIndex(self.uris,self.aggregation_dimension,names,
+                                      units=units,calendar=calendar)
+        return(self._index)
+
+    def close(self):
+        for ds in self._files.itervalues():
+            ds.close()
+        self._files = {}
+
+    def ncattrs(self):
+        return(self._get_file_(0).ncattrs())
+
+    def _get_file_(self,idx):
+        try:
+            ret = self._files[idx]
+        except KeyError:
+            ret = nc.Dataset(self.uris[idx],'r')
+            self._files[idx] = ret
+        return(ret)
+
+
+class NcMultiFileDimension(object):
+    '''The aggregation dimension of a :class:`NcMultiFileDataset`.'''
+
+    def __init__(self,name,dataset):
+        self._name = name
+        self._dataset = dataset
+
+    def __len__(self):
+        return(len(self._dataset.index))
+
+    def isunlimited(self):
+        return(True)
+
+
+class NcMultiFileVariable(object):
+    '''A variable along the aggregation dimension of a
+    :class:`NcMultiFileDataset`. Attributes are those of the variable in the
+    first file.'''
+
+    def __init__(self,name,dataset):
+        self._name = name
+        self._dataset = dataset
+
+    def __getattr__(self,name):
+        if name.startswith('__'):
+            raise(AttributeError(name))
+        return(getattr(self._dataset._get_file_(0).variables[self._name],name))
+
+    def __getitem__(self,key):
+        if not isinstance(key,tuple):
+            key = (key,)
+        index = self._dataset.index
+        ## coordinate variables are read from the index
+        if self._name in index.values:
+            return(index.values[self._name][key])
+        tkey,rest = key[0],key[1:]
+        idx = np.arange(len(index))[tkey]
+        scalar = idx.ndim == 0
+        idx = np.atleast_1d(idx)
+        parts = []
+        for fidx,local in index.get_files(idx):
+            var = self._dataset._get_file_(fidx).variables[self._name]
+            if np.all(np.diff(local) == 1):
+                local = slice(local[0],local[-1]+1)
+            parts.append(var[(local,)+rest])
+        if len(parts) == 0:
+            ret = np.empty((0,)+self.shape[1:],dtype=self.dtype)[(slice(None),)+rest]
+        elif len(parts) == 1:
+            ret = parts[0]
+        else:
+            ret = np.ma.concatenate(parts,axis=0)
+        if scalar:
+            ret = ret[0]
+        return(ret)
+
+    @property
+    def shape(self):
+        first = self._dataset._get_file_(0).variables[self._name]
+        return((len(self._dataset.index),)+first.shape[1:])
+
+    def ncattrs(self):
+        return(self._dataset._get_file_(0).variables[self._name].ncattrs())
@@ -0,0 +1,120 @@
+import re
+import numpy as np
+from ocgis.util.helpers import get_date_parts
+
+
+## seconds in each time unit
+UNITS = {'days':86400,'day':86400,'d':86400,
+         'hours':3600,'hour':3600,'hrs':3600,'hr':3600,'h':3600,
+         'minutes':60,'minute':60,'mins':60,'min':60,
+         'seconds':1,'second':1,'secs':1,'sec':1,'s':1}
+## calendars decoded with numpy datetimes
+CALENDARS_STANDARD = ('standard','gregorian','proleptic_gregorian')
+## calendars decoded with tables of month lengths
+CALENDARS_TABLE = {'noleap':[31,28,31,30,31,30,31,31,30,31,30,31],
+                   '365_day':[31,28,31,30,31,30,31,31,30,31,30,31],
+                   '360_day':[30]*12}
+## the first day of the gregorian calendar. the standard calendar is julian
+## before this day.
+GREGORIAN_START = np.datetime64('1582-10-15')
+
+_re_units = re.compile(r'^\s*(\w+)\s+since\s+(-?\d+)-(\d+)-(\d+)'
+                       r'(?:[ T](\d+):(\d+)(?::(\d+(?:\.\d*)?))?)?'
+                       r'\s*(?:Z|UTC|[+-]00:?00)?\s*$')
+
+
+def get_units_origin(units):
+    '''
+    :param str units: CF time units (e.g. `'days since 1850-01-01 00:00:00'`).
+    :returns: The seconds in a time unit and the origin as `year, month, day,
+     hour, minute, second`.
+    :rtype: (int, tuple)
+    :raises: NotImplementedError
+    '''
+    match = _re_units.match(units)
+    if match is None or match.group(1).lower() not in UNITS:
+        raise(NotImplementedError('time units not recognized: {0}'.format(units)))
+    origin = [int(part or 0) for part in match.groups()[1:6]]
+    origin.append(float(match.group(7) or 0))
+    return(UNITS[match.group(1).lower()],tuple(origin))
+
+def get_date_parts_num(value,units,calendar):
+    '''Decode numeric times to integer date parts without creating datetime
+    objects.
+
+    :param value: Times in the units.
+    :type value: :class:`numpy.ndarray`
+    :param str units: CF time units.
+    :param str calendar: CF calendar name.
+    :returns: Array with shape (n,7) and columns `year, month, day, hour,
+     minute, second, microsecond`. Microseconds are truncated.
+    :rtype: :class:`numpy.ndarray`
+    :raises: NotImplementedError
+    '''
+    if calendar in CALENDARS_STANDARD:
+        ret = get_date_parts(get_datetime64(value,units,calendar))
+    elif calendar in CALENDARS_TABLE:
+        days,seconds = _get_days_seconds_(value,units,calendar)
+        lengths = np.array(CALENDARS_TABLE[calendar])
+        ndays = lengths.sum()
+        starts = np.hstack(([0],np.cumsum(lengths)[:-1]))
+        doy = days % ndays
+        month = np.searchsorted(starts,doy,side='right')
+        ret = np.empty((days.shape[0],7),dtype=int)
+        ret[:,0] = days // ndays
+        ret[:,1] = month
+        ret[:,2] = doy-starts[month-1]+1
+        ret[:,3] = seconds // 3600
+        ret[:,4] = (seconds // 60) % 60
+        ret[:,5] = seconds % 60
+        ret[:,6] = 0
+    else:
+        raise(NotImplementedError('calendar not supported: {0}'.format(calendar)))
+    return(ret)
+
+def get_datetime64(value,units,calendar):
+    '''Decode numeric times to numpy datetimes with a resolution of seconds.
+
+    :param value: Times in the units.
+    :type value: :class:`numpy.ndarray`
+    :param str units: CF time units.
+    :param str calendar: CF calendar name. Calendars with dates that do not
+     exist in the gregorian calendar are not supported.
+    :returns: Array of `datetime64[s]` with the shape of the value.
+    :rtype: :class:`numpy.ndarray`
+    :raises: NotImplementedError
+    '''
+    value = np.asarray(value)
+    if calendar in CALENDARS_STANDARD:
+        factor,origin = get_units_origin(units)
+        start = np.datetime64('{0:04d}-{1:02d}-{2:02d}'.format(*origin[0:3]),'us')
+        ## an origin before the gregorian calendar start is a julian date and
+        ## every time is offset from the proleptic date
+        if calendar != 'proleptic_gregorian' and start < GREGORIAN_START:
+            raise(NotImplementedError('time units origin before the gregorian calendar start'))
+        start += np.timedelta64(int(round((origin[3]*3600+origin[4]*60+origin[5])*1e6)),'us')
+        offset = np.round(value.reshape(-1).astype(float)*factor*1e6).astype(np.int64)
+        ret = (start+offset.astype('timedelta64[us]')).astype('datetime64[s]')
+        if calendar != 'proleptic_gregorian' and ret.shape[0] > 0 and ret.min() < GREGORIAN_START:
+            raise(NotImplementedError('dates before the gregorian calendar start'))
+    elif calendar in ('noleap','365_day'):
+        parts = get_date_parts_num(value,units,calendar)
+        month = (parts[:,0]-1970)*12+parts[:,1]-1
+        seconds = parts[:,3]*3600+parts[:,4]*60+parts[:,5]
+        ret = month.astype('datetime64[M]').astype('datetime64[s]')
+        ret += ((parts[:,2]-1)*86400+seconds).astype('timedelta64[s]')
+    else:
+        raise(NotImplementedError('calendar not supported: {0}'.format(calendar)))
+    return(ret.reshape(value.shape))
+
+def _get_days_seconds_(value,units,calendar):
+    ## whole days and seconds of the day counted from the start of year zero
+    factor,origin = get_units_origin(units)
+    lengths = CALENDARS_TABLE[calendar]
+    year,month,day,hour,minute,second = origin
+    start = (year*sum(lengths)+sum(lengths[0:month-1])+day-1)*86400*1000000
+    start += int(round((hour*3600+minute*60+second)*1e6))
+    total = start+np.round(np.asarray(value).reshape(-1).astype(float)*factor*1e6).astype(np.int64)
+    ## microseconds are truncated
+    total //= 1000000
+    return(total // 86400,total % 86400)
@@ -4,6 +4,7 @@ import numpy as np
 from shapely.geometry.multipolygon import MultiPolygon
 from shapely.ops import cascaded_union
 from ocgis.util.helpers import iter_array
+from ocgis.util.spatial.geometry_array import GeometryArray
 
 
 class ShpSpatialDimension(geometry.GeometrySpatialDimension):
@@ -72,8 +73,7 @@ class ShpDataset(geometry.GeometryDataset):
             else:
                 to_union.append(geom)
         ugeom = cascaded_union(to_union)
-        new_geom = np.ma.array([0],dtype=object)
-        new_geom[0] = ugeom
+        new_geom = GeometryArray.from_shapely([ugeom])
         new_uid = np.ma.array([new_id],dtype=int)
         self.spatial.geom = new_geom
         self.spatial.uid = new_uid
@@ -0,0 +1,40 @@
+import time
+import numpy as np
+from ocgis.util.helpers import get_weighted_average
+
+
+def get_aggregate_loop(value,weights):
+    ## the previous implementation averaging each time step and level
+    wshape = (value.shape[0],value.shape[1],1,1)
+    weighted = np.ma.array(np.empty(wshape,dtype=float),mask=False)
+    for dim_time in range(value.shape[0]):
+        for dim_level in range(value.shape[1]):
+            weighted[dim_time,dim_level,0,0] = \
+             np.ma.average(value[dim_time,dim_level,:,:],weights=weights)
+    return(weighted)
+
+def main(ntime=36500,shape=(20,20)):
+    ## a century of daily values with a geometry mask and scattered missing
+    ## values
+    np.random.seed(1)
+    value = np.random.rand(ntime,1,shape[0],shape[1])
+    mask = np.random.rand(*value.shape) > 0.95
+    geom_mask = np.zeros(shape,dtype=bool)
+    geom_mask[0:5,0:5] = True
+    mask = np.logical_or(mask,geom_mask)
+    value = np.ma.array(value,mask=mask)
+    weights = np.ma.array(np.random.rand(*shape),mask=geom_mask)
+    print('time steps={0} grid={1}'.format(ntime,shape))
+    
+    t1 = time.time()
+    loop = get_aggregate_loop(value,weights)
+    t2 = time.time()
+    vectorized = get_weighted_average(value,weights)
+    t3 = time.time()
+    
+    assert(np.allclose(loop,vectorized))
+    print('  loop={0:.3f}s vectorized={1:.3f}s speedup={2:.1f}x'.format(t2-t1,t3-t2,(t2-t1)/(t3-t2)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+import time
+import datetime
+import numpy as np
+from ocgis.interface.nc.dimension import NcTemporalDimension
+
+
+def get_temporal(ndays):
+    start = datetime.datetime(1850,1,1,12)
+    value = np.array([start+datetime.timedelta(days=ii) for ii in range(ndays)])
+    bounds = np.column_stack((value-datetime.timedelta(hours=12),
+                              value+datetime.timedelta(hours=12)))
+    return(NcTemporalDimension(value=value,bounds=bounds))
+
+def main(ndays=55000,groupings=(['month'],['month','year'],['year','month','day'])):
+    temporal = get_temporal(ndays)
+    print('time steps={0}'.format(ndays))
+    for grouping in groupings:
+        t1 = time.time()
+        temporal.set_grouping(grouping)
+        t2 = time.time()
+        print('  {0}: groups={1} {2:.3f}s'.format(grouping,temporal.group.value.shape[0],t2-t1))
+
+
+if __name__ == '__main__':
+    main()
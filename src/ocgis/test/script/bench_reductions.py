@@ -0,0 +1,28 @@
+import time
+import numpy as np
+from ocgis.calc import library
+from ocgis.interface.base import TemporalGroupIndex
+
+
+def main(ndays=54750,shape=(10,10)):
+    ## 150 years of daily values grouped by month and year
+    np.random.seed(1)
+    values = np.ma.array(np.random.rand(ndays,1,shape[0],shape[1]),mask=False)
+    values.mask[:,:,0,0] = True
+    groups = TemporalGroupIndex(np.arange(ndays)//30)
+    print('time steps={0} groups={1} grid={2}'.format(ndays,len(groups),shape))
+    for klass,kwds in [(library.Mean,{}),(library.Max,{}),(library.StandardDeviation,{}),
+                       (library.Threshold,{'threshold':0.5,'operation':'gt'})]:
+        ## the boolean masks select the per-group fallback
+        masks = [groups.get_mask(idx) for idx in range(len(groups))]
+        t1 = time.time()
+        loop = klass(values=values,groups=masks,kwds=kwds).calculate()
+        t2 = time.time()
+        reduced = klass(values=values,groups=groups,kwds=kwds).calculate()
+        t3 = time.time()
+        assert(np.allclose(loop,reduced))
+        print('  {0:>18}: loop={1:.3f}s reductions={2:.3f}s speedup={3:.1f}x'.format(klass.__name__,t2-t1,t3-t2,(t2-t1)/(t3-t2)))
+
+
+if __name__ == '__main__':
+    main()
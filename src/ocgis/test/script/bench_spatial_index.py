@@ -0,0 +1,47 @@
+import time
+import itertools
+import numpy as np
+from shapely.geometry.polygon import Polygon
+from shapely.geometry.point import Point
+from ocgis.util.helpers import make_poly
+from ocgis.util.spatial import index as si
+
+
+def get_target(nvertices):
+    ## a star with a varying number of vertices spanning roughly 60 degrees
+    angles = np.linspace(0,2*np.pi,nvertices,endpoint=False)
+    radius = 30.0 + 8.0*np.sin(angles*11)
+    return(Polygon(zip(radius*np.cos(angles)-100.0,radius*np.sin(angles)+40.0)))
+
+def get_cells(target,resolution):
+    minx,miny,maxx,maxy = target.bounds
+    rows = np.arange(miny,maxy+resolution,resolution)
+    cols = np.arange(minx,maxx+resolution,resolution)
+    for ii,jj in itertools.product(range(rows.shape[0]-1),range(cols.shape[0]-1)):
+        yield(make_poly(rows[ii:ii+2],cols[jj:jj+2]),(cols[jj],rows[ii],cols[jj+1],rows[ii+1]))
+
+def main(nvertices=(100,1000,10000),resolution=1.0,npoints=5000):
+    np.random.seed(1)
+    for n in nvertices:
+        target = get_target(n)
+        cells = list(get_cells(target,resolution))
+        minx,miny,maxx,maxy = target.bounds
+        points = [Point(x,y) for x,y in zip(np.random.uniform(minx,maxx,npoints),
+                                             np.random.uniform(miny,maxy,npoints))]
+        print('vertices={0} cells={1} points={2}'.format(n,len(cells),len(points)))
+        results = {}
+        for method in ['grid','quadtree']:
+            t1 = time.time()
+            index = si.get_spatial_index(target,method=method)
+            t2 = time.time()
+            keep = [index.keep(cell,bounds=cell_bounds) for cell,cell_bounds in cells]
+            t3 = time.time()
+            intersects = [index.intersects(point,bounds=(point.x,point.y,point.x,point.y)) for point in points]
+            t4 = time.time()
+            results[method] = (keep,intersects)
+            print('  {0:>8}: build={1:.3f}s keep={2:.3f}s intersects={3:.3f}s'.format(method,t2-t1,t3-t2,t4-t3))
+        assert(results['grid'] == results['quadtree'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,27 @@
+import time
+import numpy as np
+import netCDF4 as nc
+from ocgis.interface.nc.dimension import NcTemporalDimension
+
+
+def main(ndays=55000,units='days since 1850-01-01 00:00:00',calendars=('standard','noleap')):
+    value = np.arange(ndays,dtype=float)+0.5
+    bounds = np.column_stack((value-0.5,value+0.5))
+    print('time steps={0}'.format(ndays))
+    for calendar in calendars:
+        t1 = time.time()
+        decoded = nc.num2date(value,units,calendar=calendar)
+        NcTemporalDimension._to_datetime_(decoded)
+        decoded = nc.num2date(bounds,units,calendar=calendar)
+        NcTemporalDimension._to_datetime_(decoded)
+        t2 = time.time()
+        temporal = NcTemporalDimension(value=value,bounds=bounds,units=units,calendar=calendar)
+        temporal.set_grouping(['month','year'])
+        t3 = time.time()
+        temporal.value,temporal.bounds
+        t4 = time.time()
+        print('  {0}: num2date={1:.3f}s numeric grouping={2:.3f}s decode={3:.3f}s'.format(calendar,t2-t1,t3-t2,t4-t3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+import time
+import numpy as np
+from ocgis.util.helpers import make_poly, get_weighted_average
+from ocgis.util.spatial.zonal import get_sparse_weights
+
+
+def get_geoms(ngeoms,extent,size):
+    ## randomly placed boxes standing in for counties
+    minx,miny,maxx,maxy = extent
+    x = np.random.uniform(minx,maxx-size,ngeoms)
+    y = np.random.uniform(miny,maxy-size,ngeoms)
+    return([make_poly((yy,yy+size),(xx,xx+size)) for xx,yy in zip(x,y)])
+
+def get_aggregate_loop(value,weights):
+    ## aggregate each geometry separately on its own window of the data
+    ret = np.ma.empty((value.shape[0],value.shape[1],len(weights)),dtype=float)
+    ncol = value.shape[3]
+    for idx in range(len(weights)):
+        indices,data = weights.get_row(idx)
+        ii,jj = indices//ncol,indices%ncol
+        rslc,cslc = slice(ii.min(),ii.max()+1),slice(jj.min(),jj.max()+1)
+        dense = np.ma.array(np.zeros((rslc.stop-rslc.start,cslc.stop-cslc.start)),mask=True)
+        dense[ii-rslc.start,jj-cslc.start] = data
+        ret[:,:,idx] = get_weighted_average(value[:,:,rslc,cslc],dense)[:,:,0,0]
+    return(ret)
+
+def main(ngeoms=3000,shape=(250,600),ntime=365):
+    np.random.seed(1)
+    row_bounds = np.column_stack((np.arange(shape[0])*0.1+25,np.arange(1,shape[0]+1)*0.1+25))
+    col_bounds = np.column_stack((np.arange(shape[1])*0.1-125,np.arange(1,shape[1]+1)*0.1-125))
+    geoms = get_geoms(ngeoms,(-125,25,-65,50),0.6)
+    value = np.ma.array(np.random.rand(ntime,1,shape[0],shape[1]),mask=False)
+    print('geometries={0} grid={1} time steps={2}'.format(ngeoms,shape,ntime))
+    
+    t1 = time.time()
+    weights = get_sparse_weights(geoms,row_bounds,col_bounds,spatial_operation='clip')
+    t2 = time.time()
+    loop = get_aggregate_loop(value,weights)
+    t3 = time.time()
+    sparse = weights.average(value)
+    t4 = time.time()
+    
+    assert(np.allclose(loop,sparse))
+    print('  weights={0:.3f}s loop={1:.3f}s sparse={2:.3f}s'.format(t2-t1,t3-t2,t4-t3))
+
+
+if __name__ == '__main__':
+    main()
@@ -9,6 +9,10 @@ from ocgis.test.base import TestBase
 from unittest.case import SkipTest
 import netCDF4 as nc
 import subprocess
+from ocgis.interface.base import TemporalGroupIndex
+from ocgis.calc.reduction import get_reductions, ReductionAccumulator,\
+    get_sorted_groups
+from ocgis.util.helpers import get_nan_filled
 
 
 class Test(TestBase):
@@ -87,6 +91,94 @@ class Test(TestBase):
         mean = library.Mean(values=values,agg=agg,weights=weights,groups=groups)
         ret = mean.calculate()
         
+    def test_reductions(self):
+        np.random.seed(1)
+        values = np.ma.array(np.random.rand(40,2,3,3)*10,mask=False)
+        values.mask[3,0,1,1] = True
+        values.mask[:,1,2,2] = True
+        values.mask[0:10,0,0,0] = True
+        ## contiguous and non-contiguous groups
+        for group_ids in [np.repeat(np.arange(4),10),np.arange(40) % 3]:
+            groups = TemporalGroupIndex(group_ids)
+            masks = [groups.get_mask(idx) for idx in range(len(groups))]
+            for klass,kwds in [(library.Mean,{}),(library.Max,{}),(library.Min,{}),
+                               (library.StandardDeviation,{}),
+                               (library.Between,{'lower':2,'upper':7}),
+                               (library.Threshold,{'threshold':5,'operation':'gte'})]:
+                for agg in [False,True]:
+                    weights = np.ma.array(np.random.rand(3,3),mask=False)
+                    ref = klass(values=values,groups=groups,kwds=kwds,agg=agg,weights=weights)
+                    self.assertTrue(ref._use_reductions_())
+                    ret = ref.calculate()
+                    actual = klass(values=values,groups=masks,kwds=kwds,agg=agg,weights=weights).calculate()
+                    self.assertEqual(ret.dtype,actual.dtype)
+                    self.assertTrue(np.all(ret.mask == actual.mask))
+                    self.assertTrue(np.allclose(ret.compressed(),actual.compressed()))
+        
+    def test_reduction_accumulator(self):
+        np.random.seed(2)
+        values = np.ma.array(np.random.rand(40,2,3,3)*10,mask=False)
+        values.mask[3,0,1,1] = True
+        values.mask[:,1,2,2] = True
+        reductions = ('count','sum','min','max','ssd')
+        for group_ids in [np.repeat(np.arange(4),10),np.arange(40) % 3]:
+            groups = TemporalGroupIndex(group_ids)
+            actual = get_reductions(values,groups,reductions)
+            for block_size in [1,7,40]:
+                accumulator = ReductionAccumulator(groups,reductions)
+                finalized = []
+                for start in range(0,40,block_size):
+                    finalized += accumulator.update(values[start:start+block_size]).tolist()
+                    ## only a group spanning the next block is held
+                    if groups.is_contiguous:
+                        self.assertTrue(len(accumulator._active) <= 1)
+                self.assertTrue(accumulator.is_complete)
+                self.assertEqual(sorted(finalized),range(len(groups)))
+                ret = accumulator.get_reductions()
+                for name in reductions:
+                    self.assertTrue(np.all(ret[name].mask == actual[name].mask))
+                    self.assertTrue(np.allclose(ret[name].compressed(),actual[name].compressed()))
+        ## contiguous groups are finalized with their last block
+        accumulator = ReductionAccumulator(TemporalGroupIndex(np.repeat(np.arange(4),10)),('sum',))
+        self.assertEqual(accumulator.update(values[0:15]).tolist(),[0])
+        self.assertEqual(accumulator._active.keys(),[1])
+        with self.assertRaises(ValueError):
+            accumulator.get_reductions()
+        
+    def test_MaxConsecutive(self):
+        np.random.seed(3)
+        values = np.ma.array(np.random.rand(50,2,3,4),mask=False)
+        values.mask[7,0,1,1] = True
+        values.mask[:,1,2,2] = True
+        values[0:20,0,0,0] = 0.9
+        values[20,0,0,0] = 0.1
+        ## longest sequence with a python loop over the elements
+        def get_expected(values,threshold):
+            ret = np.zeros(values.shape[1:],dtype=int)
+            for idx in np.ndindex(*values.shape[1:]):
+                run = 0
+                for tidx in range(values.shape[0]):
+                    value = values[(tidx,)+idx]
+                    if value is not np.ma.masked and value > threshold:
+                        run += 1
+                    else:
+                        run = 0
+                    ret[idx] = max(ret[idx],run)
+            return(ret)
+        kwds = {'threshold':0.5,'operation':'gt'}
+        ret = library.MaxConsecutive._calculate_(values,**kwds)
+        self.assertTrue(np.all(ret == get_expected(values,0.5)))
+        self.assertEqual(ret[0,0,0],20)
+        self.assertEqual(ret[1,2,2],0)
+        ## calculated for each temporal group
+        groups = TemporalGroupIndex(np.repeat(np.arange(5),10))
+        ret = library.MaxConsecutive(values=values,groups=groups,kwds=kwds).calculate()
+        self.assertEqual(ret.shape,(5,2,3,4))
+        self.assertEqual(ret.dtype,int)
+        for idx in range(5):
+            self.assertTrue(np.all(ret[idx] == get_expected(values[groups[idx]],0.5)))
+        self.assertEqual(ret[0:2,0,0,0].tolist(),[10,10])
+        
     def test_computational_nc_output(self):
         rd = self.test_data.get_rd('cancm4_tasmax_2011',kwds={'time_range':[datetime.datetime(2011,1,1),datetime.datetime(2011,12,31)]})
         calc = [{'func':'mean','name':'tasmax_mean'}]
@@ -141,6 +233,109 @@ class Test(TestBase):
         ret = cseq[idx,:,:,:]
         self.assertAlmostEqual(5.1832553259829295,ret.sum())
 
+    def test_sorted_percentiles(self):
+        np.random.seed(5)
+        values = np.ma.array(np.random.normal(size=(31,2,2,2)),mask=False)
+        values.mask[0:10,0,0,0] = True
+        values.mask[:,1,1,1] = True
+        groups = TemporalGroupIndex(np.arange(31) % 2)
+        sorted_groups = get_sorted_groups(values,groups)
+        self.assertEqual(len(sorted_groups),2)
+        for klass,kwds,perc in [(library.FrequencyPercentile,{'perc':95},95),
+                                (library.FrequencyPercentile,{'perc':5},5),
+                                (library.Median,{},50)]:
+            for shared in [None,sorted_groups]:
+                ret = klass(values=values,groups=groups,kwds=kwds).calculate(sorted_groups=shared)
+                for gidx,group in enumerate(groups):
+                    for idx in np.ndindex(2,2,2):
+                        sel = values[(group,)+idx]
+                        if sel.count() == 0:
+                            self.assertTrue(ret.mask[(gidx,)+idx])
+                        else:
+                            ## masked values are excluded
+                            self.assertAlmostEqual(ret[(gidx,)+idx],np.percentile(sel.compressed(),perc))
+        ## the median matches the masked median
+        actual = np.ma.median(values[groups[0]],axis=0)
+        ret = library.Median(values=values,groups=groups).calculate()
+        self.assertTrue(np.all(ret[0].mask == actual.mask))
+        self.assertTrue(np.allclose(ret[0].compressed(),actual.compressed()))
+        
+
+class TestNanCalculation(TestBase):
+    '''Functions calculated from float values with nan for masked values
+    match the masked calculations.'''
+    
+    def get_values(self,dtype=float):
+        np.random.seed(4)
+        values = np.ma.array(np.random.rand(36,2,3,3)*10,mask=False).astype(dtype)
+        values.mask[3,0,1,1] = True
+        values.mask[:,1,2,2] = True
+        values.mask[0:12,0,0,0] = True
+        return(values)
+    
+    def get_groups(self):
+        ## masks as opposed to a group index evaluate each group separately
+        return([np.arange(36) // 12 == idx for idx in range(3)])
+    
+    def assertCalculationEqual(self,klass,values,groups,agg=False,kwds={}):
+        weights = np.ma.array(np.random.rand(3,3),mask=False)
+        actual = klass(values=values,groups=groups,agg=agg,weights=weights,kwds=kwds).calculate()
+        ref = klass(values=get_nan_filled(values),groups=groups,agg=agg,weights=weights,kwds=kwds)
+        self.assertTrue(ref._use_nan_())
+        ret = ref.calculate()
+        self.assertIsInstance(ret,np.ma.MaskedArray)
+        self.assertEqual(ret.dtype,actual.dtype)
+        self.assertTrue(np.all(ret.mask == actual.mask))
+        self.assertTrue(np.allclose(ret.compressed(),actual.compressed()))
+    
+    def test_functions(self):
+        klasses = [library.Mean,library.Max,library.Min,library.StandardDeviation]
+        for klass in klasses:
+            self.assertTrue(klass._has_nan_kernel_())
+            for agg in [False,True]:
+                self.assertCalculationEqual(klass,self.get_values(),self.get_groups(),agg=agg)
+        for operation in ['gt','lt','gte','lte']:
+            kwds = {'threshold':5,'operation':operation}
+            self.assertCalculationEqual(library.MaxConsecutive,self.get_values(),
+                                        self.get_groups(),kwds=kwds)
+        self.assertFalse(library.SampleSize._has_nan_kernel_())
+        self.assertFalse(library.Median._has_nan_kernel_())
+        
+    def test_integer_values(self):
+        values = self.get_values(dtype=int)
+        filled = get_nan_filled(values)
+        self.assertEqual(filled.dtype,float)
+        self.assertTrue(np.isnan(filled[3,0,1,1]))
+        self.assertCalculationEqual(library.Mean,values,self.get_groups())
+        
+    def test_all_masked_group(self):
+        ## the first group of the first cell is entirely masked
+        values = self.get_values()
+        ret = library.Mean(values=get_nan_filled(values),groups=self.get_groups()).calculate()
+        self.assertTrue(ret.mask[0,0,0,0])
+        self.assertFalse(ret.mask[1,0,0,0])
+        self.assertCalculationEqual(library.Max,values,self.get_groups())
+        
+    def test_multivariate(self):
+        np.random.seed(5)
+        tas = np.ma.array(290+np.random.rand(36,1,3,3)*20,mask=False)
+        rhs = np.ma.array(np.random.rand(36,1,3,3)*100,mask=False)
+        tas.mask[0:12,0,0,0] = True
+        rhs.mask[5,0,1,1] = True
+        self.assertTrue(library.HeatIndex._has_nan_kernel_())
+        for groups in [self.get_groups(),None]:
+            kwds = {'tas':tas.copy(),'rhs':rhs.copy(),'units':'k'}
+            actual = library.HeatIndex(groups=groups,kwds=kwds).calculate()
+            kwds = {'tas':get_nan_filled(tas),'rhs':get_nan_filled(rhs),'units':'k'}
+            ref = library.HeatIndex(groups=groups,kwds=kwds)
+            self.assertTrue(ref._use_nan_())
+            ret = ref.calculate()
+            self.assertIsInstance(ret,np.ma.MaskedArray)
+            self.assertEqual(ret.shape,actual.shape)
+            self.assertTrue(np.all(ret.mask == actual.mask))
+            self.assertTrue(np.allclose(ret.compressed(),actual.compressed()))
+        
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
\ No newline at end of file
@@ -9,11 +9,15 @@ from ocgis.util.shp_cabinet import ShpCabinet
 from ocgis.interface.shp import ShpDataset
 from shapely.geometry.point import Point
 from ocgis.interface.nc.dimension import NcRowDimension, NcColumnDimension,\
-    NcGridDimension, NcSpatialDimension, NcPolygonDimension, NcPointDimension
+    NcGridDimension, NcSpatialDimension, NcPolygonDimension, NcPointDimension,\
+    NcTemporalDimension
 from ocgis.interface.nc.dataset import NcDataset
 from shapely.geometry.multipolygon import MultiPolygon
 from ocgis.interface.geometry import GeometryDataset
 from ocgis import env
+from ocgis.exc import EmptyData
+from ocgis.interface.nc.multifile import NcFileIndex
+from ocgis.api.request import RequestDataset
 import os.path
 
 
@@ -178,6 +182,182 @@ class TestNcDataset(TestBase):
         for row in ods.temporal.group.get_iter():
             pass
         
+    def test_temporal_group_ids(self):
+        start = datetime.datetime(1990,12,30,12)
+        value = np.array([start+datetime.timedelta(days=ii) for ii in range(800)])
+        bounds = np.column_stack((value-datetime.timedelta(hours=12),
+                                  value+datetime.timedelta(hours=12)))
+        temporal = NcTemporalDimension(value=value,bounds=bounds)
+        temporal.set_grouping(['month','year'])
+        group = temporal.group
+        self.assertEqual(group.value.shape[0],28)
+        self.assertEqual(group.value[0,0:3].tolist(),[1990,12,None])
+        self.assertEqual(group.value[1,0:3].tolist(),[1991,1,None])
+        self.assertEqual(group.bounds[1].tolist(),[datetime.datetime(1991,1,1),datetime.datetime(1991,2,1)])
+        ## groups of contiguous time steps are slices
+        self.assertTrue(group.dgroups.is_contiguous)
+        for idx,dgrp in enumerate(group.dgroups):
+            self.assertIsInstance(dgrp,slice)
+            self.assertTrue(np.all(group.dgroups.get_mask(idx) == (group.group_ids == idx)))
+            for dt in value[dgrp]:
+                self.assertEqual((dt.year,dt.month),tuple(group.value[idx,0:2]))
+        temporal.set_grouping(['month'])
+        self.assertEqual(temporal.group.value[:,1].tolist(),range(1,13))
+        self.assertFalse(temporal.group.dgroups.is_contiguous)
+        january = temporal.group.dgroups[0]
+        self.assertEqual(january.shape[0],93)
+        self.assertTrue(np.all(np.diff(january) > 0))
+        self.assertEqual(set([dt.month for dt in value[january]]),set([1]))
+        self.assertEqual(temporal.group.bounds[0].tolist(),[datetime.datetime(1991,1,1),datetime.datetime(1993,2,1)])
+
+    def test_temporal_decode(self):
+        np.random.seed(1)
+        value = np.sort(np.random.rand(500)*60000)
+        for units in ['days since 1850-01-01','hours since 1950-1-1 06:00:00','days since 2001-03-15T12:30:00Z']:
+            for calendar in ['standard','proleptic_gregorian','noleap','365_day','360_day']:
+                num = value*24 if units.startswith('hours') else value
+                decoded = nc.num2date(num,units,calendar=calendar)
+                parts = np.array([[d.year,d.month,d.day,d.hour,d.minute,d.second] for d in decoded])
+                temporal = NcTemporalDimension(value=num,bounds=np.column_stack((num-0.5,num+0.5)),
+                                               units=units,calendar=calendar)
+                ## the times are decoded on access
+                self.assertIsNone(temporal._value)
+                self.assertEqual(temporal.shape,(500,))
+                self.assertTrue(np.all(temporal.get_date_parts()[:,0:6] == parts))
+                ## slices keep the numeric values
+                sub = temporal[10:20]
+                self.assertTrue(np.all(sub.value_num == num[10:20]))
+                self.assertTrue(np.all(sub.real_idx == np.arange(10,20)))
+                if calendar == '360_day':
+                    continue
+                expected = [datetime.datetime(*row) for row in parts]
+                self.assertEqual(temporal.value.tolist(),expected)
+                self.assertIsInstance(temporal.value[0],datetime.datetime)
+                self.assertEqual(sub.value.tolist(),expected[10:20])
+                ## grouping matches the grouping of datetime objects
+                temporal.set_grouping(['month','year'])
+                actual = NcTemporalDimension(value=temporal.value,bounds=temporal.bounds)
+                actual.set_grouping(['month','year'])
+                self.assertTrue(np.all(temporal.group.group_ids == actual.group.group_ids))
+                self.assertEqual(temporal.group.bounds.tolist(),actual.group.bounds.tolist())
+        ## unknown units are decoded by netCDF4
+        temporal = NcTemporalDimension(value=np.array([1.,2.]),units='days since 2000-01-01 00:00:00 -06:00',
+                                       calendar='standard')
+        self.assertEqual(temporal.value[0],datetime.datetime(2000,1,2,6))
+        ## origins before the gregorian calendar start are julian dates
+        for units in ['hours since 1-1-1 00:00:0.0','days since 0001-01-01']:
+            for calendar in ['standard','gregorian']:
+                dates = [datetime.datetime(2000,1,1),datetime.datetime(2000,2,15,12)]
+                num = nc.date2num(dates,units,calendar=calendar)
+                expected = [datetime.datetime(d.year,d.month,d.day,d.hour) for d in nc.num2date(num,units,calendar=calendar)]
+                self.assertEqual(expected,dates)
+                temporal = NcTemporalDimension(value=num,units=units,calendar=calendar)
+                self.assertEqual(temporal.value.tolist(),expected)
+                self.assertEqual(temporal.get_date_parts()[:,0:4].tolist(),[[2000,1,1,0],[2000,2,15,12]])
+                sub = temporal.subset(datetime.datetime(2000,1,1),datetime.datetime(2000,1,31))
+                self.assertEqual(sub.value.tolist(),expected[0:1])
+
+    def test_temporal_subset(self):
+        units = 'days since 1950-01-01 00:00:00'
+        num = np.arange(3650,dtype=float)+0.5
+        ranges = [(datetime.datetime(1951,3,1),datetime.datetime(1952,2,28,23,59,59)),
+                  (datetime.datetime(1951,3,1,12),datetime.datetime(1951,3,1,12)),
+                  (datetime.datetime(1940,1,1),datetime.datetime(1950,1,10)),
+                  (datetime.datetime(1959,12,1),datetime.datetime(1970,1,1))]
+        for bounds in [np.column_stack((num-0.5,num+0.5)),None]:
+            for calendar in ['standard','noleap']:
+                temporal = NcTemporalDimension(value=num,bounds=bounds,units=units,calendar=calendar)
+                ## the datetime comparison of the decoded times
+                decoded = NcTemporalDimension(value=temporal.value,bounds=temporal.bounds,
+                                              units=units,calendar=calendar)
+                temporal = NcTemporalDimension(value=num,bounds=bounds,units=units,calendar=calendar)
+                for lower,upper in ranges:
+                    sub = temporal.subset(lower,upper)
+                    actual = decoded.subset(lower,upper)
+                    ## only the window is decoded
+                    self.assertIsNone(temporal._value)
+                    self.assertIsNone(sub._value)
+                    self.assertTrue(np.all(sub.real_idx == actual.real_idx))
+                    self.assertEqual(sub.value.tolist(),actual.value.tolist())
+                    self.assertEqual(sub.units,units)
+                    if bounds is not None:
+                        self.assertEqual(sub.bounds.tolist(),actual.bounds.tolist())
+                lower,upper = datetime.datetime(1900,1,1),datetime.datetime(1901,1,1)
+                if bounds is None:
+                    self.assertEqual(temporal.subset(lower,upper).shape,(0,))
+                else:
+                    with self.assertRaises(EmptyData):
+                        temporal.subset(lower,upper)
+        ## times that are not increasing are compared as datetime objects
+        temporal = NcTemporalDimension(value=num[::-1].copy(),units=units,calendar='standard')
+        sub = temporal.subset(*ranges[0])
+        self.assertEqual(sub.shape,(365,))
+        self.assertIsNone(sub.value_num)
+
+    def test_multifile(self):
+        ## three years of daily data in one file per year. the last file uses
+        ## different time units.
+        uris = []
+        tas = []
+        for year in [2001,2002,2003]:
+            units = 'days since 2001-01-01 00:00:00' if year < 2003 else 'hours since 2003-01-01 00:00:00'
+            start = (datetime.datetime(year,1,1)-datetime.datetime(2001,1,1)).days
+            uri = os.path.join(self._new_dir,'tas_{0}.nc'.format(year))
+            ds = nc.Dataset(uri,'w')
+            ds.createDimension('time',None)
+            ds.createDimension('bnds',2)
+            ds.createDimension('lat',3)
+            ds.createDimension('lon',4)
+            time = ds.createVariable('time',float,('time',))
+            time.axis = 'T'
+            time.units = units
+            time.calendar = 'noleap'
+            time.bounds = 'time_bnds'
+            time_bnds = ds.createVariable('time_bnds',float,('time','bnds'))
+            num = np.arange(365,dtype=float)+0.5
+            bounds = np.column_stack((num-0.5,num+0.5))
+            if year == 2003:
+                num,bounds = num*24,bounds*24
+            else:
+                num,bounds = num+start,bounds+start
+            time[:] = num
+            time_bnds[:] = bounds
+            for name,axis,value in [('lat','Y',[40.,41.,42.]),('lon','X',[250.,251.,252.,253.])]:
+                var = ds.createVariable(name,float,(name,))
+                var.axis = axis
+                var[:] = value
+            var = ds.createVariable('tas',float,('time','lat','lon'))
+            value = np.random.rand(365,3,4)+start
+            var[:] = value
+            tas.append(value)
+            ds.close()
+            uris.append(uri)
+        tas = np.concatenate(tas)
+        
+        rd = RequestDataset(uri=uris,variable='tas')
+        ods = NcDataset(request_dataset=rd)
+        self.assertEqual(ods.temporal.shape,(365*3,))
+        self.assertEqual(ods.temporal.value[-1],datetime.datetime(2003,12,31,12))
+        self.assertEqual(ods.metadata['dimensions']['time']['len'],365*3)
+        ## only the files overlapping the time range are read
+        sods = ods.get_subset(temporal=[datetime.datetime(2002,12,1),datetime.datetime(2003,1,31,23,59)])
+        self.assertEqual(sods.value.shape,(62,1,3,4))
+        self.assertTrue(np.all(sods.value.data[:,0,:,:] == tas[699:761]))
+        self.assertEqual(sorted(sods._ds._files),[0,1,2])
+        ods = NcDataset(request_dataset=rd)
+        sods = ods.get_subset(temporal=[datetime.datetime(2002,3,1),datetime.datetime(2002,3,31,23,59)])
+        self.assertTrue(np.all(sods.value.data[:,0,:,:] == tas[424:455]))
+        self.assertEqual(sorted(sods._ds._files),[0,1])
+        ## the time index is built once
+        read_entry = NcFileIndex._read_entry_
+        try:
+            NcFileIndex._read_entry_ = None
+            index = NcFileIndex(uris,'time',['time','time_bnds'],
+                                units='days since 2001-01-01 00:00:00',calendar='noleap')
+        finally:
+            NcFileIndex._read_entry_ = read_entry
+        self.assertEqual(index.offsets.tolist(),[0,365,730,1095])
+
     def test_slice(self):
         rd = self.test_data.get_rd('cancm4_tas')
         ods = NcDataset(request_dataset=rd)
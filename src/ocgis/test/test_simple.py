@@ -2,6 +2,9 @@ import unittest
 from ocgis.test.make_test_data import SimpleNc, SimpleMaskNc, SimpleNc360
 from ocgis.api.operations import OcgOperations
 from ocgis.api.interpreter import OcgInterpreter
+from ocgis.api.subset import SubsetOperation
+from ocgis.api.estimate import RequestEstimate
+from ocgis.calc import library
 import itertools
 import numpy as np
 import datetime
@@ -15,6 +18,7 @@ from ocgis.test.base import TestBase
 import subprocess
 from unittest.case import SkipTest
 from shapely.geometry.point import Point
+from ocgis.interface.shp import ShpDataset, ShpSpatialDimension
 
 
 class TestSimpleBase(TestBase):
@@ -60,6 +64,13 @@ class TestSimpleBase(TestBase):
         
         return(ret)
     
+    def get_shp_dataset(self,polygons):
+        geoms = np.empty(len(polygons),dtype=object)
+        for idx,polygon in enumerate(polygons):
+            geoms[idx] = polygon
+        uid = np.arange(1,len(polygons)+1,dtype=int)
+        return(ShpDataset(spatial=ShpSpatialDimension(uid,geoms)))
+        
     def make_shp(self):
         ops = OcgOperations(dataset=self.dataset,
                             output_format='shp')
@@ -198,6 +209,125 @@ class TestSimple(TestSimpleBase):
         self.assertEqual(ref.variables[self.var].spatial.vector.geom.flatten()[0].area,1.0)
         self.assertEqual(ref.variables[self.var].value.flatten().mean(),2.5)
         
+    def test_parallel(self):
+        polygons = [make_poly((37.5,39.5),(-104.5,-102.5)),
+                    make_poly((38,39),(-104,-103)),
+                    make_poly((39.5,40.5),(-105.5,-103.5))]
+        serial = self.get_ret(kwds={'geom':self.get_shp_dataset(polygons)})
+        env.SERIAL = False
+        env.CORES = 2
+        for ordered in [True,False]:
+            env.ORDERED = ordered
+            parallel = self.get_ret(kwds={'geom':self.get_shp_dataset(polygons)})
+            self.assertEqual(set(parallel.keys()),set([1,2,3]))
+            for ugid,coll in serial.iteritems():
+                value = coll.variables[self.var].value
+                pvalue = parallel[ugid].variables[self.var].value
+                self.assertTrue(np.all(value == pvalue))
+                self.assertTrue(np.all(value.mask == pvalue.mask))
+                
+        ## errors are reported with the failed selection geometry
+        polygons.append(make_poly((20,25),(-90,-80)))
+        with self.assertRaises(exc.SubsetGeometryError) as cm:
+            self.get_ret(kwds={'geom':self.get_shp_dataset(polygons)})
+        self.assertEqual(cm.exception.ugid,4)
+        self.assertIn('ExtentError',cm.exception.msg)
+        
+    def test_shared_read(self):
+        polygons = [make_poly((37.5,39.5),(-104.5,-102.5)),
+                    make_poly((38,40),(-104,-103)),
+                    make_poly((38.5,39.5),(-103.5,-102.5))]
+        ret = self.get_ret(kwds={'geom':self.get_shp_dataset(polygons)})
+        ## values are views on the shared read
+        self.assertTrue(np.may_share_memory(ret[1].variables[self.var].value.data,
+                                            ret[2].variables[self.var].value.data))
+        ## the shared read is released once the collections are returned
+        self.assertEqual(self.ops.dataset[self.var].ds._hyperslab,None)
+        
+        ops = self.get_ops(kwds={'geom':self.get_shp_dataset(polygons)})
+        ods = ops.dataset[self.var].ds
+        so = SubsetOperation(ops,serial=True)
+        ## the read is planned when iteration starts
+        self.assertEqual(ods._hyperslab,None)
+        it = iter(so)
+        it.next()
+        self.assertNotEqual(ods._hyperslab,None)
+        self.assertEqual(len(list(it)),2)
+        self.assertEqual(ods._hyperslab,None)
+        ## reads are not shared by worker processes
+        so = SubsetOperation(ops,serial=False,nprocs=2)
+        it = iter(so)
+        it.next()
+        self.assertEqual(ods._hyperslab,None)
+        self.assertEqual(len(list(it)),2)
+        
+        ## a read that is not shared replaces a previous plan
+        so._plan_hyperslabs_()
+        self.assertNotEqual(ods._hyperslab,None)
+        env.SHARED_READ_LIMIT = 0
+        so._plan_hyperslabs_()
+        self.assertEqual(ods._hyperslab,None)
+        ret_unshared = self.get_ret(kwds={'geom':self.get_shp_dataset(polygons)})
+        self.assertFalse(np.may_share_memory(ret_unshared[1].variables[self.var].value.data,
+                                             ret_unshared[2].variables[self.var].value.data))
+        for ugid,coll in ret.iteritems():
+            value = coll.variables[self.var].value
+            value_unshared = ret_unshared[ugid].variables[self.var].value
+            self.assertEqual(value.shape,value_unshared.shape)
+            self.assertTrue(np.all(value == value_unshared))
+            self.assertTrue(np.all(value.mask == value_unshared.mask))
+        
+    def test_zonal_aggregate(self):
+        polygons = [make_poly((37.5,39.5),(-104.5,-102.5)),
+                    make_poly((38.2,39.7),(-103.8,-102.6)),
+                    make_poly((37.2,38.4),(-104.9,-103.1)),
+                    make_poly((20,25),(-90,-80))]
+        for spatial_operation in ['intersects','clip']:
+            kwds = {'aggregate':True,'spatial_operation':spatial_operation,
+                    'allow_empty':True}
+            env.ZONAL_AGGREGATE = False
+            kwds['geom'] = self.get_shp_dataset(polygons)
+            ret = self.get_ret(kwds=kwds)
+            env.ZONAL_AGGREGATE = True
+            kwds['geom'] = self.get_shp_dataset(polygons)
+            ret_zonal = self.get_ret(kwds=kwds)
+            ## all the geometries are aggregated in a single pass when
+            ## iteration starts
+            so = SubsetOperation(self.ops)
+            self.assertEqual(so._zonal,{})
+            it = iter(so)
+            it.next()
+            zonal = so._zonal[self.var]
+            self.assertEqual(set(zonal.keys()),set([1,2,3,4]))
+            self.assertEqual(zonal[4],None)
+            ## the aggregates are released once iteration finishes
+            self.assertEqual(len(list(it)),3)
+            self.assertEqual(so._zonal,{})
+            for ugid in [1,2,3]:
+                ref = ret[ugid].variables[self.var]
+                ref_zonal = ret_zonal[ugid].variables[self.var]
+                self.assertEqual(ref.value.shape,ref_zonal.value.shape)
+                self.assertTrue(np.allclose(ref.value,ref_zonal.value))
+                self.assertEqual(ref_zonal.spatial.vector.uid[0,0],ugid)
+                self.assertAlmostEqual(ref.spatial.vector.geom[0,0].area,
+                                       ref_zonal.spatial.vector.geom[0,0].area)
+            self.assertEqual(len(ret_zonal[4].variables),0)
+            
+        ## blocks of time steps are limited by env.STREAM_BLOCK_LIMIT
+        env.SHARED_READ_LIMIT = 0
+        ods = self.ops.dataset[self.var].ds
+        reads = []
+        get_numpy_data = ods._get_numpy_data_
+        def _get_numpy_data_(*args,**kwds):
+            reads.append(args)
+            return(get_numpy_data(*args,**kwds))
+        ods._get_numpy_data_ = _get_numpy_data_
+        SubsetOperation(self.ops)._get_zonal_aggregates_()
+        self.assertEqual(len(reads),1)
+        env.STREAM_BLOCK_LIMIT = 0
+        SubsetOperation(self.ops)._get_zonal_aggregates_()
+        self.assertEqual(len(reads),1+ods.temporal.shape[0])
+
     def test_empty_intersection(self):
         geom = make_poly((20,25),(-90,-80))
         
@@ -218,6 +348,29 @@ class TestSimple(TestSimpleBase):
         ref = ret[1].calc[self.var]['my_mean']
         self.assertEqual(ref.shape,(1,1,4,4))
         
+    def test_snippet_prefix(self):
+        calc = [{'func':'mean','name':'my_mean'}]
+        ## the first group in the time range
+        for group,time_range,n in [[['month'],None,31],[['year'],None,61],
+                                   [['month'],[datetime.datetime(2000,4,5),datetime.datetime(2000,4,30,23,59)],26]]:
+            ops = self.get_ops(kwds={'calc':calc,'calc_grouping':group,'snippet':True},
+                               time_range=time_range)
+            so = SubsetOperation(ops)
+            rd = ops.dataset[0]
+            ## only the time steps of the snippet are loaded
+            self.assertEqual(rd.ds.temporal.shape,(n,))
+            self.assertEqual(rd.ds.level.shape,(1,))
+            ret = OcgInterpreter(ops).execute()
+            ref = ret[1].calc[self.var]
+            self.assertEqual(ref['my_mean'].shape,(1,1,4,4))
+            self.assertTrue(np.all(ref['n'] == n))
+        ## no grouping loads a single time step
+        ops = self.get_ops(kwds={'snippet':True},time_range=time_range)
+        SubsetOperation(ops)
+        temporal = ops.dataset[0].ds.temporal
+        self.assertEqual(temporal.value.tolist(),[datetime.datetime(2000,4,5,12)])
+        self.assertEqual(temporal.real_idx.tolist(),[35])
+        
     def test_calc(self):
         calc = [{'func':'mean','name':'my_mean'}]
         group = ['month','year']
@@ -239,7 +392,199 @@ class TestSimple(TestSimpleBase):
             self.assertEqual(ref['n'].shape,(2,2,1,1))
             self.assertEqual(ref['my_mean'].shape,(2,2,1,1))
             self.assertEqual(ref['my_mean'].flatten().mean(),2.5)
+
+    def test_calc_shared_reductions(self):
+        from ocgis.calc import engine
+        calc = [{'func':'mean','name':'my_mean'},{'func':'min','name':'my_min'},
+                {'func':'max','name':'my_max'},{'func':'std','name':'my_std'}]
+        group = ['month']
+        ## count the passes over the values
+        calls = []
+        get_reductions = engine.get_reductions
+        def counted(*args,**kwds):
+            calls.append(args[2])
+            return(get_reductions(*args,**kwds))
+        engine.get_reductions = counted
+        try:
+            ret = self.get_ret(kwds={'calc':calc,'calc_grouping':group})
+        finally:
+            engine.get_reductions = get_reductions
+        self.assertEqual(calls,[('count','max','min','ssd','sum')])
+        ref = ret[1].calc[self.var]
+        self.assertEqual(ref.keys(),['my_mean','my_min','my_max','my_std','n'])
+        ## the functions calculated separately match
+        for c in calc:
+            actual = self.get_ret(kwds={'calc':[c],'calc_grouping':group})[1].calc[self.var][c['name']]
+            self.assertTrue(np.all(ref[c['name']].mask == actual.mask))
+            self.assertTrue(np.allclose(ref[c['name']],actual))
+
+    def test_calc_stream(self):
+        calc = [{'func':'mean','name':'my_mean'},{'func':'std','name':'my_std'},
+                {'func':'max','name':'my_max'},
+                {'func':'between','name':'my_between','kwds':{'lower':2,'upper':3}}]
+        geom = make_poly((37.5,39.5),(-104.5,-102.5))
+        for group in [['month'],['month','year'],['year']]:
+            kwds = {'calc':calc,'calc_grouping':group,'geom':geom}
+            actual = self.get_ret(kwds=kwds)[1].calc[self.var]
+            env.STREAM_CALC = True
+            ## blocks of a single time step
+            env.STREAM_BLOCK_LIMIT = 1e-6
+            try:
+                ret = self.get_ret(kwds=kwds)
+            finally:
+                env.STREAM_CALC = False
+            ## the value is never loaded
+            self.assertIsNone(ret[1].variables[self.var]._value)
+            ref = ret[1].calc[self.var]
+            self.assertEqual(ref.keys(),actual.keys())
+            for key in ref.keys():
+                self.assertEqual(ref[key].dtype,actual[key].dtype)
+                self.assertTrue(np.all(ref[key].mask == actual[key].mask))
+                self.assertTrue(np.allclose(ref[key],actual[key]))
+
+    def test_calc_percentiles(self):
+        from ocgis.calc import engine
+        calc = [{'func':'freq_perc','name':'p5','kwds':{'perc':5}},
+                {'func':'freq_perc','name':'p95','kwds':{'perc':95}},
+                {'func':'median','name':'my_median'}]
+        ## count the sorts of the values
+        calls = []
+        get_sorted_groups = engine.get_sorted_groups
+        def counted(*args,**kwds):
+            calls.append(1)
+            return(get_sorted_groups(*args,**kwds))
+        engine.get_sorted_groups = counted
+        try:
+            ret = self.get_ret(kwds={'calc':calc,'calc_grouping':['month']})
+        finally:
+            engine.get_sorted_groups = get_sorted_groups
+        self.assertEqual(len(calls),1)
+        ref = ret[1].calc[self.var]
+        for key in ['p5','p95','my_median']:
+            self.assertEqual(ref[key].shape,(2,2,4,4))
+        self.assertTrue(np.all(ref['p5'] <= ref['my_median']))
+        self.assertTrue(np.all(ref['my_median'] <= ref['p95']))
+
+    def test_estimate(self):
+        geom = make_poly((37.5,39.5),(-104.5,-102.5))
+        calc = [{'func':'mean','name':'my_mean'},{'func':'std','name':'my_std'}]
+        for kwds in [{},{'geom':geom},{'geom':geom,'aggregate':True},
+                     {'calc':calc,'calc_grouping':['month']},
+                     {'calc':calc,'calc_grouping':['month'],'geom':geom}]:
+            ops = self.get_ops(kwds=kwds)
+            estimate = RequestEstimate(ops)
+            ## the groups are counted from the numeric times
+            self.assertIsNone(ops.dataset[self.var].ds.temporal._value)
+            ret = self.get_ret(kwds=kwds)
+            ds = ret[1].variables[self.var]
+            value = ds.raw_value if kwds.get('aggregate') else ds.value
+            self.assertEqual(estimate.read,value.data.nbytes)
+            if 'calc' in kwds:
+                output = sum([v.data.nbytes for v in ret[1].calc[self.var].itervalues()])
+            else:
+                output = ds.value.data.nbytes
+            self.assertEqual(estimate.output,output)
+            self.assertTrue(estimate.get_memory() >= value.nbytes)
             
+    def test_estimate_geometries(self):
+        polygons = [make_poly((37.5,39.5),(-104.5,-102.5)),
+                    make_poly((38,40),(-104,-103)),
+                    make_poly((38.5,39.5),(-103.5,-102.5))]
+        kwds = {'geom':self.get_shp_dataset(polygons)}
+        ops = self.get_ops(kwds=kwds)
+        estimate = RequestEstimate(ops)
+        ## the shared read is held for the whole serial iteration
+        ods = ops.dataset[self.var].ds
+        it = iter(SubsetOperation(ops,serial=True))
+        it.next()
+        value = ods._hyperslab._value
+        list(it)
+        self.assertEqual(estimate._shared,value.data.nbytes+value.mask.nbytes)
+        self.assertEqual(estimate.get_memory(),max(estimate._memory)+estimate._shared)
+        ## reads are not shared by worker processes
+        env.CORES = 2
+        self.assertEqual(estimate.get_memory(serial=False),sum(sorted(estimate._memory)[-2:]))
+        env.MAX_MEMORY = (estimate.get_memory()-estimate._shared/2.0)/1024**2
+        with self.assertRaises(exc.MemoryLimitExceeded):
+            self.get_ret(kwds=kwds)
+        env.MAX_MEMORY = None
+        
+        ## the zonal aggregates are held for the whole iteration and the data
+        ## is read once for all geometries
+        env.ZONAL_AGGREGATE = True
+        kwds = {'geom':self.get_shp_dataset(polygons),'aggregate':True}
+        ops = self.get_ops(kwds=kwds)
+        estimate = RequestEstimate(ops)
+        self.assertEqual(estimate._shared,0)
+        ods = ops.dataset[self.var].ds
+        reads = []
+        get_numpy_data = ods._get_numpy_data_
+        def _get_numpy_data_(*args,**kwds):
+            ret = get_numpy_data(*args,**kwds)
+            reads.append(ret.data.nbytes)
+            return(ret)
+        ods._get_numpy_data_ = _get_numpy_data_
+        so = SubsetOperation(ops)
+        so._get_zonal_aggregates_()
+        self.assertEqual(estimate.read,sum(reads))
+        aggregates = [ds.value for ds in so._zonal[self.var].itervalues()]
+        output = sum([value.data.nbytes+value.mask.nbytes for value in aggregates])
+        self.assertEqual(estimate._zonal,output+min(sum(reads)*9/8,env.STREAM_BLOCK_LIMIT*1024**2*9/8))
+        self.assertTrue(estimate.get_memory() >= estimate._zonal)
+        
+    def test_max_memory(self):
+        kwds = {'calc':[{'func':'mean','name':'my_mean'}],'calc_grouping':['month']}
+        actual = self.get_ret(kwds=kwds)[1].calc[self.var]['my_mean']
+        env.STREAM_BLOCK_LIMIT = 1e-3
+        estimate = RequestEstimate(self.get_ops(kwds=kwds))
+        memory,memory_stream = estimate.get_memory(),estimate.get_memory(stream=True)
+        self.assertTrue(memory_stream < memory)
+        ## the calculation is streamed to fit the budget
+        env.MAX_MEMORY = (memory+memory_stream)/2.0/1024**2
+        ret = self.get_ret(kwds=kwds)
+        self.assertIsNone(ret[1].variables[self.var]._value)
+        self.assertTrue(np.allclose(ret[1].calc[self.var]['my_mean'],actual))
+        self.assertFalse(env.STREAM_CALC)
+        ## the budget is too small for any strategy
+        env.MAX_MEMORY = memory_stream/2.0/1024**2
+        with self.assertRaises(exc.MemoryLimitExceeded):
+            self.get_ret(kwds=kwds)
+        ## medians are not streamed
+        kwds['calc'] = [{'func':'median','name':'my_median'}]
+        env.MAX_MEMORY = memory/2.0/1024**2
+        with self.assertRaises(exc.MemoryLimitExceeded):
+            self.get_ret(kwds=kwds)
+        ## the full values are estimated for requests that are not streamed
+        env.STREAM_CALC = True
+        for kwds in [kwds,{}]:
+            estimate = RequestEstimate(self.get_ops(kwds=kwds))
+            self.assertFalse(estimate.can_stream())
+            env.MAX_MEMORY = estimate.get_memory()/2.0/1024**2
+            with self.assertRaises(exc.MemoryLimitExceeded):
+                self.get_ret(kwds=kwds)
+            env.MAX_MEMORY = estimate.get_memory()*2.0/1024**2
+            self.get_ret(kwds=kwds)
+
+    def test_calc_threads(self):
+        calc = [{'func':'mean','name':'my_mean'},{'func':'median','name':'my_median'},
+                {'func':'std','name':'my_std'},{'func':'max','name':'my_max'},
+                {'func':'freq_perc','name':'p95','kwds':{'perc':95}},
+                {'func':'between','name':'my_between','kwds':{'lower':2,'upper':3}}]
+        for group in [['month'],['year']]:
+            kwds = {'calc':calc,'calc_grouping':group}
+            actual = self.get_ret(kwds=kwds)[1].calc[self.var]
+            env.THREAD_CALC = True
+            env.CORES = 4
+            try:
+                ret = self.get_ret(kwds=kwds)[1].calc[self.var]
+            finally:
+                env.THREAD_CALC = False
+            ## results are stored in the order of the functions
+            self.assertEqual(ret.keys(),actual.keys())
+            for key in ret.keys():
+                self.assertTrue(np.all(ret[key].mask == actual[key].mask))
+                self.assertTrue(np.all(ret[key] == actual[key]))
+
     def test_inspect(self):
         uri = self.get_dataset()['uri']
         for variable in [self.get_dataset()['variable'],None]:
@@ -330,6 +675,65 @@ class TestSimpleMask(TestSimpleBase):
             ret = self.get_ret(kwds={'geom':geom})
         ret = self.get_ret(kwds={'geom':geom,'allow_empty':True})
         
+    def test_calc_nan(self):
+        calc = [{'func':'max_cons','name':'max_cons_gt','kwds':{'threshold':2,'operation':'gt'}},
+                {'func':'mean','name':'my_mean'}]
+        kwds = {'calc':calc,'calc_grouping':['month']}
+        actual = self.get_ret(kwds=kwds)[1].calc[self.var]
+        ## count the groups calculated by the nan kernel
+        calls = []
+        kernel = library.MaxConsecutive._calculate_nan_
+        def _calculate_nan_(values,**kwds):
+            calls.append(values.shape)
+            return(kernel(values,**kwds))
+        library.MaxConsecutive._calculate_nan_ = staticmethod(_calculate_nan_)
+        try:
+            env.NAN_CALC = True
+            ret = self.get_ret(kwds=kwds)[1].calc[self.var]
+        finally:
+            library.MaxConsecutive._calculate_nan_ = staticmethod(kernel)
+        ## one call for each month
+        self.assertEqual(len(calls),2)
+        self.assertTrue(actual['my_mean'].mask.any())
+        for key in actual.keys():
+            self.assertIsInstance(ret[key],np.ma.MaskedArray)
+            self.assertTrue(np.all(ret[key].mask == actual[key].mask))
+            self.assertTrue(np.all(ret[key] == actual[key]))
+        
+    def test_zonal_aggregate_mask(self):
+        ## mask a cell after the first time step only
+        ds = nc.Dataset(self.get_dataset()['uri'],'a')
+        try:
+            var = ds.variables[self.var]
+            value = var[1:3,:,:,:]
+            value.mask = np.ma.getmaskarray(value)
+            value.mask[:,:,1,1] = True
+            var[1:3,:,:,:] = value
+        finally:
+            ds.close()
+        polygons = [make_poly((37.5,39.5),(-104.5,-102.5)),
+                    make_poly((38,40),(-104,-103))]
+        ## blocks of a single time step are aggregated with the mask of the
+        ## first time step as for the loaded values
+        env.STREAM_BLOCK_LIMIT = 0
+        time_ranges = [None,[datetime.datetime(2000,3,2),datetime.datetime(2000,3,31)]]
+        for time_range in time_ranges:
+            kwds = {'aggregate':True,'geom':self.get_shp_dataset(polygons)}
+            env.ZONAL_AGGREGATE = False
+            ret = self.get_ret(kwds=kwds,time_range=time_range)
+            env.ZONAL_AGGREGATE = True
+            kwds['geom'] = self.get_shp_dataset(polygons)
+            ret_zonal = self.get_ret(kwds=kwds,time_range=time_range)
+            so = SubsetOperation(self.ops)
+            so._get_zonal_aggregates_()
+            self.assertIn(self.var,so._zonal)
+            for ugid in [1,2]:
+                value = ret[ugid].variables[self.var].value
+                value_zonal = ret_zonal[ugid].variables[self.var].value
+                self.assertEqual(value.shape,value_zonal.shape)
+                self.assertTrue(np.all(value.mask == value_zonal.mask))
+                self.assertTrue(np.allclose(value,value_zonal))
+        
         
 class TestSimple360(TestSimpleBase):
 #    return_shp = True
@@ -1,9 +1,27 @@
 from ocgis.interface.shp import ShpDataset
 import numpy as np
-from ocgis.util.helpers import format_bool, iter_array
+from ocgis.util.helpers import format_bool, iter_array, get_cell_area,\
+ get_weighted_average, get_date_parts
+from ocgis import env
 import itertools
+import datetime
 from ocgis.test.base import TestBase
 from ocgis.util.spatial.wrap import Wrapper
+from ocgis.interface.nc.dimension import NcRowDimension, NcColumnDimension,\
+    NcGridDimension, NcPolygonDimension, NcPointDimension, NcGridMatrixDimension,\
+    NcSpatialDimension
+from ocgis.util.helpers import make_poly
+from ocgis.util.spatial import index as si
+from ocgis.util.spatial.zonal import get_sparse_weights
+from shapely.geometry.polygon import Polygon
+from shapely.geometry.multipolygon import MultiPolygon
+from shapely.geometry.point import Point
+from shapely.geometry.linestring import LineString
+from ocgis.util.spatial.geometry_array import GeometryArray
+from copy import deepcopy
+from ocgis.util.cache import get_cache, SubsetCache
+import os
+from ocgis.interface.projection import WGS84, LambertConformalConic
 
 
 class TestHelpers(TestBase):
@@ -60,6 +78,44 @@ class TestHelpers(TestBase):
             ret = format_bool(key)
             self.assertEqual(ret,value)
 
+    def test_get_date_parts(self):
+        dates = np.array([datetime.datetime(1850,1,1),
+                          datetime.datetime(2000,2,29,23,59,58,999),
+                          datetime.datetime(1969,12,31,1,2,3)])
+        parts = get_date_parts(dates)
+        for idx,dt in enumerate(dates):
+            self.assertEqual(parts[idx].tolist(),[dt.year,dt.month,dt.day,dt.hour,
+                                                  dt.minute,dt.second,dt.microsecond])
+
+    def test_get_cell_area(self):
+        row_bounds = np.array([[40.0,41.0],[43.0,41.0]])
+        col_bounds = np.array([[-100.0,-99.0],[-99.0,-96.5]])
+        area = get_cell_area(row_bounds,col_bounds)
+        for ii,jj in itertools.product(range(2),range(2)):
+            self.assertAlmostEqual(area[ii,jj],make_poly(row_bounds[ii],col_bounds[jj]).area)
+        ## the globe
+        row_bounds = np.column_stack((np.arange(-90,90),np.arange(-89,91)))
+        col_bounds = np.column_stack((np.arange(0,360),np.arange(1,361)))
+        area = get_cell_area(row_bounds,col_bounds,spherical=True)
+        self.assertAlmostEqual(area.sum(),4*np.pi)
+        self.assertTrue(area[0,0] < area[90,0])
+
+    def test_get_weighted_average(self):
+        np.random.seed(1)
+        value = np.ma.array(np.random.rand(4,2,3,3),mask=False)
+        value.mask[1,0,0,0] = True
+        value.mask[2,1,:,:] = True
+        weights = np.ma.array(np.random.rand(3,3),mask=False)
+        weights.mask[2,2] = True
+        ret = get_weighted_average(value,weights)
+        self.assertEqual(ret.shape,(4,2,1,1))
+        for tidx,lidx in itertools.product(range(4),range(2)):
+            if tidx == 2 and lidx == 1:
+                self.assertTrue(ret.mask[tidx,lidx,0,0])
+            else:
+                actual = np.ma.average(value[tidx,lidx,:,:],weights=weights)
+                self.assertAlmostEqual(ret[tidx,lidx,0,0],actual)
+
 class TestSpatial(TestBase):
     axes = [-10.0,-5.0,0.0,5.0,10]
 
@@ -81,3 +137,370 @@ class TestSpatial(TestBase):
                 new_geom = w.wrap(unwrapped_geom)
                 self.assertFalse(unwrapped_geom.equals(new_geom))
                 self.assertTrue(sd.spatial.geom[idx].almost_equals(new_geom))
+                
+    def get_polygon_dimension(self,row_reverse=False,column_reverse=False,projection=None):
+        row_bounds = np.arange(30.0,50.5,0.5)
+        col_bounds = np.arange(-110.0,-89.5,0.5)
+        row_bounds = np.hstack((row_bounds[:-1].reshape(-1,1),row_bounds[1:].reshape(-1,1)))
+        col_bounds = np.hstack((col_bounds[:-1].reshape(-1,1),col_bounds[1:].reshape(-1,1)))
+        if row_reverse:
+            row_bounds = row_bounds[::-1,::-1]
+        if column_reverse:
+            col_bounds = col_bounds[::-1,:]
+        row = NcRowDimension(value=row_bounds.mean(axis=1),bounds=row_bounds)
+        column = NcColumnDimension(value=col_bounds.mean(axis=1),bounds=col_bounds)
+        grid = NcGridDimension(row=row,column=column)
+        return(NcPolygonDimension(grid=grid,uid=grid.uid,projection=projection))
+                
+    def test_polygon_intersects(self):
+        ring = [(-105.2,32.1),(-95.0,31.0),(-92.5,40.0),(-100.0,47.3),(-108.0,44.0)]
+        hole = [(-101.0,37.0),(-98.0,37.0),(-98.0,41.0),(-101.0,41.0)]
+        polygons = [Polygon(ring),
+                    Polygon(ring,[hole]),
+                    ## vertices and edges on cell bounds
+                    make_poly((35.0,42.5),(-104.0,-96.5)),
+                    MultiPolygon([make_poly((31.25,33.75),(-109.0,-107.0)),
+                                  Polygon(ring).buffer(-1.0)]),
+                    ## partially outside the grid
+                    make_poly((45.0,55.0),(-95.0,-85.0))]
+        for polygon in polygons:
+            for row_reverse,column_reverse in itertools.product([False,True],[False,True]):
+                vd = self.get_polygon_dimension(row_reverse=row_reverse,
+                                                column_reverse=column_reverse)
+                ret = vd.intersects(polygon)
+                ## geometries are not loaded by the spatial operation
+                self.assertIsNone(ret._geom)
+                weights = ret.weights
+                ## compare against an exact test on each cell
+                index = si.build_index(polygon,si.build_index_grid(30.0,polygon))
+                row = ret.grid.row.bounds
+                col = ret.grid.column.bounds
+                actual = np.ones(ret.grid.shape,dtype=bool)
+                for ii,jj in itertools.product(range(row.shape[0]),range(col.shape[0])):
+                    test_geom = make_poly(row[ii,:],col[jj,:])
+                    if si.index_intersects(test_geom,index):
+                        actual[ii,jj] = False
+                self.assertTrue(np.any(~actual))
+                self.assertTrue(np.all(ret.mask == actual))
+                ## load the geometries
+                for (ii,jj),geom in iter_array(ret.geom,return_value=True):
+                    self.assertTrue(geom.equals(make_poly(row[ii,:],col[jj,:])))
+                self.assertTrue(np.all(ret.geom.mask == actual))
+                ret._weights = None
+                self.assertTrue(np.all(weights.mask == ret.weights.mask))
+                self.assertTrue(np.allclose(weights.compressed(),ret.weights.compressed()))
+
+                
+    def test_polygon_weights(self):
+        polygon = Polygon([(-105.2,32.1),(-95.0,31.0),(-92.5,40.0),(-100.0,47.3),(-108.0,44.0)])
+        vd = self.get_polygon_dimension(row_reverse=True,projection=WGS84())
+        for spherical in [False,True]:
+            env.SPHERICAL_WEIGHTS = spherical
+            try:
+                for clip,ret in [(False,vd.intersects(polygon)),(True,vd.clip(polygon))]:
+                    weights = ret.weights
+                    geom = ret.geom
+                    self.assertTrue(np.all(weights.mask == geom.mask))
+                    row,col = ret.grid.row.bounds,ret.grid.column.bounds
+                    actual = np.ma.array(np.zeros(ret.shape),mask=geom.mask)
+                    for (ii,jj),cell in iter_array(geom,return_value=True):
+                        full = make_poly(row[ii],col[jj])
+                        area = get_cell_area(row[ii:ii+1],col[jj:jj+1],spherical=spherical)[0,0]
+                        actual[ii,jj] = area*cell.area/full.area
+                    actual = actual/actual.max()
+                    self.assertTrue(np.allclose(weights.compressed(),actual.compressed()))
+                    ## clipped cells have smaller weights
+                    self.assertEqual(np.any(actual.compressed() < 0.5),clip)
+            finally:
+                env.reset()
+                
+    def test_polygon_weights_projected(self):
+        ## spherical weights are not applied to projected coordinates
+        polygon = Polygon([(-105.2,32.1),(-95.0,31.0),(-92.5,40.0),(-100.0,47.3),(-108.0,44.0)])
+        projection = LambertConformalConic((25.0,45.0),-97.0,42.5,0.0,0.0)
+        actual = {}
+        for spherical in [False,True]:
+            env.SPHERICAL_WEIGHTS = spherical
+            try:
+                vd = self.get_polygon_dimension(row_reverse=True,projection=projection)
+                ret = vd.clip(polygon)
+                self.assertIs(ret.projection,projection)
+                actual[spherical] = ret.weights
+            finally:
+                env.reset()
+        self.assertTrue(np.all(actual[False].mask == actual[True].mask))
+        self.assertTrue(np.allclose(actual[False].compressed(),actual[True].compressed()))
+        ## the same grid in geographic coordinates is weighted on the sphere
+        env.SPHERICAL_WEIGHTS = True
+        try:
+            vd = self.get_polygon_dimension(row_reverse=True,projection=WGS84())
+            weights = vd.clip(polygon).weights
+        finally:
+            env.reset()
+        self.assertFalse(np.allclose(weights.compressed(),actual[True].compressed()))
+                
+    def test_subset_cache(self):
+        polygon = Polygon([(-105.2,32.1),(-95.0,31.0),(-92.5,40.0),(-100.0,47.3),(-108.0,44.0)])
+        vd = self.get_polygon_dimension()
+        intersects = vd.intersects(polygon)
+        clip = vd.clip(polygon)
+        env.DIR_CACHE = os.path.join(self._new_dir,'cache')
+        for cached in [False,True]:
+            ret_intersects = vd.intersects(polygon)
+            ret_clip = vd.clip(polygon)
+            self.assertEqual(len(os.listdir(env.DIR_CACHE)),2)
+            self.assertTrue(np.all(ret_intersects.mask == intersects.mask))
+            self.assertTrue(np.all(ret_clip.mask == clip.mask))
+            self.assertTrue(np.allclose(ret_clip.weights,clip.weights))
+            self.assertTrue(np.all(ret_clip.geom.replaced == clip.geom.replaced))
+            for (ii,jj),geom in iter_array(clip.geom,return_value=True):
+                self.assertTrue(geom.equals(ret_clip.geom[ii,jj]))
+        ## a different geometry is a new entry. the least recently used entry
+        ## is evicted when the cache is full.
+        cache = get_cache()
+        key = cache.get_key('intersects',intersects.grid.row.bounds,intersects.grid.column.bounds,polygon.wkb)
+        self.assertIn(key,cache)
+        paths = [os.path.join(env.DIR_CACHE,fn) for fn in os.listdir(env.DIR_CACHE)]
+        os.utime(cache._get_path_(key),(0,0))
+        env.CACHE_LIMIT = sum(map(os.path.getsize,paths))/1024.0**2
+        buffered = polygon.buffer(1.0)
+        ret = vd.intersects(buffered)
+        self.assertNotIn(key,cache)
+        self.assertIn(cache.get_key('intersects',ret.grid.row.bounds,ret.grid.column.bounds,buffered.wkb),cache)
+                
+    def test_subset_cache_evict(self):
+        cache = SubsetCache(os.path.join(self._new_dir,'cache_evict'),limit=1.0)
+        scans = []
+        evict = SubsetCache.evict
+        def _evict_(self):
+            scans.append(self.path)
+            evict(self)
+        SubsetCache.evict = _evict_
+        try:
+            ## only the first write scans the directory while the estimated
+            ## size is within the limit
+            for idx in range(5):
+                cache.put(str(idx),value=np.zeros(1000))
+            self.assertEqual(len(scans),1)
+            ## the least recently used entry is removed once the estimate
+            ## exceeds the limit
+            paths = [os.path.join(cache.path,fn) for fn in os.listdir(cache.path)]
+            os.utime(cache._get_path_('0'),(0,0))
+            cache.limit = sum(map(os.path.getsize,paths))/1024.0**2
+            cache.put('5',value=np.zeros(1000))
+            self.assertEqual(len(scans),2)
+            self.assertNotIn('0',cache)
+            self.assertIn('5',cache)
+        finally:
+            SubsetCache.evict = evict
+                
+    def test_spatial_get_iter(self):
+        polygon = make_poly((35.0,42.5),(-104.0,-96.5)).buffer(1.0)
+        vd = self.get_polygon_dimension().intersects(polygon)
+        spatial = NcSpatialDimension(grid=vd.grid,vector=vd)
+        geoms = [(idx,geom) for idx,geom,_ in spatial.get_iter()]
+        self.assertIsNone(vd._geom)
+        self.assertEqual(len(geoms),(~vd.mask).sum())
+        self.assertEqual([idx for idx,_ in geoms],list(iter_array(vd.geom)))
+        for (ii,jj),geom in geoms:
+            self.assertTrue(geom.equals(vd.geom[ii,jj]))
+            
+    def test_sparse_weights(self):
+        row_bounds = np.column_stack((np.arange(40.0,44.0),np.arange(41.0,45.0)))
+        col_bounds = np.column_stack((np.arange(-100.0,-96.0),np.arange(-99.0,-95.0)))
+        geoms = [make_poly((40.5,42.5),(-99.5,-97.5)),
+                 make_poly((10,11),(10,11)),
+                 make_poly((41,42),(-100,-99))]
+        weights = get_sparse_weights(geoms,row_bounds,col_bounds,spatial_operation='clip')
+        self.assertEqual(weights.shape,(3,16))
+        indices,data = weights.get_row(0)
+        self.assertEqual(indices.tolist(),[0,1,2,4,5,6,8,9,10])
+        self.assertAlmostEqual(data.sum(),4.0)
+        self.assertEqual(weights.get_row(1)[0].shape[0],0)
+        self.assertEqual(weights.get_row(2)[0].tolist(),[4])
+        
+        value = np.ma.array(np.random.rand(3,1,4,4),mask=False)
+        value.mask[1,0,1,0] = True
+        ret = weights.average(value)
+        self.assertEqual(ret.shape,(3,1,3))
+        self.assertTrue(ret.mask[:,:,1].all())
+        self.assertTrue(ret.mask[1,0,2])
+        self.assertFalse(ret.mask[0,0,2])
+        for tidx in range(3):
+            actual = np.ma.average(value[tidx,0].flatten()[indices],weights=data)
+            self.assertAlmostEqual(ret[tidx,0,0],actual)
+
+class TestSpatialIndex(TestBase):
+    
+    def get_target(self):
+        angles = np.linspace(0,2*np.pi,400,endpoint=False)
+        radius = 10.0 + 3.0*np.sin(angles*7)
+        star = Polygon(zip(radius*np.cos(angles),radius*np.sin(angles)),
+                       [Point(0,0).buffer(2.0).exterior.coords])
+        return(MultiPolygon([star,make_poly((-2.0,2.0),(20.0,30.0))]))
+    
+    def test_intersects_points(self):
+        target = self.get_target()
+        np.random.seed(3)
+        x = np.random.uniform(-15,31,(60,70))
+        y = np.random.uniform(-15,15,(60,70))
+        ## vertices and points on segments
+        coords = list(target[0].exterior.coords) + list(target[1].exterior.coords)
+        x[0,0:10],y[0,0:10] = zip(*coords[0:10])
+        x[1,0:5] = [20.0,25.0,30.0,-2.0,2.0]
+        y[1,0:5] = [0.0,2.0,0.0,0.0,0.0]
+        ret = si.intersects_points(target,x,y)
+        actual = np.array([target.intersects(Point(*xy)) for xy in zip(x.flat,y.flat)]).reshape(x.shape)
+        self.assertTrue(np.all(ret[0,0:10]) and np.all(ret[1,0:5]))
+        self.assertTrue(np.all(ret == actual))
+        
+    def test_point_dimension_intersects(self):
+        target = self.get_target()
+        row = NcRowDimension(value=np.arange(-15.0,15.5,0.5))
+        column = NcColumnDimension(value=np.arange(-15.0,31.5,0.5))
+        grid = NcGridDimension(row=row,column=column)
+        y,x = np.meshgrid(row.value,column.value,indexing='ij')
+        shp = grid.shape
+        real_row,real_column = np.meshgrid(np.arange(shp[0]),np.arange(shp[1]),indexing='ij')
+        ## a rotated matrix grid
+        matrix = NcGridMatrixDimension(y+0.1*x,x-0.1*y,real_row,real_column,grid.uid)
+        for grid in [grid,matrix]:
+            vd = NcPointDimension(grid=grid,uid=grid.uid)
+            ret = vd.intersects(target)
+            self.assertIsNone(ret._geom)
+            x,y = ret._get_coordinates_(ret.grid)
+            actual = [not target.intersects(Point(*xy)) for xy in zip(x.flat,y.flat)]
+            self.assertEqual(ret.mask.flatten().tolist(),actual)
+            self.assertTrue(np.any(~ret.mask) and np.any(ret.mask))
+            geom = ret.geom
+            self.assertTrue(np.all(geom.mask == ret.mask))
+            for (ii,jj),pt in iter_array(geom,return_value=True):
+                self.assertEqual((pt.x,pt.y),(x[ii,jj],y[ii,jj]))
+    
+    def test_str_tree(self):
+        np.random.seed(1)
+        lower = np.random.uniform(-100,100,(500,2))
+        bounds = np.hstack((lower,lower+np.random.uniform(0,10,(500,2))))
+        tree = si.StrTree(bounds,capacity=4)
+        self.assertEqual(len(tree),500)
+        for query in [(-5.0,-5.0,5.0,5.0),(0.0,0.0,0.0,0.0),(200.0,200.0,300.0,300.0),
+                      (-100.0,-100.0,110.0,110.0)]:
+            actual = np.nonzero((bounds[:,0] <= query[2]) & (bounds[:,2] >= query[0]) &
+                                (bounds[:,1] <= query[3]) & (bounds[:,3] >= query[1]))[0]
+            self.assertEqual(np.sort(tree.query(query)).tolist(),actual.tolist())
+        tree = si.StrTree(np.zeros((0,4)))
+        self.assertEqual(tree.query((0,0,1,1)).shape[0],0)
+    
+    def test_get_spatial_index(self):
+        target = self.get_target()
+        self.assertIsInstance(si.get_spatial_index(target),si.QuadtreeIndex)
+        self.assertIsInstance(si.get_spatial_index(target,method='grid',dim=5.0),si.GridIndex)
+        with self.assertRaises(ValueError):
+            si.get_spatial_index(target,method='foo')
+    
+    def test_intersects_keep(self):
+        target = self.get_target()
+        indexes = [si.QuadtreeIndex(target,max_vertices=16),
+                   si.QuadtreeIndex(target),
+                   si.GridIndex(target,dim=5.0)]
+        self.assertTrue(len(indexes[0]) > len(indexes[1]))
+        
+        geoms = []
+        bounds = np.arange(-15.0,32.0,1.0)
+        for ii,jj in itertools.product(range(bounds.shape[0]-1),range(bounds.shape[0]-1)):
+            geoms.append(make_poly(bounds[ii:ii+2],bounds[jj:jj+2]))
+        np.random.seed(2)
+        for x,y in np.random.uniform(-15,31,(500,2)):
+            geoms.append(Point(x,y))
+        ## points on the target boundary and on quadrant seams
+        geoms += [Point(20.0,0.0),Point(25.0,2.0),Point(0.0,0.0),Point(-7.0,0.0)]
+        
+        for index in indexes:
+            for geom in geoms:
+                self.assertEqual(index.intersects(geom),geom.intersects(target))
+                self.assertEqual(index.keep(geom),si.keep(target,geom))
+
+
+class TestGeometryArray(TestBase):
+    
+    def get_shapely(self):
+        hole = Polygon([(0,0),(10,0),(10,10),(0,10)],[[(2,2),(4,2),(4,4),(2,4)]])
+        multi = MultiPolygon([make_poly((0,1),(0,1)),make_poly((5,7),(5,6))])
+        return([hole,multi,make_poly((-5,-4),(3,1)),LineString([(0,0),(1,1)])])
+    
+    def assertGeometryProperties(self,arr,geoms):
+        for idx,geom in enumerate(geoms):
+            self.assertAlmostEqual(arr.area[idx],geom.area)
+            self.assertTrue(np.allclose(arr.bounds[idx],geom.bounds))
+            self.assertTrue(np.allclose(arr.centroid[idx],geom.centroid.coords[0]))
+            self.assertTrue(arr[idx].equals(geom))
+    
+    def test_from_shapely(self):
+        geoms = self.get_shapely()
+        arr = GeometryArray.from_shapely(geoms)
+        self.assertEqual(arr.shape,(4,))
+        self.assertEqual(arr.geom_type,'Polygon')
+        self.assertIsInstance(arr[1],MultiPolygon)
+        self.assertGeometryProperties(arr,geoms)
+        
+        points = [Point(1,2),Point(3,4)]
+        arr = GeometryArray.from_shapely(np.ma.array(points,dtype=object,mask=[False,True]))
+        self.assertEqual(arr.geom_type,'Point')
+        self.assertEqual(arr.mask.tolist(),[False,True])
+        self.assertTrue(arr[1] is np.ma.masked)
+        self.assertTrue(arr.compressed()[0].equals(points[0]))
+        self.assertTrue(np.all(arr.centroid == [[1,2],[3,4]]))
+        
+        arr = GeometryArray.from_shapely(geoms[0])
+        self.assertEqual(arr.shape,(1,))
+        self.assertTrue(arr[0].equals(geoms[0]))
+    
+    def test_from_bounds(self):
+        row_bounds = np.array([[40.0,41.0],[41.0,43.0]])
+        col_bounds = np.array([[-100.0,-99.0],[-99.0,-97.5],[-97.5,-97.0]])
+        arr = GeometryArray.from_bounds(row_bounds,col_bounds)
+        self.assertEqual(arr.shape,(2,3))
+        for ii,jj in itertools.product(range(2),range(3)):
+            geom = make_poly(row_bounds[ii],col_bounds[jj])
+            self.assertEqual(list(arr[ii,jj].exterior.coords),list(geom.exterior.coords))
+            self.assertAlmostEqual(arr.area[ii,jj],geom.area)
+            self.assertTrue(np.allclose(arr.bounds[ii,jj],geom.bounds))
+            self.assertTrue(np.allclose(arr.centroid[ii,jj],geom.centroid.coords[0]))
+        
+        points = GeometryArray.from_points(np.array([[1.0,2.0]]),np.array([[3.0,4.0]]))
+        self.assertEqual(points.shape,(1,2))
+        self.assertTrue(points[0,1].equals(Point(2,4)))
+        self.assertTrue(np.all(points.area == 0))
+    
+    def test_indexing(self):
+        arr = GeometryArray.from_bounds(np.array([[0.0,1.0],[1.0,2.0]]),
+                                        np.array([[0.0,1.0],[1.0,2.0],[2.0,3.0]]))
+        arr.mask[0,0] = True
+        self.assertTrue(arr[0,0] is np.ma.masked)
+        self.assertEqual(len(arr.compressed()),5)
+        self.assertEqual(list(iter_array(arr)),[(0,1),(0,2),(1,0),(1,1),(1,2)])
+        self.assertEqual(len(list(arr.flat)),6)
+        
+        ## slices are views
+        view = arr[1,:]
+        self.assertEqual(view.shape,(3,))
+        view[0] = Point(5,5)
+        self.assertTrue(arr[1,0].equals(Point(5,5)))
+        self.assertEqual(arr.area[1,0],0)
+        view.mask[1] = True
+        self.assertTrue(arr.mask[1,1])
+        
+        ## other indexing copies
+        cp = arr[np.array([False,True]),:]
+        cp[0,2] = Point(6,6)
+        self.assertFalse(arr[1,2].equals(Point(6,6)))
+        
+        arr[0,0] = Point(7,7)
+        self.assertFalse(arr.mask[0,0])
+        arr[0,1] = np.ma.masked
+        self.assertTrue(arr.mask[0,1])
+        
+        dc = deepcopy(arr)
+        dc[0,0] = Point(8,8)
+        self.assertTrue(arr[0,0].equals(Point(7,7)))
+        self.assertTrue(np.all(dc.to_shapely().mask == arr.mask))
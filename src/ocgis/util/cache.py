@@ -0,0 +1,152 @@
+import os
+import hashlib
+import tempfile
+import zipfile
+import numpy as np
+from ocgis import env
+
+
+## estimated sizes in bytes of the cache directories written by this process.
+## a directory is only scanned when its estimate exceeds the size limit.
+_sizes = {}
+
+
+class SubsetCache(object):
+    '''A directory of arrays computed by spatial subsets. Entries are addressed
+    by a hash of the subset inputs. When the directory grows beyond its size
+    limit, the least recently used entries are removed. The size of the
+    directory is estimated from the entries written by this process and
+    corrected by a scan of the directory when the estimate exceeds the limit.
+
+    :param str path: The cache directory. It is created if it does not exist.
+    :param float limit: The maximum size of the cache directory in megabytes.
+    '''
+    _ext = '.npz'
+
+    def __init__(self,path,limit=500.0):
+        self.path = path
+        self.limit = limit
+        if not os.path.exists(path):
+            try:
+                os.makedirs(path)
+            ## another process may have created the directory
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+
+    def __contains__(self,key):
+        return(os.path.exists(self._get_path_(key)))
+
+    def get(self,key):
+        '''
+        :param str key: The entry key.
+        :returns: The stored arrays or `None` if the entry does not exist.
+        :rtype: dict
+        '''
+        path = self._get_path_(key)
+        try:
+            with np.load(path) as data:
+                ret = dict([(name,data[name]) for name in data.files])
+        ## the entry is missing, evicted by another process, or unreadable
+        except (IOError,ValueError,zipfile.BadZipfile):
+            ret = None
+        else:
+            ## the modification time records the last use
+            try:
+                os.utime(path,None)
+            except OSError:
+                pass
+        return(ret)
+
+    def put(self,key,**arrays):
+        '''Store arrays under the key. Masked arrays are stored as their data
+        and mask.
+
+        :param str key: The entry key.
+        :param arrays: Arrays to store.
+        '''
+        to_save = {}
+        for name,value in arrays.iteritems():
+            if isinstance(value,np.ma.MaskedArray):
+                to_save[name] = value.data
+                to_save[name+'_mask'] = np.ma.getmaskarray(value)
+            else:
+                to_save[name] = value
+        ## write to a temporary file first so readers never see partial entries
+        fd,tmp = tempfile.mkstemp(suffix='.tmp',dir=self.path)
+        try:
+            with os.fdopen(fd,'wb') as f:
+                np.savez(f,**to_save)
+            size = os.path.getsize(tmp)
+            os.rename(tmp,self._get_path_(key))
+        except Exception:
+            os.remove(tmp)
+            raise
+        path = os.path.abspath(self.path)
+        ## the first write of the process scans the directory
+        if path not in _sizes:
+            self.evict()
+        else:
+            _sizes[path] += size
+            if _sizes[path] > self.limit*1024**2:
+                self.evict()
+
+    def evict(self):
+        '''Remove the least recently used entries until the directory size is
+        within the limit. This scans the directory.'''
+        entries = []
+        for fn in os.listdir(self.path):
+            if fn.endswith(self._ext):
+                path = os.path.join(self.path,fn)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime,stat.st_size,path))
+        total = sum([entry[1] for entry in entries])
+        limit = self.limit*1024**2
+        for mtime,size,path in sorted(entries):
+            if total <= limit:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        _sizes[os.path.abspath(self.path)] = total
+
+    @staticmethod
+    def get_key(*parts):
+        '''
+        :param parts: Strings and arrays identifying the entry.
+        :returns: A hexadecimal digest of the parts.
+        :rtype: str
+        '''
+        sha = hashlib.sha1()
+        for part in parts:
+            if isinstance(part,np.ndarray):
+                part = np.ascontiguousarray(part)
+                sha.update(str(part.dtype))
+                sha.update(str(part.shape))
+                sha.update(part.data)
+            else:
+                sha.update(str(part))
+            ## separate the parts so concatenations do not collide
+            sha.update('|')
+        return(sha.hexdigest())
+
+    def _get_path_(self,key):
+        return(os.path.join(self.path,key+self._ext))
+
+
+def get_cache():
+    '''
+    :returns: The subset cache in :attr:`env.DIR_CACHE` or `None` if caching is
+     disabled.
+    :rtype: :class:`SubsetCache`
+    '''
+    if env.DIR_CACHE is None:
+        ret = None
+    else:
+        ret = SubsetCache(env.DIR_CACHE,limit=env.CACHE_LIMIT)
+    return(ret)
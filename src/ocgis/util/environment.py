@@ -10,14 +10,25 @@ class Environment(object):
         self.DIR_SHPCABINET = EnvParm('DIR_SHPCABINET',None)
         self.DIR_DATA = EnvParm('DIR_DATA',None)
         self.DIR_TEST_DATA = EnvParm('DIR_TEST_DATA',None)
+        self.DIR_CACHE = EnvParm('DIR_CACHE',None)
+        self.CACHE_LIMIT = EnvParm('CACHE_LIMIT',500.0,formatter=float)
         self.SERIAL = EnvParm('SERIAL',True,formatter=self._format_bool_)
         self.CORES = EnvParm('CORES',6,formatter=int)
+        self.ORDERED = EnvParm('ORDERED',True,formatter=self._format_bool_)
         self.MODE = EnvParm('MODE','raw')
         self.PREFIX = EnvParm('PREFIX','ocgis_output')
         self.FILL_VALUE = EnvParm('FILL_VALUE',1e20,formatter=float)
         self.VERBOSE = EnvParm('VERBOSE',False,formatter=self._format_bool_)
         self.OPTIMIZE_FOR_CALC = EnvParm('OPTIMIZE_FOR_CALC',False,formatter=self._format_bool_)
         self.WRITE_TO_REFERENCE_PROJECTION = EnvParm('WRITE_TO_REFERENCE_PROJECTION',False,formatter=self._format_bool_)
+        self.SHARED_READ_LIMIT = EnvParm('SHARED_READ_LIMIT',500.0,formatter=float)
+        self.SPHERICAL_WEIGHTS = EnvParm('SPHERICAL_WEIGHTS',False,formatter=self._format_bool_)
+        self.ZONAL_AGGREGATE = EnvParm('ZONAL_AGGREGATE',False,formatter=self._format_bool_)
+        self.STREAM_CALC = EnvParm('STREAM_CALC',False,formatter=self._format_bool_)
+        self.STREAM_BLOCK_LIMIT = EnvParm('STREAM_BLOCK_LIMIT',100.0,formatter=float)
+        self.NAN_CALC = EnvParm('NAN_CALC',False,formatter=self._format_bool_)
+        self.THREAD_CALC = EnvParm('THREAD_CALC',False,formatter=self._format_bool_)
+        self.MAX_MEMORY = EnvParm('MAX_MEMORY',None,formatter=float)
         
         self.ops = None
         
@@ -17,6 +17,7 @@ from ocgis import env
 import sys
 from shapely.geometry.multipoint import MultiPoint
 from osgeo.ogr import wkbPoint
+from ocgis.util.spatial.geometry_array import GeometryArray
 
 
 def vprint(args):
@@ -163,7 +164,7 @@ def iter_array(arr,use_mask=True,return_value=False):
         arr = np.array(arr,ndmin=1)
         shp = arr.shape
     iter_args = [range(0,ii) for ii in shp]
-    if use_mask and not np.ma.isMaskedArray(arr):
+    if use_mask and not np.ma.isMaskedArray(arr) and not isinstance(arr,GeometryArray):
         use_mask = False
     else:
         try:
@@ -294,6 +295,89 @@ def contains(grid,lower,upper,res=0.0):
 #    for ii,jj in itertools.product(range(ix),range(jx)):
 #        yield ii,jj
         
+def get_cell_area(row_bounds,col_bounds,spherical=False):
+    '''Area of rectilinear grid cells computed from their bounds.
+    
+    :param row_bounds: Row bounds with shape (nrow,2).
+    :param col_bounds: Column bounds with shape (ncol,2).
+    :param bool spherical: If `True`, bounds are latitudes and longitudes in
+     degrees and the area is on the unit sphere. Otherwise, the area is in
+     coordinate units.
+    :rtype: :class:`numpy.ndarray` with shape (nrow,ncol)
+    '''
+    if spherical:
+        row = np.abs(np.diff(np.sin(np.radians(row_bounds)),axis=1))
+        col = np.abs(np.diff(np.radians(col_bounds),axis=1))
+    else:
+        row = np.abs(np.diff(row_bounds,axis=1))
+        col = np.abs(np.diff(col_bounds,axis=1))
+    return(row*col.reshape(1,-1))
+        
+def get_weighted_average(value,weights):
+    '''Weighted average over the spatial dimensions of a four-dimensional
+    array. Masked values and weights do not contribute to the average.
+    
+    :param value: Array with dimensions (time,level,row,column).
+    :type value: :class:`numpy.ma.MaskedArray`
+    :param weights: Weights with shape (row,column).
+    :type weights: :class:`numpy.ma.MaskedArray`
+    :returns: Array with shape (time,level,1,1). Elements with no unmasked
+     values are masked.
+    :rtype: :class:`numpy.ma.MaskedArray`
+    '''
+    weights = np.ma.filled(weights,0.0).astype(float)
+    valid = np.logical_not(np.ma.getmaskarray(value))
+    total = np.einsum('ijkl,kl->ij',np.ma.filled(value,0),weights)
+    weight_sum = np.einsum('ijkl,kl->ij',valid,weights)
+    select = weight_sum > 0
+    ret = np.zeros(total.shape,dtype=float)
+    ret[select] = total[select]/weight_sum[select]
+    shape = (value.shape[0],value.shape[1],1,1)
+    ret = np.ma.array(ret.reshape(shape),mask=np.logical_not(select).reshape(shape))
+    return(ret)
+
+def get_nan_filled(value):
+    '''
+    :param value: The array to fill.
+    :type value: :class:`numpy.ma.MaskedArray`
+    :returns: A floating point copy of the array with masked values set to
+     `nan`.
+    :rtype: :class:`numpy.ndarray`
+    '''
+    if value.dtype.kind != 'f':
+        value = value.astype(float)
+    return(np.ma.filled(value,np.nan))
+        
+def get_date_parts(dates):
+    '''Integer date parts of datetime objects.
+    
+    :param dates: One-dimensional array of datetime objects.
+    :type dates: :class:`numpy.ndarray`
+    :returns: Array with shape (n,7) and columns `year, month, day, hour,
+     minute, second, microsecond`.
+    :rtype: :class:`numpy.ndarray`
+    '''
+    dates = np.asarray(dates).reshape(-1)
+    ret = np.empty((dates.shape[0],7),dtype=int)
+    try:
+        dt = dates.astype('datetime64[us]')
+    ## datetime objects from non-standard calendars do not convert
+    except (TypeError,ValueError):
+        for idx,d in enumerate(dates):
+            ret[idx,:] = [d.year,d.month,d.day,d.hour,d.minute,d.second,d.microsecond]
+    else:
+        month = dt.astype('datetime64[M]')
+        day = dt.astype('datetime64[D]')
+        us = (dt-day).astype(np.int64)
+        ret[:,0] = dt.astype('datetime64[Y]').astype(np.int64)+1970
+        ret[:,1] = month.astype(np.int64) % 12 + 1
+        ret[:,2] = (day-month).astype(np.int64)+1
+        ret[:,3] = us // 3600000000
+        ret[:,4] = (us // 60000000) % 60
+        ret[:,5] = (us // 1000000) % 60
+        ret[:,6] = us % 1000000
+    return(ret)
+        
 def make_poly(rtup,ctup):
     """
     rtup = (row min, row max)
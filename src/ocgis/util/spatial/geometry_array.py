@@ -0,0 +1,371 @@
+import numpy as np
+from shapely.geometry.point import Point
+from shapely.geometry.polygon import Polygon
+from shapely.geometry.multipolygon import MultiPolygon
+from shapely.geometry.base import BaseGeometry
+
+
+class GeometryArray(object):
+    '''Masked array of point or polygon geometries stored as contiguous
+    coordinate buffers. Shapely geometries are created only when an element is
+    requested.
+
+    Polygon buffers are nested by offsets: geometries reference a range of
+    parts, parts a range of rings (the first ring of a part is the exterior),
+    and rings a range of closed coordinates. Point buffers hold one coordinate
+    per geometry.
+
+    Elements assigned after construction are held as shapely geometries.
+    Slicing returns a view sharing buffers and assigned geometries with the
+    source array. Other indexing returns a copy.
+
+    :param str geom_type: Either `'Point'` or `'Polygon'`.
+    :param coords: Coordinates with shape (n,2).
+    :type coords: :class:`numpy.ndarray`
+    :param ring_offsets: Polygon ring offsets into `coords` with shape (nrings+1,).
+    :param part_offsets: Polygon part offsets into the rings with shape (nparts+1,).
+    :param geom_offsets: Polygon geometry offsets into the parts with shape (ngeoms+1,).
+    :param multi: Boolean array with shape (ngeoms,) indicating multi-part
+     polygons.
+    :param index: Integer array of buffer geometry indices defining the array's
+     shape. Defaults to all buffer geometries in order.
+    :param mask: Boolean mask with the shape of `index`.
+    :param geoms: Dictionary mapping buffer geometry indices to shapely
+     geometries replacing the buffer geometry.
+    '''
+
+    def __init__(self,geom_type,coords,ring_offsets=None,part_offsets=None,
+                 geom_offsets=None,multi=None,index=None,mask=None,geoms=None):
+        if geom_type not in ('Point','Polygon'):
+            raise(ValueError('Geometry type not supported: {0}'.format(geom_type)))
+        self.geom_type = geom_type
+        self.coords = np.asarray(coords,dtype=float).reshape(-1,2)
+        self.ring_offsets = ring_offsets
+        self.part_offsets = part_offsets
+        self.geom_offsets = geom_offsets
+        self.multi = multi
+        if index is None:
+            index = np.arange(self._ngeoms)
+        self._index = np.asarray(index)
+        self.mask = False if mask is None else mask
+        self._geoms = geoms if geoms is not None else {}
+
+    def __getitem__(self,key):
+        index = self._index[key]
+        mask = self._mask[key]
+        if np.ndim(index) == 0:
+            if mask:
+                ret = np.ma.masked
+            else:
+                ret = self._get_geom_(int(index))
+        else:
+            ## basic slicing creates views sharing assigned geometries
+            if np.may_share_memory(index,self._index):
+                geoms = self._geoms
+            else:
+                geoms = self._geoms.copy()
+            ret = self._new_(index,mask,geoms)
+        return(ret)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield(self[idx])
+
+    def __len__(self):
+        return(self.shape[0])
+
+    def __repr__(self):
+        return('{0}(geom_type={1}, shape={2})'.format(self.__class__.__name__,
+                                                      self.geom_type,self.shape))
+
+    def __setitem__(self,key,value):
+        if value is np.ma.masked:
+            self._mask[key] = True
+        else:
+            for idx in np.array(self._index[key],ndmin=1).flat:
+                self._geoms[int(idx)] = value
+            self._mask[key] = False
+
+    @property
+    def area(self):
+        '''Geometry areas as a float array with the shape of the array.'''
+        if self.geom_type == 'Point':
+            area = np.zeros(self._ngeoms,dtype=float)
+        else:
+            area = self._get_area_centroid_()[0]
+        area = self._replace_(area,lambda geom: geom.area)
+        return(area[self._index])
+
+    @property
+    def bounds(self):
+        '''Geometry bounds as a float array with shape (...,4) with the last
+        dimension ordered `minx, miny, maxx, maxy`.'''
+        ngeoms = self._ngeoms
+        bounds = np.empty((ngeoms,4),dtype=float)
+        bounds[:] = np.nan
+        if self.geom_type == 'Point':
+            bounds[:,0:2] = self.coords
+            bounds[:,2:4] = self.coords
+        else:
+            coord_offsets = self.ring_offsets[self.part_offsets[self.geom_offsets]]
+            start = coord_offsets[:-1]
+            select = coord_offsets[1:] > start
+            if select.any():
+                start = start[select]
+                for ii,func in zip(range(4),[np.minimum,np.minimum,np.maximum,np.maximum]):
+                    bounds[select,ii] = func.reduceat(self.coords[:,ii % 2],start)
+        bounds = self._replace_(bounds,lambda geom: geom.bounds)
+        return(bounds[self._index])
+
+    @property
+    def centroid(self):
+        '''Geometry centroids as a float array with shape (...,2).'''
+        if self.geom_type == 'Point':
+            centroid = self.coords.copy()
+        else:
+            centroid = self._get_area_centroid_()[1]
+        centroid = self._replace_(centroid,lambda geom: geom.centroid.coords[0][0:2])
+        return(centroid[self._index])
+
+    @property
+    def flat(self):
+        '''Iterator over all elements in row-major order.'''
+        return(self.reshape(-1).__iter__())
+
+    @property
+    def mask(self):
+        return(self._mask)
+
+    @mask.setter
+    def mask(self,value):
+        mask = np.zeros(self._index.shape,dtype=bool)
+        mask[:] = value
+        self._mask = mask
+
+    @property
+    def ndim(self):
+        return(self._index.ndim)
+
+    @property
+    def replaced(self):
+        '''Boolean array indicating elements held as shapely geometries.'''
+        if len(self._geoms) == 0:
+            ret = np.zeros(self.shape,dtype=bool)
+        else:
+            ret = np.in1d(self._index,self._geoms.keys()).reshape(self.shape)
+        return(ret)
+
+    @property
+    def shape(self):
+        return(self._index.shape)
+
+    @property
+    def size(self):
+        return(self._index.size)
+
+    @property
+    def _ngeoms(self):
+        if self.geom_type == 'Point':
+            ret = self.coords.shape[0]
+        else:
+            ret = self.geom_offsets.shape[0]-1
+        return(ret)
+
+    def compressed(self):
+        '''
+        :returns: Unmasked elements as shapely geometries.
+        :rtype: one-dimensional object :class:`numpy.ndarray`
+        '''
+        index = self._index[np.logical_not(self._mask)]
+        ret = np.empty(index.shape[0],dtype=object)
+        for ii,idx in enumerate(index.flat):
+            ret[ii] = self._get_geom_(int(idx))
+        return(ret)
+
+    def copy(self):
+        return(self._new_(self._index.copy(),self._mask.copy(),self._geoms.copy()))
+
+    def reshape(self,*args):
+        return(self._new_(self._index.reshape(*args),self._mask.reshape(*args),self._geoms))
+
+    def to_shapely(self):
+        '''
+        :returns: A masked object array of shapely geometries.
+        :rtype: :class:`numpy.ma.MaskedArray`
+        '''
+        ret = np.ma.array(np.empty(self.shape,dtype=object),mask=self._mask.copy())
+        for idx in zip(*np.nonzero(np.logical_not(self._mask))):
+            ret[idx] = self._get_geom_(int(self._index[idx]))
+        return(ret)
+
+    @classmethod
+    def from_bounds(cls,row_bounds,col_bounds,mask=None):
+        '''Create the polygons of a rectilinear grid.
+
+        :param row_bounds: Row bounds with shape (nrow,2).
+        :param col_bounds: Column bounds with shape (ncol,2).
+        :param mask: Boolean mask with shape (nrow,ncol).
+        :rtype: :class:`GeometryArray` with shape (nrow,ncol)
+        '''
+        nrow,ncol = row_bounds.shape[0],col_bounds.shape[0]
+        n = nrow*ncol
+        r0 = np.repeat(row_bounds[:,0],ncol)
+        r1 = np.repeat(row_bounds[:,1],ncol)
+        c0 = np.tile(col_bounds[:,0],nrow)
+        c1 = np.tile(col_bounds[:,1],nrow)
+        ## vertex order follows ocgis.util.helpers.make_poly
+        coords = np.empty((n,5,2),dtype=float)
+        for ii,(x,y) in enumerate([(c0,r0),(c0,r1),(c1,r1),(c1,r0),(c0,r0)]):
+            coords[:,ii,0] = x
+            coords[:,ii,1] = y
+        ret = cls('Polygon',coords,
+                  ring_offsets=np.arange(0,n*5+1,5),
+                  part_offsets=np.arange(n+1),
+                  geom_offsets=np.arange(n+1),
+                  multi=np.zeros(n,dtype=bool),
+                  index=np.arange(n).reshape(nrow,ncol),
+                  mask=mask)
+        return(ret)
+
+    @classmethod
+    def from_points(cls,x,y,mask=None):
+        '''
+        :param x: Point x-coordinates.
+        :param y: Point y-coordinates with the shape of `x`.
+        :param mask: Boolean mask with the shape of `x`.
+        :rtype: :class:`GeometryArray` with the shape of `x`
+        '''
+        x = np.asarray(x,dtype=float)
+        coords = np.column_stack((x.reshape(-1),np.asarray(y,dtype=float).reshape(-1)))
+        return(cls('Point',coords,index=np.arange(x.size).reshape(x.shape),mask=mask))
+
+    @classmethod
+    def from_shapely(cls,geoms,mask=None):
+        '''Pack shapely geometries into buffers. Geometry types other than
+        points, polygons, and multi-polygons are held as shapely geometries.
+
+        :param geoms: A sequence or array of shapely geometries.
+        :param mask: Boolean mask with the shape of `geoms`. The mask of a
+         masked array is used if not provided.
+        :rtype: :class:`GeometryArray`
+        '''
+        ## avoid numpy conversion of the geometries' array interfaces
+        if isinstance(geoms,BaseGeometry):
+            arr = np.empty(1,dtype=object)
+            arr[0] = geoms
+        elif isinstance(geoms,np.ndarray):
+            if mask is None and np.ma.isMaskedArray(geoms):
+                mask = np.ma.getmaskarray(geoms)
+            arr = np.array(np.ma.getdata(geoms),dtype=object)
+        else:
+            geoms = list(geoms)
+            arr = np.empty(len(geoms),dtype=object)
+            for ii,geom in enumerate(geoms):
+                arr[ii] = geom
+        flat = arr.reshape(-1)
+        index = np.arange(flat.shape[0]).reshape(arr.shape)
+
+        ## unmasked geometries determine the buffer type
+        valid = flat if mask is None else flat[np.logical_not(np.asarray(mask).reshape(-1))]
+        if len(valid) > 0 and all([isinstance(geom,Point) for geom in valid]):
+            coords = np.empty((flat.shape[0],2),dtype=float)
+            coords[:] = np.nan
+            geoms = {}
+            for ii,geom in enumerate(flat):
+                if isinstance(geom,Point):
+                    coords[ii,:] = geom.coords[0][0:2]
+                elif geom is not None:
+                    geoms[ii] = geom
+            return(cls('Point',coords,index=index,mask=mask,geoms=geoms))
+
+        coords,ring_offsets,part_offsets,geom_offsets = [],[0],[0],[0]
+        multi = np.zeros(flat.shape[0],dtype=bool)
+        geoms = {}
+        for ii,geom in enumerate(flat):
+            if isinstance(geom,Polygon):
+                parts = [geom]
+            elif isinstance(geom,MultiPolygon):
+                parts = list(geom)
+                multi[ii] = True
+            else:
+                parts = []
+                if geom is not None:
+                    geoms[ii] = geom
+            for part in parts:
+                for ring in [part.exterior] + list(part.interiors):
+                    ring_coords = np.array(ring.coords)[:,0:2]
+                    coords.append(ring_coords)
+                    ring_offsets.append(ring_offsets[-1]+ring_coords.shape[0])
+                part_offsets.append(len(ring_offsets)-1)
+            geom_offsets.append(len(part_offsets)-1)
+        coords = np.vstack(coords) if len(coords) > 0 else np.empty((0,2),dtype=float)
+        ret = cls('Polygon',coords,
+                  ring_offsets=np.array(ring_offsets),
+                  part_offsets=np.array(part_offsets),
+                  geom_offsets=np.array(geom_offsets),
+                  multi=multi,index=index,mask=mask,geoms=geoms)
+        return(ret)
+
+    def _get_area_centroid_(self):
+        ## shoelace sums over the segments of each ring
+        coords = self.coords
+        nrings = self.ring_offsets.shape[0]-1
+        ngeoms = self._ngeoms
+        ring_id = np.repeat(np.arange(nrings),np.diff(self.ring_offsets))
+        select = ring_id[:-1] == ring_id[1:]
+        x0,y0 = coords[:-1,0][select],coords[:-1,1][select]
+        x1,y1 = coords[1:,0][select],coords[1:,1][select]
+        segment_ring = ring_id[:-1][select]
+        cross = x0*y1 - x1*y0
+        ring_area = 0.5*np.bincount(segment_ring,weights=cross,minlength=nrings)
+        ring_cx = np.bincount(segment_ring,weights=(x0+x1)*cross,minlength=nrings)
+        ring_cy = np.bincount(segment_ring,weights=(y0+y1)*cross,minlength=nrings)
+        ## exterior rings add area and interior rings subtract it
+        part_id = np.repeat(np.arange(self.part_offsets.shape[0]-1),np.diff(self.part_offsets))
+        ring_geom = np.repeat(np.arange(ngeoms),np.diff(self.geom_offsets))[part_id]
+        exterior = np.arange(nrings) == self.part_offsets[part_id]
+        weight = np.where(exterior,1.0,-1.0)*np.abs(ring_area)
+        ## the ring centroid is the moment divided by six times the signed area
+        nonzero = ring_area != 0
+        factor = np.zeros(nrings,dtype=float)
+        factor[nonzero] = weight[nonzero]/(6.0*ring_area[nonzero])
+        area = np.bincount(ring_geom,weights=weight,minlength=ngeoms)
+        centroid = np.empty((ngeoms,2),dtype=float)
+        centroid[:] = np.nan
+        has_area = area != 0
+        centroid[has_area,0] = np.bincount(ring_geom,weights=ring_cx*factor,minlength=ngeoms)[has_area]/area[has_area]
+        centroid[has_area,1] = np.bincount(ring_geom,weights=ring_cy*factor,minlength=ngeoms)[has_area]/area[has_area]
+        return(area,centroid)
+
+    def _get_geom_(self,idx):
+        try:
+            ret = self._geoms[idx]
+        except KeyError:
+            if self.geom_type == 'Point':
+                ret = Point(*self.coords[idx])
+            else:
+                parts = []
+                ring_offsets = self.ring_offsets
+                for part in range(self.geom_offsets[idx],self.geom_offsets[idx+1]):
+                    rings = [self.coords[ring_offsets[ring]:ring_offsets[ring+1]] for ring in
+                             range(self.part_offsets[part],self.part_offsets[part+1])]
+                    parts.append(Polygon(rings[0],rings[1:]))
+                if self.multi[idx]:
+                    ret = MultiPolygon(parts)
+                else:
+                    ret = parts[0]
+        return(ret)
+
+    def _new_(self,index,mask,geoms):
+        ret = self.__class__(self.geom_type,self.coords,ring_offsets=self.ring_offsets,
+                             part_offsets=self.part_offsets,geom_offsets=self.geom_offsets,
+                             multi=self.multi,index=index,geoms=geoms)
+        ## keep views of the mask
+        ret._mask = mask
+        return(ret)
+
+    def _replace_(self,values,func):
+        ## replace buffer values for geometries held as shapely geometries
+        for idx,geom in self._geoms.iteritems():
+            values[idx] = func(geom)
+        return(values)
@@ -1,6 +1,10 @@
 import numpy as np
+from abc import ABCMeta, abstractmethod
 from shapely.geometry.multipolygon import MultiPolygon
+from shapely import prepared
 from ocgis.util.helpers import make_poly
+from shapely.geometry.point import Point
+from ocgis.util.spatial.mask import get_edges, get_inside_points
 
     
 def shapely_grid(dim,rtup,ctup,target=None):
@@ -55,84 +59,261 @@ def index_intersects(target,index):
                 break
     return(ret)
 
-################################################################################
-
-#sc = ShpCabinet()
-
-#geom = sc.get_geom_dict('state_boundaries',{'id':[16]})[0]['geom']
-#geom = sc.get_geom_dict('world_countries')
-#geom = union_geom_dicts(geom)[0]['geom']
-#
-##target = Point(-99.77,41.22)
-#target = make_poly((40,41),(-99,-98))
-#
-#dims = np.arange(10,100,10)
-#build_times = []
-#int_times = []
-#for dim in dims.flat:
-#    print(dim)
-#    
-#    t1 = time.time()
-#    grid = build_index_grid(dim,geom)
-#    index = build_index(geom,grid)
-#    t2 = time.time()
-#    build_times.append(t2-t1)
-#    
-#    t1 = time.time()
-#    index_intersects(target,index)
-#    t2 = time.time()
-#    int_times.append(t2-t1)
-#
-#plt.figure(1)
-#plt.subplot(211)
-#plt.plot(dims,build_times)
-#plt.title('build times')
-#
-#plt.subplot(212)
-#plt.plot(dims,int_times)
-#plt.title('intersects times')
-#
-#plt.show()
-
-#print index_intersects(pt,index)
-
-#import ipdb;ipdb.set_trace()
-
-################################################################################
-
-#rtup = (40.0,50.0)
-#ctup = (-120.0,-100.0)
-#dim = 5.0
-#
-#tag = str(datetime.now())
-#target = make_poly(rtup,ctup)
-#grid = shapely_grid(dim,rtup,ctup)
-#index = build_index(target,grid)
-#test_in = make_poly((42.17,43.31),(-118.72,-117.52))
-#test_out = make_poly((41.10,42.81),(-125.56,-123.58))
-#
-#print('in')
-#print(index_intersects(test_in,index))
-#print('out')
-#print(index_intersects(test_out,index))
-#
-#import ipdb;ipdb.set_trace()
-#
-#shapely_to_shp(target,'target_'+tag)
-#shapely_to_shp(grid,'grid_'+tag)
-#shapely_to_shp(test_in,'test_in_'+tag)
-#shapely_to_shp(test_out,'test_out_'+tag)
-
-#sc = ShpCabinet()
-#geom_dict = sc.get_geom_dict('state_boundaries',{'ugid':[25]})
-#geom = geom_dict[0]['geom']
-#bounds = geom.bounds
-#rtup = (bounds[1],bounds[3])
-#ctup = (bounds[0],bounds[2])
-#grid = shapely_grid(1.0,rtup,ctup,target=geom)
-#index = build_index(geom,grid)
-#
-#import ipdb;ipdb.set_trace()
-#
-#shapely_to_shp(geom,'geom_'+tag)
-#shapely_to_shp(grid,'grid_'+tag)
\ No newline at end of file
+
+def _expand_ranges_(start,stop):
+    ## concatenate the index ranges [start,stop)
+    counts = stop-start
+    idx = np.repeat(np.arange(counts.shape[0]),counts)
+    offset = np.cumsum(counts)-counts
+    return(start[idx] + (np.arange(idx.shape[0])-offset[idx]))
+
+
+class StrTree(object):
+    '''A static R-tree packed with the Sort-Tile-Recursive algorithm.
+    
+    :param bounds: Item bounding boxes with shape (n,4) and columns `minx, miny,
+     maxx, maxy`.
+    :type bounds: :class:`numpy.ndarray`
+    :param int capacity: Maximum number of children for a node.
+    '''
+    
+    def __init__(self,bounds,capacity=8):
+        bounds = np.array(bounds,dtype=float).reshape(-1,4)
+        self.capacity = capacity
+        self._order = self._get_str_order_(bounds)
+        ## level zero holds the items. nodes of higher levels reference a
+        ## contiguous range of nodes on the level below.
+        self._bounds = [bounds[self._order]]
+        self._start = [None]
+        self._stop = [None]
+        while self._bounds[-1].shape[0] > 1:
+            self._pack_()
+    
+    def __len__(self):
+        return(self._order.shape[0])
+    
+    def query(self,bounds):
+        '''
+        :param bounds: Query bounding box as `minx, miny, maxx, maxy`.
+        :returns: Indices of the items with bounding boxes intersecting the
+         query bounding box.
+        :rtype: :class:`numpy.ndarray`
+        '''
+        minx,miny,maxx,maxy = bounds
+        ## descending the tree only pays off for larger trees
+        if self._order.shape[0] <= self.capacity**2:
+            top = 0
+        else:
+            top = len(self._bounds)-1
+        nodes = np.arange(self._bounds[top].shape[0])
+        for level in range(top,-1,-1):
+            ref = self._bounds[level][nodes]
+            select = (ref[:,0] <= maxx) & (ref[:,2] >= minx) & \
+                     (ref[:,1] <= maxy) & (ref[:,3] >= miny)
+            nodes = nodes[select]
+            if level > 0:
+                nodes = _expand_ranges_(self._start[level][nodes],
+                                        self._stop[level][nodes])
+        return(self._order[nodes])
+    
+    def _get_str_order_(self,bounds):
+        ## sort into vertical slabs by center x then by center y within slabs
+        n = bounds.shape[0]
+        if n == 0:
+            return(np.zeros(0,dtype=int))
+        nnodes = int(np.ceil(n/float(self.capacity)))
+        slab_size = int(np.ceil(np.sqrt(nnodes)))*self.capacity
+        cx = bounds[:,0] + bounds[:,2]
+        cy = bounds[:,1] + bounds[:,3]
+        slab = np.empty(n,dtype=int)
+        slab[np.argsort(cx,kind='mergesort')] = np.arange(n)//slab_size
+        return(np.lexsort((cy,slab)))
+    
+    def _pack_(self):
+        child = self._bounds[-1]
+        start = np.arange(0,child.shape[0],self.capacity)
+        stop = np.minimum(start+self.capacity,child.shape[0])
+        bounds = np.column_stack((np.minimum.reduceat(child[:,0],start),
+                                  np.minimum.reduceat(child[:,1],start),
+                                  np.maximum.reduceat(child[:,2],start),
+                                  np.maximum.reduceat(child[:,3],start)))
+        order = self._get_str_order_(bounds)
+        self._bounds.append(bounds[order])
+        self._start.append(start[order])
+        self._stop.append(stop[order])
+
+
+class AbstractSpatialIndex(object):
+    '''Spatial index for repeated tests against a single target geometry.
+    
+    :param target: The geometry to index.
+    :type target: :class:`shapely.geometry.Polygon` or :class:`shapely.geometry.MultiPolygon`
+    '''
+    __metaclass__ = ABCMeta
+    
+    def __init__(self,target):
+        self.target = target
+        
+    @abstractmethod
+    def intersects(self,geom,bounds=None):
+        '''Return `True` if the geometry intersects the target.
+        
+        :param geom: The geometry to test.
+        :param bounds: The geometry's bounding box if already known.
+        :type bounds: tuple
+        '''
+    
+    @abstractmethod
+    def keep(self,geom,bounds=None):
+        '''Return `True` if the geometry intersects and does not only touch the
+        target. Parameters are the same as :meth:`intersects`.'''
+    
+    
+class GridIndex(AbstractSpatialIndex):
+    '''The target is cut into pieces by a regular grid of boxes.
+    
+    :param float dim: The box dimension.
+    '''
+    
+    def __init__(self,target,dim=30.0):
+        super(GridIndex,self).__init__(target)
+        self._index = build_index(target,build_index_grid(dim,target))
+        
+    def intersects(self,geom,bounds=None):
+        ret = False
+        for value in self._index.itervalues():
+            if value['box'].intersects(geom) and value['geom'].intersects(geom):
+                ret = True
+                break
+        return(ret)
+    
+    def keep(self,geom,bounds=None):
+        return(index_intersects(geom,self._index))
+
+
+class QuadtreeIndex(AbstractSpatialIndex):
+    '''The target's bounding box is split recursively into quadrants until the
+    number of target vertices in a quadrant falls to `max_vertices`. Quadrant
+    pieces of the target are searched using a :class:`StrTree`.
+    
+    :param int max_vertices: Maximum number of target vertices in a piece.
+    :param int max_depth: Maximum number of quadrant splits.
+    :param int capacity: Node capacity for the :class:`StrTree`.
+    '''
+    
+    def __init__(self,target,max_vertices=64,max_depth=10,capacity=8):
+        super(QuadtreeIndex,self).__init__(target)
+        self.max_vertices = max_vertices
+        self.max_depth = max_depth
+        
+        edges = get_edges(target)
+        if edges is None:
+            vertices = np.array(target.envelope.exterior.coords)
+        else:
+            vertices = edges[:,0:2]
+        prep_target = prepared.prep(target)
+        
+        ## pieces fully contained by the target are the quadrant box
+        self._pieces = []
+        self._prep_pieces = []
+        bounds = []
+        for box_bounds in self._iter_quadrants_(target.bounds,vertices,0):
+            minx,miny,maxx,maxy = box_bounds
+            box = make_poly((miny,maxy),(minx,maxx))
+            if prep_target.contains(box):
+                piece = box
+            else:
+                if not prep_target.intersects(box):
+                    continue
+                piece = target.intersection(box)
+                if piece.is_empty:
+                    continue
+            self._pieces.append(piece)
+            self._prep_pieces.append(prepared.prep(piece))
+            bounds.append(piece.bounds)
+        self._tree = StrTree(bounds,capacity=capacity)
+        
+    def __len__(self):
+        return(len(self._pieces))
+        
+    def intersects(self,geom,bounds=None):
+        ret = False
+        prep_pieces = self._prep_pieces
+        for idx in self._tree.query(bounds or geom.bounds):
+            if prep_pieces[idx].intersects(geom):
+                ret = True
+                break
+        return(ret)
+    
+    def keep(self,geom,bounds=None):
+        ret = False
+        touched = False
+        prep_pieces = self._prep_pieces
+        for idx in self._tree.query(bounds or geom.bounds):
+            if prep_pieces[idx].intersects(geom):
+                if not prep_pieces[idx].touches(geom):
+                    ret = True
+                    break
+                touched = True
+        ## geometries without area may lie on the seam between pieces inside
+        ## the target.
+        if not ret and touched and geom.area == 0:
+            ret = keep(self.target,geom)
+        return(ret)
+    
+    def _iter_quadrants_(self,bounds,vertices,depth):
+        if vertices.shape[0] <= self.max_vertices or depth == self.max_depth:
+            yield(bounds)
+        else:
+            minx,miny,maxx,maxy = bounds
+            midx = (minx+maxx)/2.0
+            midy = (miny+maxy)/2.0
+            for quadrant in [(minx,miny,midx,midy),(midx,miny,maxx,midy),
+                             (minx,midy,midx,maxy),(midx,midy,maxx,maxy)]:
+                select = (vertices[:,0] >= quadrant[0]) & (vertices[:,0] <= quadrant[2]) & \
+                         (vertices[:,1] >= quadrant[1]) & (vertices[:,1] <= quadrant[3])
+                for ret in self._iter_quadrants_(quadrant,vertices[select],depth+1):
+                    yield(ret)
+
+
+SPATIAL_INDEXES = {'quadtree':QuadtreeIndex,
+                   'grid':GridIndex}
+
+def get_spatial_index(target,method='quadtree',**kwds):
+    '''
+    :param target: The geometry to index.
+    :param str method: Key of the index class in :attr:`SPATIAL_INDEXES`.
+    :param kwds: Passed to the index class constructor.
+    :rtype: :class:`AbstractSpatialIndex`
+    '''
+    try:
+        klass = SPATIAL_INDEXES[method]
+    except KeyError:
+        raise(ValueError('Spatial index method not recognized: {0}'.format(method)))
+    return(klass(target,**kwds))
+
+def intersects_points(target,x,y):
+    '''Vectorized equivalent of `target.intersects(Point(x,y))`.
+    
+    :param target: The geometry to test against.
+    :param x: Point x-coordinates.
+    :type x: :class:`numpy.ndarray`
+    :param y: Point y-coordinates with the same shape as `x`.
+    :type y: :class:`numpy.ndarray`
+    :rtype: boolean :class:`numpy.ndarray` with the shape of `x`
+    '''
+    x = np.asarray(x,dtype=float)
+    y = np.asarray(y,dtype=float)
+    edges = get_edges(target)
+    if edges is None:
+        ret = np.zeros(x.shape,dtype=bool)
+        to_test = np.ones(x.shape,dtype=bool)
+    else:
+        ret,to_test = get_inside_points(edges,x,y)
+    ## points near the boundary are confirmed with the spatial index
+    if to_test.any():
+        index = get_spatial_index(target)
+        for idx in zip(*np.nonzero(to_test)):
+            px,py = x[idx],y[idx]
+            ret[idx] = index.intersects(Point(px,py),bounds=(px,py,px,py))
+    return(ret)
@@ -0,0 +1,249 @@
+import numpy as np
+from shapely.geometry.polygon import Polygon
+from shapely.geometry.multipolygon import MultiPolygon
+
+
+def get_edges(geom):
+    '''Return the ring segments of a polygon.
+
+    :type geom: :class:`shapely.geometry.Polygon` or :class:`shapely.geometry.MultiPolygon`
+    :returns: Segment coordinates as columns `x0, y0, x1, y1` or `None` if the
+     geometry type is not supported.
+    :rtype: :class:`numpy.ndarray`
+    '''
+    if isinstance(geom,Polygon):
+        polygons = [geom]
+    elif isinstance(geom,MultiPolygon):
+        polygons = list(geom)
+    else:
+        return(None)
+    edges = []
+    for polygon in polygons:
+        for ring in [polygon.exterior] + list(polygon.interiors):
+            coords = np.array(ring.coords,dtype=float)
+            if coords.shape[0] < 2:
+                continue
+            edges.append(np.hstack((coords[:-1,0:2],coords[1:,0:2])))
+    if len(edges) == 0:
+        ret = np.empty((0,4),dtype=float)
+    else:
+        ret = np.vstack(edges)
+    return(ret)
+
+def get_breaks(bounds):
+    '''Return the cell breaks of contiguous bounds in ascending order.
+
+    :param bounds: Two-dimensional bounds array with shape (n,2).
+    :type bounds: :class:`numpy.ndarray`
+    :returns: A tuple composed of the breaks with shape (n+1,) and a boolean
+     indicating if the cells are in descending order. `None` is returned if
+     the cells are not contiguous or not monotonic.
+    :rtype: tuple
+    '''
+    lower = bounds.min(axis=1)
+    upper = bounds.max(axis=1)
+    if lower.shape[0] == 0:
+        return(None)
+    if lower.shape[0] == 1:
+        reverse = False
+    else:
+        diff = np.diff(lower)
+        if np.all(diff > 0):
+            reverse = False
+        elif np.all(diff < 0):
+            reverse = True
+            lower = lower[::-1]
+            upper = upper[::-1]
+        else:
+            return(None)
+    tol = 1e-10*max(1.0,np.abs(bounds).max())
+    if not np.allclose(upper[:-1],lower[1:],rtol=0,atol=tol):
+        return(None)
+    breaks = np.hstack((lower,upper[-1]))
+    return(breaks,reverse)
+
+def _iter_pairs_(lower,upper):
+    ## for each segment, expand the half-open index range [lower,upper) into
+    ## pairs of segment and index.
+    counts = np.maximum(upper-lower,0)
+    idx_segment = np.repeat(np.arange(counts.shape[0]),counts)
+    offset = np.cumsum(counts)-counts
+    idx = lower[idx_segment] + (np.arange(idx_segment.shape[0])-offset[idx_segment])
+    return(idx_segment,idx)
+
+def _get_cell_range_(breaks,value):
+    ## cells containing the value. two cells are returned if the value falls
+    ## on a break.
+    lower = np.searchsorted(breaks,value,side='left')-1
+    upper = np.searchsorted(breaks,value,side='right')-1
+    return(lower,upper)
+
+def _mark_(fill,rows,cols):
+    ## mark every combination of the row and column ranges inside the grid
+    nrow,ncol = fill.shape
+    for row in rows:
+        for col in cols:
+            select = (row >= 0)&(row < nrow)&(col >= 0)&(col < ncol)
+            fill[row[select],col[select]] = True
+
+def get_boundary_cells(edges,row_breaks,col_breaks):
+    '''Identify cells the polygon boundary passes through. Cells touched by the
+    boundary are included making this a conservative estimate.
+
+    :param edges: Segments from :func:`get_edges`.
+    :param row_breaks: Ascending row breaks.
+    :param col_breaks: Ascending column breaks.
+    :rtype: boolean :class:`numpy.ndarray` with shape (nrow,ncol)
+    '''
+    fill = np.zeros((row_breaks.shape[0]-1,col_breaks.shape[0]-1),dtype=bool)
+    x0,y0,x1,y1 = edges[:,0],edges[:,1],edges[:,2],edges[:,3]
+
+    ## cells containing segment vertices
+    _mark_(fill,_get_cell_range_(row_breaks,y0),_get_cell_range_(col_breaks,x0))
+
+    ## segments crossing horizontal cell boundaries
+    ymin,ymax = np.minimum(y0,y1),np.maximum(y0,y1)
+    lower = np.searchsorted(row_breaks,ymin,side='right')
+    upper = np.searchsorted(row_breaks,ymax,side='left')
+    idx_segment,idx = _iter_pairs_(lower,upper)
+    if idx.shape[0] > 0:
+        y = row_breaks[idx]
+        sx0,sy0,sx1,sy1 = x0[idx_segment],y0[idx_segment],x1[idx_segment],y1[idx_segment]
+        x = sx0 + (y-sy0)*(sx1-sx0)/(sy1-sy0)
+        _mark_(fill,(idx-1,idx),_get_cell_range_(col_breaks,x))
+
+    ## segments crossing vertical cell boundaries
+    xmin,xmax = np.minimum(x0,x1),np.maximum(x0,x1)
+    lower = np.searchsorted(col_breaks,xmin,side='right')
+    upper = np.searchsorted(col_breaks,xmax,side='left')
+    idx_segment,idx = _iter_pairs_(lower,upper)
+    if idx.shape[0] > 0:
+        x = col_breaks[idx]
+        sx0,sy0,sx1,sy1 = x0[idx_segment],y0[idx_segment],x1[idx_segment],y1[idx_segment]
+        y = sy0 + (x-sx0)*(sy1-sy0)/(sx1-sx0)
+        _mark_(fill,_get_cell_range_(row_breaks,y),(idx-1,idx))
+
+    return(fill)
+
+def get_inside_grid(edges,x,y):
+    '''Even-odd point-in-polygon test for the points of a rectilinear grid.
+    Points on the polygon boundary may be classified either way.
+
+    :param edges: Segments from :func:`get_edges`.
+    :param x: Ascending column coordinates.
+    :param y: Ascending row coordinates.
+    :rtype: boolean :class:`numpy.ndarray` with shape (y.shape[0],x.shape[0])
+    '''
+    x0,y0,x1,y1 = edges[:,0],edges[:,1],edges[:,2],edges[:,3]
+    ## rows crossed by a horizontal ray from the segment
+    ymin,ymax = np.minimum(y0,y1),np.maximum(y0,y1)
+    lower = np.searchsorted(y,ymin,side='left')
+    upper = np.searchsorted(y,ymax,side='left')
+    idx_segment,idx_row = _iter_pairs_(lower,upper)
+    ny,nx = y.shape[0],x.shape[0]
+    if idx_row.shape[0] == 0:
+        return(np.zeros((ny,nx),dtype=bool))
+    sx0,sy0,sx1,sy1 = x0[idx_segment],y0[idx_segment],x1[idx_segment],y1[idx_segment]
+    xcross = sx0 + (y[idx_row]-sy0)*(sx1-sx0)/(sy1-sy0)
+    ## a crossing flips the parity of all points to its left. count crossings
+    ## by the number of points they flip then accumulate from the right.
+    idx_col = np.searchsorted(x,xcross,side='left')
+    counts = np.bincount(idx_row*(nx+1)+idx_col,minlength=ny*(nx+1)).reshape(ny,nx+1)
+    flips = np.cumsum(counts[:,::-1],axis=1)[:,::-1]
+    return(flips[:,1:] % 2 == 1)
+
+def get_inside_points(edges,x,y,tolerance=None,batch_size=1000000):
+    '''Even-odd point-in-polygon test for arbitrary points.
+
+    :param edges: Segments from :func:`get_edges`.
+    :param x: Point x-coordinates.
+    :type x: :class:`numpy.ndarray`
+    :param y: Point y-coordinates with the same shape as `x`.
+    :type y: :class:`numpy.ndarray`
+    :param float tolerance: Points closer than this horizontal distance to a
+     segment are flagged as ambiguous. If `None`, a tolerance relative to the
+     segment coordinates is used.
+    :param int batch_size: Maximum number of segment-point pairs evaluated at
+     once.
+    :returns: A tuple of boolean arrays `(inside,ambiguous)` with the shape of
+     `x`. Ambiguous points lie on or near the polygon boundary and should be
+     confirmed with an exact test.
+    :rtype: tuple
+    '''
+    shape = np.shape(x)
+    x = np.asarray(x,dtype=float).reshape(-1)
+    y = np.asarray(y,dtype=float).reshape(-1)
+    if tolerance is None:
+        tolerance = 1e-9*max(1.0,np.abs(edges).max() if edges.shape[0] > 0 else 1.0)
+    ## points are sorted by y so the points on a segment's scanlines are
+    ## contiguous.
+    order = np.argsort(y,kind='mergesort')
+    xs,ys = x[order],y[order]
+    crossings = np.zeros(x.shape[0],dtype=int)
+    ambiguous = np.zeros(x.shape[0],dtype=bool)
+    
+    x0,y0,x1,y1 = edges[:,0],edges[:,1],edges[:,2],edges[:,3]
+    ymin,ymax = np.minimum(y0,y1),np.maximum(y0,y1)
+    horizontal = ymin == ymax
+    
+    ## non-horizontal segments. the pairing is widened by the tolerance to
+    ## flag points near segment end points.
+    idx_edges = np.nonzero(~horizontal)[0]
+    lower = np.searchsorted(ys,ymin[idx_edges]-tolerance,side='left')
+    upper = np.searchsorted(ys,ymax[idx_edges]+tolerance,side='right')
+    counts = np.cumsum(np.maximum(upper-lower,0))
+    splits = np.searchsorted(counts,np.arange(batch_size,counts[-1] if counts.shape[0] > 0 else 0,batch_size))
+    for batch in np.split(np.arange(idx_edges.shape[0]),splits):
+        idx_segment,idx_point = _iter_pairs_(lower[batch],upper[batch])
+        idx_segment = idx_edges[batch][idx_segment]
+        sx0,sy0,sx1,sy1 = x0[idx_segment],y0[idx_segment],x1[idx_segment],y1[idx_segment]
+        py = ys[idx_point]
+        dx = xs[idx_point] - (sx0 + (py-sy0)*(sx1-sx0)/(sy1-sy0))
+        cross = (dx < 0) & (py >= ymin[idx_segment]) & (py < ymax[idx_segment])
+        crossings += np.bincount(idx_point[cross],minlength=x.shape[0])
+        ambiguous[idx_point[np.abs(dx) <= tolerance]] = True
+    
+    ## points on horizontal segments
+    idx_edges = np.nonzero(horizontal)[0]
+    lower = np.searchsorted(ys,y0[idx_edges]-tolerance,side='left')
+    upper = np.searchsorted(ys,y0[idx_edges]+tolerance,side='right')
+    idx_segment,idx_point = _iter_pairs_(lower,upper)
+    idx_segment = idx_edges[idx_segment]
+    on = (xs[idx_point] >= np.minimum(x0,x1)[idx_segment]-tolerance) & \
+         (xs[idx_point] <= np.maximum(x0,x1)[idx_segment]+tolerance)
+    ambiguous[idx_point[on]] = True
+    
+    inside = np.empty(x.shape[0],dtype=bool)
+    inside[order] = crossings % 2 == 1
+    ret_ambiguous = np.empty(x.shape[0],dtype=bool)
+    ret_ambiguous[order] = ambiguous
+    return(inside.reshape(shape),ret_ambiguous.reshape(shape))
+
+def classify_cells(polygon,row_bounds,col_bounds):
+    '''Classify grid cells as inside the polygon or on its boundary using only
+    the cell bounds. Cells that are neither are outside the polygon.
+
+    :type polygon: :class:`shapely.geometry.Polygon` or :class:`shapely.geometry.MultiPolygon`
+    :param row_bounds: Row bounds with shape (nrow,2).
+    :param col_bounds: Column bounds with shape (ncol,2).
+    :returns: A tuple of boolean arrays `(inside,boundary)` with shape
+     (nrow,ncol) or `None` if the grid or polygon is not supported.
+    :rtype: tuple
+    '''
+    edges = get_edges(polygon)
+    row = get_breaks(row_bounds)
+    col = get_breaks(col_bounds)
+    if edges is None or row is None or col is None:
+        return(None)
+    (row_breaks,row_reverse),(col_breaks,col_reverse) = row,col
+    boundary = get_boundary_cells(edges,row_breaks,col_breaks)
+    ## cells not touched by the boundary are entirely inside or outside the
+    ## polygon. their centers determine which.
+    inside = get_inside_grid(edges,(col_breaks[:-1]+col_breaks[1:])/2.0,
+                             (row_breaks[:-1]+row_breaks[1:])/2.0)
+    inside[boundary] = False
+    if row_reverse:
+        inside,boundary = inside[::-1,:],boundary[::-1,:]
+    if col_reverse:
+        inside,boundary = inside[:,::-1],boundary[:,::-1]
+    return(inside,boundary)
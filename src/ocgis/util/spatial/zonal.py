@@ -0,0 +1,147 @@
+import numpy as np
+from shapely import prepared
+from ocgis.util.helpers import make_poly, get_cell_area
+from ocgis.util.spatial import index as si
+from ocgis.util.spatial.mask import classify_cells
+
+
+class SparseWeights(object):
+    '''Weights of grid cells for a set of selection geometries stored as a
+    sparse matrix in compressed sparse row format. Matrix rows are selection
+    geometries and matrix columns are the flattened grid cells.
+
+    :param indptr: Row `ii` is stored in `indices[indptr[ii]:indptr[ii+1]]`
+     and `data[indptr[ii]:indptr[ii+1]]`.
+    :type indptr: :class:`numpy.ndarray`
+    :param indices: Flat grid cell indices.
+    :type indices: :class:`numpy.ndarray`
+    :param data: Cell weights.
+    :type data: :class:`numpy.ndarray`
+    :param shape: Number of geometries and number of grid cells.
+    :type shape: (int, int)
+    '''
+
+    def __init__(self,indptr,indices,data,shape):
+        self.indptr = np.asarray(indptr,dtype=int)
+        self.indices = np.asarray(indices,dtype=int)
+        self.data = np.asarray(data,dtype=float)
+        self.shape = tuple(shape)
+
+    def __len__(self):
+        return(self.shape[0])
+
+    def get_row(self,idx):
+        '''
+        :param int idx: The geometry index.
+        :returns: Flat grid cell indices and weights of cells selected by the
+         geometry.
+        :rtype: (:class:`numpy.ndarray`, :class:`numpy.ndarray`)
+        '''
+        slc = slice(self.indptr[idx],self.indptr[idx+1])
+        return(self.indices[slc],self.data[slc])
+
+    def average(self,value):
+        '''Weighted average of the value for each geometry. Masked values do
+        not contribute to the average.
+
+        :param value: Array with dimensions (time,level,row,column) with the
+         grid cells flattened by row.
+        :type value: :class:`numpy.ma.MaskedArray`
+        :returns: Array with shape (time,level,geometries). Elements with no
+         unmasked values are masked.
+        :rtype: :class:`numpy.ma.MaskedArray`
+        '''
+        nt,nl = value.shape[0],value.shape[1]
+        flat = value.reshape(nt*nl,-1)
+        if flat.shape[1] != self.shape[1]:
+            raise(ValueError('Value has {0} grid cells but the weights require {1}.'.format(flat.shape[1],self.shape[1])))
+        total = np.zeros((nt*nl,self.shape[0]),dtype=float)
+        weight_sum = np.zeros((nt*nl,self.shape[0]),dtype=float)
+        ## rows without cells are skipped. the remaining row starts partition
+        ## the stored elements.
+        nonempty = np.nonzero(np.diff(self.indptr) > 0)[0]
+        if nonempty.shape[0] > 0:
+            starts = self.indptr[nonempty]
+            data = np.take(np.ma.getdata(flat),self.indices,axis=1).astype(float)
+            mask = np.ma.getmask(flat)
+            if mask is np.ma.nomask or not mask.any():
+                weight_sum[:,nonempty] = np.add.reduceat(self.data,starts)
+            else:
+                invalid = np.take(mask,self.indices,axis=1)
+                data[invalid] = 0
+                weight_sum[:,nonempty] = np.add.reduceat(np.logical_not(invalid)*self.data,starts,axis=1)
+            data *= self.data
+            total[:,nonempty] = np.add.reduceat(data,starts,axis=1)
+        select = weight_sum > 0
+        ret = np.zeros(total.shape,dtype=float)
+        ret[select] = total[select]/weight_sum[select]
+        shape = (nt,nl,self.shape[0])
+        return(np.ma.array(ret.reshape(shape),mask=np.logical_not(select).reshape(shape)))
+
+
+def get_sparse_weights(geoms,row_bounds,col_bounds,spatial_operation='intersects',
+                       spherical=False):
+    '''Build the cell weights of a polygon grid for each selection geometry.
+    Cell weights are the cell areas. For a clip operation, the weights of cells
+    on the geometry boundary are reduced by the fraction of the cell area
+    outside the geometry.
+
+    :param geoms: Selection geometries.
+    :type geoms: sequence of :class:`shapely.geometry.Polygon` or :class:`shapely.geometry.MultiPolygon`
+    :param row_bounds: Row bounds with shape (nrow,2).
+    :param col_bounds: Column bounds with shape (ncol,2).
+    :param str spatial_operation: Either `'intersects'` or `'clip'`.
+    :param bool spherical: If `True`, use cell areas on the sphere.
+    :rtype: :class:`SparseWeights`
+    '''
+    if spatial_operation not in ('intersects','clip'):
+        raise(NotImplementedError(spatial_operation))
+    area = get_cell_area(row_bounds,col_bounds,spherical=spherical)
+    row_min,row_max = row_bounds.min(axis=1),row_bounds.max(axis=1)
+    col_min,col_max = col_bounds.min(axis=1),col_bounds.max(axis=1)
+    ncol = col_bounds.shape[0]
+
+    indptr = [0]
+    indices = []
+    data = []
+    for geom in geoms:
+        minx,miny,maxx,maxy = geom.bounds
+        rsel = np.nonzero(np.logical_and(row_min <= maxy,row_max >= miny))[0]
+        csel = np.nonzero(np.logical_and(col_min <= maxx,col_max >= minx))[0]
+        fraction = np.zeros((rsel.shape[0],csel.shape[0]),dtype=float)
+        if fraction.size > 0:
+            row = row_bounds[rsel,:]
+            col = col_bounds[csel,:]
+            classified = classify_cells(geom,row,col)
+            if classified is None:
+                boundary = np.ones(fraction.shape,dtype=bool)
+            else:
+                inside,boundary = classified
+                fraction[inside] = 1.0
+            ## only cells on the geometry boundary require the exact test
+            index = None
+            prep_geom = prepared.prep(geom)
+            for ii,jj in zip(*np.nonzero(boundary)):
+                cell = make_poly(row[ii,:],col[jj,:])
+                if spatial_operation == 'clip':
+                    ## cells only touching the geometry have no area inside it
+                    if prep_geom.contains(cell):
+                        fraction[ii,jj] = 1.0
+                    elif prep_geom.intersects(cell) and cell.area > 0:
+                        fraction[ii,jj] = geom.intersection(cell).area/cell.area
+                else:
+                    if index is None:
+                        index = si.get_spatial_index(geom)
+                    bounds = (col_min[csel[jj]],row_min[rsel[ii]],col_max[csel[jj]],row_max[rsel[ii]])
+                    if index.keep(cell,bounds=bounds):
+                        fraction[ii,jj] = 1.0
+        ii,jj = np.nonzero(fraction > 0)
+        indices.append(rsel[ii]*ncol + csel[jj])
+        data.append(area[rsel[ii],csel[jj]]*fraction[ii,jj])
+        indptr.append(indptr[-1]+ii.shape[0])
+
+    if len(indices) == 0:
+        indices,data = np.zeros(0,dtype=int),np.zeros(0,dtype=float)
+    else:
+        indices,data = np.hstack(indices),np.hstack(data)
+    return(SparseWeights(indptr,indices,data,(len(indptr)-1,area.size)))